@@ -42,6 +42,19 @@ CACHE_HOST = env("CACHE_HOST", "cache")
 CACHE_PORT = env("CACHE_PORT", "6379")
 CACHE_PASS = env("CACHE_PASS")
 CACHE_DB = env("CACHE_DB", "0")
+CACHE_POOL_SIZE = env("CACHE_POOL_SIZE", 64, dtype=int) # connections per process of the asyncio client
+
+# Message Store record backend (redis | memory). The memory backend keeps records in the store's
+# process: use it for single-process stores. Audit logs, keys and certificates always stay on Redis.
+CACHE_BACKEND = env("CACHE_BACKEND", "redis")
+MEMORY_CACHE_SHARDS = env("MEMORY_CACHE_SHARDS", 16, dtype=int)
+MEMORY_CACHE_MAX_BYTES = env("MEMORY_CACHE_MAX_BYTES", 256 * 1024 * 1024, dtype=int)
+MEMORY_CACHE_TICK_MS = env("MEMORY_CACHE_TICK_MS", 100, dtype=float)
+
+# Message Store record layout (binary | text). Binary records keep raw bytes behind a
+# fixed-size length header; stores read both layouts. Binary takes 27% less memory per record
+# and a few microseconds more per retrieve to re-encode base64 (see experiments/record_bench.py).
+MS_RECORD_FORMAT = env("MS_RECORD_FORMAT", "binary")
 
 n_ev = env('n_ev', 3)
 n_ms = env('n_ms', 3)
@@ -91,8 +104,112 @@ KEYLIST_SIZE = env('KEYLIST_SIZE', 10, dtype=int)
 ROTATION_INTERVAL_SECONDS = env('ROTATION_INTERVAL_SECONDS', 10, dtype=int)
 LIVENESS_WINDOW_SECONDS = env('LIVENESS_WINDOW_SECONDS', 4, dtype=int)
 KEY_ROTATION_LABEL = env('KEY_ROTATION_LABEL', 'keyrotation')
+KEY_SCHEDULE = env('KEY_SCHEDULE', 'rotation') # rotation | epoch
 STORES_PER_MULTI_CID = env('STORES_PER_MULTI_CID', 1, dtype=int)
 
+# Threshold call IDs: with 0 < EV_THRESHOLD < n_ev a retrieve completes on the first EV_THRESHOLD
+# evaluators to answer and tolerates the others being down. Publishers store the record under
+# the call ID of every EV_THRESHOLD-subset of the evaluators that answered, C(n_ev, EV_THRESHOLD)
+# records per call. Threshold calls ask for full verification keys rather than pinned ones.
+EV_THRESHOLD = env('EV_THRESHOLD', 0, dtype=int)
+
+# Verified billing tokens remembered per worker process. A call presents its token to every EV
+# and MS once per phase, so uses beyond BILLING_MAX_USES are treated as double spending. Workers
+# do not share the count: a node running N workers lets a token through up to N * BILLING_MAX_USES
+# times, depending on which worker each presentation lands on.
+BILLING_CACHE_SIZE = env('BILLING_CACHE_SIZE', 100000, dtype=int)
+BILLING_CACHE_TTL = env('BILLING_CACHE_TTL', 2 * T_MAX_SECONDS, dtype=int)
+BILLING_MAX_USES = env('BILLING_MAX_USES', 8, dtype=int)
+
+# How long a proxy reuses its evaluator/store lists before re-reading them
+MEMBERSHIP_REFRESH_SECONDS = env('MEMBERSHIP_REFRESH_SECONDS', 5, dtype=float)
+
+# Retrieve hedging: with RETRIEVE_HEDGE_MS > 0 the proxy first asks RETRIEVE_INITIAL_FANOUT
+# stores and adds one more store each time the delay passes without a verified answer
+RETRIEVE_HEDGE_MS = env('RETRIEVE_HEDGE_MS', 0, dtype=float)
+RETRIEVE_INITIAL_FANOUT = env('RETRIEVE_INITIAL_FANOUT', 1, dtype=int)
+
+# Long-poll retrieve: with RETRIEVE_WAIT_MS > 0 stores hold a retrieve that misses until the
+# record is published or the wait ends, capped by MS_RETRIEVE_WAIT_MAX_MS and the request's deadline.
+# Workers of a store share publishes over Redis pub/sub; at most MS_RETRIEVE_MAX_WAITERS wait per worker.
+RETRIEVE_WAIT_MS = env('RETRIEVE_WAIT_MS', 0, dtype=float)
+MS_RETRIEVE_WAIT_MAX_MS = env('MS_RETRIEVE_WAIT_MAX_MS', 2000, dtype=float)
+MS_RETRIEVE_MAX_WAITERS = env('MS_RETRIEVE_MAX_WAITERS', 10000, dtype=int)
+
+# Candidate call IDs at a rotation boundary are tried one after the other, most likely first.
+# A key younger than PUBLISH_RETRIEVE_GAP_SECONDS was most likely not yet used to publish.
+RETRIEVE_CANDIDATE_HEDGE_MS = env('RETRIEVE_CANDIDATE_HEDGE_MS', 100, dtype=float)
+PUBLISH_RETRIEVE_GAP_SECONDS = env('PUBLISH_RETRIEVE_GAP_SECONDS', 2, dtype=float)
+
+# Proxy-side call ID cache (requires KEY_SCHEDULE=epoch)
+CALL_ID_CACHE = env('CALL_ID_CACHE', False, dtype=bool)
+CALL_ID_CACHE_SIZE = env('CALL_ID_CACHE_SIZE', 10000, dtype=int)
+
+# Proxy pins each evaluator's signed per-epoch key directory (requires KEY_SCHEDULE=epoch)
+PIN_EVALUATOR_KEYS = env('PIN_EVALUATOR_KEYS', False, dtype=bool)
+
+# Proxy to EV/MS body format (application/json | application/msgpack). Nodes accept both
+# and answer in the format the client accepts, so JSON remains the fallback.
+WIRE_FORMAT = env('WIRE_FORMAT', 'application/json')
+
+# Outgoing node requests: timeout, per-node scoring and circuit breakers. With
+# HTTP_HEDGE_PERCENTILE > 0, retrieve races hedge after that percentile of a store's latency.
+HTTP_TIMEOUT_SECONDS = env('HTTP_TIMEOUT_SECONDS', 5, dtype=float)
+HTTP_EWMA_ALPHA = env('HTTP_EWMA_ALPHA', 0.2, dtype=float)
+HTTP_LATENCY_SAMPLES = env('HTTP_LATENCY_SAMPLES', 128, dtype=int)
+HTTP_BREAKER_FAILURES = env('HTTP_BREAKER_FAILURES', 5, dtype=int)
+HTTP_BREAKER_ERROR_RATE = env('HTTP_BREAKER_ERROR_RATE', 0.5, dtype=float)
+HTTP_BREAKER_MIN_REQUESTS = env('HTTP_BREAKER_MIN_REQUESTS', 20, dtype=int)
+HTTP_BREAKER_COOLDOWN_SECONDS = env('HTTP_BREAKER_COOLDOWN_SECONDS', 5, dtype=float)
+HTTP_HEDGE_PERCENTILE = env('HTTP_HEDGE_PERCENTILE', 0, dtype=float)
+HTTP_HEDGE_MIN_SAMPLES = env('HTTP_HEDGE_MIN_SAMPLES', 20, dtype=int)
+
+# Signalling budget of a proxy call (0 disables deadlines). Ingress may pass its own budget in
+# the X-Jodi-Timeout-Ms header. Call ID generation gets CALL_DEADLINE_CID_SHARE of it, storage the rest.
+CALL_DEADLINE_MS = env('CALL_DEADLINE_MS', 0, dtype=float)
+CALL_DEADLINE_CID_SHARE = env('CALL_DEADLINE_CID_SHARE', 0.5, dtype=float)
+
+# Anonymous sessions: the proxy group-signs once per node and MACs later requests.
+# Sessions are re-established every SESSION_INTERVAL_SECONDS or SESSION_MAX_REQUESTS.
+# Nodes honour their own tickets for SESSION_TTL_SECONDS; without SESSION_TICKET_KEY the key is
+# derived from TEST_ISK and NODE_FQDN.
+# After a failed handshake the node is group-signed for SESSION_RETRY_SECONDS before trying again.
+SESSION_TICKETS = env('SESSION_TICKETS', False, dtype=bool)
+SESSION_INTERVAL_SECONDS = env('SESSION_INTERVAL_SECONDS', 60, dtype=float)
+SESSION_MAX_REQUESTS = env('SESSION_MAX_REQUESTS', 1000, dtype=int)
+SESSION_TTL_SECONDS = env('SESSION_TTL_SECONDS', 300, dtype=int)
+SESSION_RETRY_SECONDS = env('SESSION_RETRY_SECONDS', 5, dtype=float)
+SESSION_TICKET_KEY = env('SESSION_TICKET_KEY')
+
+# Pre-minted billing tokens held by proxies and simulators
+TOKEN_POOL_LOW = env('TOKEN_POOL_LOW', 64, dtype=int)
+TOKEN_POOL_HIGH = env('TOKEN_POOL_HIGH', 256, dtype=int)
+
+# Parsed PEM keys and certificates kept in memory
+KEY_REGISTRY_SIZE = env('KEY_REGISTRY_SIZE', 1024, dtype=int)
+
+# Receipt and audit-log signature scheme (ecdsa-p256 | ed25519 | hmac-session).
+# Ed25519 needs RECEIPT_ED25519_SK on nodes and RECEIPT_ED25519_PK on verifiers; HMAC needs RECEIPT_HMAC_KEY.
+RECEIPT_SCHEME = env('RECEIPT_SCHEME', 'ecdsa-p256')
+RECEIPT_ED25519_SK = env('RECEIPT_ED25519_SK')
+RECEIPT_ED25519_PK = env('RECEIPT_ED25519_PK')
+RECEIPT_HMAC_KEY = env('RECEIPT_HMAC_KEY')
+
+# Response receipts (single | merkle). Merkle mode signs one root per window of responses.
+RECEIPT_MODE = env('RECEIPT_MODE', 'single')
+RECEIPT_WINDOW_MS = env('RECEIPT_WINDOW_MS', 5, dtype=float)
+RECEIPT_BATCH_MAX = env('RECEIPT_BATCH_MAX', 256, dtype=int)
+RECEIPT_ROOT_CACHE_SIZE = env('RECEIPT_ROOT_CACHE_SIZE', 4096, dtype=int)
+
+# Crypto execution pool used by node handlers (thread | process)
+CRYPTO_POOL = env('CRYPTO_POOL', 'thread')
+CRYPTO_POOL_SIZE = env('CRYPTO_POOL_SIZE', 0, dtype=int) # 0 means one worker per core
+CRYPTO_QUEUE_DEPTH = env('CRYPTO_QUEUE_DEPTH', 256, dtype=int)
+
+# Request Batching (proxy side). A window of 0 disables micro-batching.
+BATCH_WINDOW_MS = env('BATCH_WINDOW_MS', 0, dtype=float)
+BATCH_MAX_SIZE = env('BATCH_MAX_SIZE', 64, dtype=int)
+
 # Network Churn
 EV_AVAILABILITY = env('EV_AVAILABILITY', 0.99, dtype=float)
 MS_AVAILABILITY = env('MS_AVAILABILITY', 0.99, dtype=float)
@@ -1,13 +1,29 @@
-import base64, traceback
-from cryptography.hazmat.primitives import serialization, hashes
+import abc, base64, hashlib, hmac, threading, traceback
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.exceptions import InvalidSignature
 
+from pylibjodi import Utils
+from typing import List
+
+from jodi import config
 from jodi.helpers import misc
+from jodi.crypto import keys, merkle
+
+RECEIPT_SINGLE = 'single'
+RECEIPT_MERKLE = 'merkle'
+
+SCHEME_ECDSA_P256 = 'ecdsa-p256'
+SCHEME_ED25519 = 'ed25519'
+SCHEME_HMAC_SESSION = 'hmac-session'
+
+# Roots whose signature was already checked, keyed by (signer, root, signature)
+verified_roots = OrderedDict()
+verified_roots_lock = threading.Lock()
 
 def ecdsa_sign(private_key, data) -> str:
-    if isinstance(private_key, str):
-        private_key = serialization.load_pem_private_key(private_key.encode(), password=None)
+    private_key = keys.load_private_key(private_key)
     if isinstance(data, dict) or isinstance(data, list):
         data = misc.stringify(data)
     signature = private_key.sign(
@@ -17,8 +33,7 @@ def ecdsa_sign(private_key, data) -> str:
     return base64.b64encode(signature).decode('utf-8')
 
 def ecdsa_verify(public_key, data, sigma: str) -> bool:
-    if isinstance(public_key, str):
-        public_key = serialization.load_pem_public_key(public_key.encode())
+    public_key = keys.load_public_key(public_key)
     if isinstance(data, dict) or isinstance(data, list):
         data = misc.stringify(data)
         
@@ -35,3 +50,182 @@ def ecdsa_verify(public_key, data, sigma: str) -> bool:
         print(f"Signature verification failed: {e}", flush=True)
         traceback.print_exc()
         return False
+
+
+def _encode(data) -> bytes:
+    if isinstance(data, dict) or isinstance(data, list):
+        data = misc.stringify(data)
+    return data.encode('utf-8')
+
+class ReceiptScheme(abc.ABC):
+    """
+    Signature scheme for node receipts and signed audit-log batches. Keys are loaded
+    from config once per process; callers may also pass their own key objects.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def signing_key(self):
+        pass
+
+    @abc.abstractmethod
+    def verification_key(self):
+        pass
+
+    @abc.abstractmethod
+    def sign(self, key, data) -> str:
+        pass
+
+    @abc.abstractmethod
+    def verify(self, key, data, sigma: str) -> bool:
+        pass
+
+    def key_id(self, key) -> str:
+        return keys.key_id(key)
+
+    def require_key(self, name: str, value: str) -> str:
+        if not value:
+            raise ValueError(f'{name} must be set to use the {self.name} receipt scheme')
+        return value
+
+class EcdsaP256Scheme(ReceiptScheme):
+    name = SCHEME_ECDSA_P256
+
+    def signing_key(self):
+        return keys.load_private_key(config.TEST_ISK)
+
+    def verification_key(self):
+        return keys.load_public_key_from_cert(config.TEST_ICERT)
+
+    def sign(self, key, data) -> str:
+        return ecdsa_sign(private_key=key, data=data)
+
+    def verify(self, key, data, sigma: str) -> bool:
+        return ecdsa_verify(public_key=key, data=data, sigma=sigma)
+
+class Ed25519Scheme(ReceiptScheme):
+    name = SCHEME_ED25519
+
+    def signing_key(self):
+        return keys.load_private_key(self.require_key('RECEIPT_ED25519_SK', config.RECEIPT_ED25519_SK))
+
+    def verification_key(self):
+        # Nodes holding only the signing key verify against its public half
+        if not config.RECEIPT_ED25519_PK and config.RECEIPT_ED25519_SK:
+            return self.signing_key().public_key()
+        return keys.load_public_key(self.require_key('RECEIPT_ED25519_PK', config.RECEIPT_ED25519_PK))
+
+    def sign(self, key, data) -> str:
+        return base64.b64encode(keys.load_private_key(key).sign(_encode(data))).decode('utf-8')
+
+    def verify(self, key, data, sigma: str) -> bool:
+        try:
+            keys.load_public_key(key).verify(base64.b64decode(sigma.encode('utf-8')), _encode(data))
+            return True
+        except Exception:
+            return False
+
+class HmacSessionScheme(ReceiptScheme):
+    """
+    HMAC-SHA256 under a key shared by the nodes and their clients for a session.
+    Cheapest option, but receipts are not publicly verifiable nor non-repudiable.
+    """
+    name = SCHEME_HMAC_SESSION
+
+    def signing_key(self) -> bytes:
+        return base64.b64decode(self.require_key('RECEIPT_HMAC_KEY', config.RECEIPT_HMAC_KEY))
+
+    def verification_key(self) -> bytes:
+        return self.signing_key()
+
+    def sign(self, key, data) -> str:
+        return base64.b64encode(hmac.new(key, _encode(data), hashlib.sha256).digest()).decode('utf-8')
+
+    def verify(self, key, data, sigma: str) -> bool:
+        return hmac.compare_digest(self.sign(key, data), sigma)
+
+    def key_id(self, key) -> str:
+        return hashlib.sha256(key).hexdigest()
+
+SCHEMES = {
+    SCHEME_ECDSA_P256: EcdsaP256Scheme(),
+    SCHEME_ED25519: Ed25519Scheme(),
+    SCHEME_HMAC_SESSION: HmacSessionScheme(),
+}
+
+def get_scheme(name: str = None) -> ReceiptScheme:
+    name = name or config.RECEIPT_SCHEME
+    if name not in SCHEMES:
+        raise ValueError(f'Unknown receipt scheme {name}')
+    return SCHEMES[name]
+
+def sign(data, key=None) -> str:
+    """Signs with the configured scheme, by default under this node's receipt key"""
+    scheme = get_scheme()
+    return scheme.sign(key or scheme.signing_key(), data)
+
+def verify(data, sigma: str, key=None) -> bool:
+    """Verifies with the configured scheme, by default against the nodes' receipt key"""
+    scheme = get_scheme()
+    return scheme.verify(key or scheme.verification_key(), data, sigma)
+
+
+def batch_digest(hashes: List[str]) -> str:
+    """Digest over an ordered list of base64 request/response hashes covered by one batch receipt"""
+    return Utils.to_base64(Utils.hash256(bytes(''.join(hashes), 'utf-8')))
+
+def verify_receipt(public_key, hreq: str, hres: str, receipt: dict) -> bool:
+    """
+    Verifies a node's receipt `sig_r` over (hreq, hres) with the configured scheme. Responses
+    split out of a batch carry the batch's ordered hashes and their position; the signature
+    then covers the digests of the whole batch.
+    """
+    batch = receipt.get('batch')
+    if batch:
+        try:
+            pos = batch['pos']
+            if batch['hreqs'][pos] != hreq or batch['hress'][pos] != hres:
+                return False
+        except (KeyError, IndexError, TypeError):
+            return False
+        hreq, hres = batch_digest(batch['hreqs']), batch_digest(batch['hress'])
+    if 'merkle' in receipt:
+        return verify_merkle_receipt(public_key, hreq, hres, receipt)
+    return verify(data=hreq + hres, sigma=receipt['sig_r'], key=public_key)
+
+def get_merkle_leaf(hreq: str, hres: str) -> str:
+    return merkle.leaf_hash(hreq + hres)
+
+def get_merkle_signed_data(root: str) -> str:
+    return RECEIPT_MERKLE + ':' + root
+
+def verify_merkle_receipt(public_key, hreq: str, hres: str, receipt: dict) -> bool:
+    """
+    Verifies a receipt whose `sig_r` signs a Merkle root over many responses. The inclusion
+    path is checked on every call; the root signature only the first time it is seen.
+    """
+    try:
+        root, path = receipt['merkle']['root'], receipt['merkle']['path']
+        if merkle.root_from_path(get_merkle_leaf(hreq, hres), path) != root:
+            return False
+    except (KeyError, TypeError, ValueError):
+        return False
+    return verify_merkle_root(public_key, root, receipt['sig_r'])
+
+def verify_merkle_root(public_key, root: str, sig_r: str) -> bool:
+    scheme = get_scheme()
+    public_key = public_key or scheme.verification_key()
+    cache_key = (scheme.name, scheme.key_id(public_key), root, sig_r)
+    with verified_roots_lock:
+        if cache_key in verified_roots:
+            verified_roots.move_to_end(cache_key)
+            return True
+
+    if not scheme.verify(public_key, get_merkle_signed_data(root), sig_r):
+        return False
+
+    with verified_roots_lock:
+        verified_roots[cache_key] = True
+        while len(verified_roots) > config.RECEIPT_ROOT_CACHE_SIZE:
+            verified_roots.popitem(last=False)
+    return True
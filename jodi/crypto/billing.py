@@ -1,3 +1,5 @@
+import hashlib, threading, time
+from collections import OrderedDict, deque
 from pylibjodi import Voprf, Utils
 from jodi import config
 
@@ -16,4 +18,134 @@ def verify_token(vk: bytes, token: str):
     return Voprf.verify(vk, t_0, t_1)
 
 def get_billing_hash(token: str, peers: str):
-    return Utils.to_base64(Utils.hash256(bytes(token + peers, 'utf-8')))
\ No newline at end of file
+    return Utils.to_base64(Utils.hash256(bytes(token + peers, 'utf-8')))
+
+class TokenLedger:
+    """
+    Per-process record of billing tokens already checked, so repeat presentations of a token
+    skip `Voprf.verify`. Entries are keyed by a 16-byte digest of the token, spread over
+    independently locked shards, expire after `ttl` seconds and are evicted oldest-first
+    once a shard is full. Tokens presented more than `max_uses` times are rejected.
+    Invalid tokens are remembered too so that replaying them is cheap to refuse.
+    Metrics are kept per shard, under the shard's lock, and summed when read.
+    """
+    def __init__(self, capacity: int = None, ttl: int = None, max_uses: int = None, shards: int = 16):
+        self.ttl = ttl or config.BILLING_CACHE_TTL
+        self.max_uses = max_uses or config.BILLING_MAX_USES
+        self.shard_capacity = max((capacity or config.BILLING_CACHE_SIZE) // shards, 1)
+        self.shards = [OrderedDict() for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.metrics = [{'hits': 0, 'misses': 0, 'rejected': 0, 'evicted': 0} for _ in range(shards)]
+
+    @staticmethod
+    def get_token_key(token: str) -> bytes:
+        return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+    def _shard(self, key: bytes) -> int:
+        return key[0] % len(self.shards)
+
+    def check(self, token: str):
+        """Returns None if the token has not been verified yet, else whether it may be used again"""
+        key = TokenLedger.get_token_key(token)
+        i = self._shard(key)
+        with self.locks[i]:
+            entry = self.shards[i].get(key)
+            if entry is None or entry[0] < time.time():
+                self.metrics[i]['misses'] += 1
+                return None
+            self.metrics[i]['hits'] += 1
+            return self._use(i, entry)
+
+    def _use(self, i: int, entry: list) -> bool:
+        entry[2] += 1
+        if not entry[1] or entry[2] > self.max_uses:
+            self.metrics[i]['rejected'] += 1
+            return False
+        return True
+
+    def record(self, token: str, valid: bool) -> bool:
+        """
+        Records the outcome of a full verification as a use of the token. Presentations that
+        missed the ledger concurrently all verify; the first to get here inserts the entry and
+        the others count as further uses of it, so none of them resets the use count.
+        """
+        key = TokenLedger.get_token_key(token)
+        i = self._shard(key)
+        shard = self.shards[i]
+        with self.locks[i]:
+            entry = shard.get(key)
+            if entry is not None and entry[0] >= time.time():
+                return self._use(i, entry)
+            shard[key] = [time.time() + self.ttl, valid, 1]
+            shard.move_to_end(key)
+            while len(shard) > self.shard_capacity:
+                shard.popitem(last=False)
+                self.metrics[i]['evicted'] += 1
+        return valid
+
+    def stats(self) -> dict:
+        metrics = {name: 0 for name in self.metrics[0]}
+        for i, lock in enumerate(self.locks):
+            with lock:
+                for name, value in self.metrics[i].items():
+                    metrics[name] += value
+        return {
+            **metrics,
+            'size': sum(len(shard) for shard in self.shards),
+            'capacity': self.shard_capacity * len(self.shards),
+        }
+
+# Consulted by executor.verify_token, which runs only unseen tokens on the crypto pool
+ledger = TokenLedger()
+
+
+class TokenPool:
+    """
+    Endorsed billing tokens minted ahead of time by a background thread. The thread tops the
+    pool up to `high` whenever it drops below `low`; `get` pops a ready token in O(1) and
+    only mints inline when the pool has run dry.
+    """
+    def __init__(self, sk=None, low: int = None, high: int = None):
+        self.sk = sk or config.VOPRF_SK
+        self.high = max(high or config.TOKEN_POOL_HIGH, 1)
+        self.low = min(low or config.TOKEN_POOL_LOW, self.high)
+        self.tokens = deque()
+        self.refill = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.misses = 0
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.refill.set()
+            self.thread = threading.Thread(target=self._run, name='token-pool', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.refill.set()
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.refill.wait()
+            self.refill.clear()
+            while len(self.tokens) < self.high and not self.stopped.is_set():
+                self.tokens.append(create_endorsed_token(self.sk))
+
+    def get(self) -> str:
+        try:
+            token = self.tokens.popleft()
+        except IndexError:
+            self.misses += 1
+            token = create_endorsed_token(self.sk)
+        if len(self.tokens) < self.low:
+            self.refill.set()
+        return token
+
+    def stats(self) -> dict:
+        return {'size': len(self.tokens), 'low': self.low, 'high': self.high, 'misses': self.misses}
@@ -0,0 +1,140 @@
+import asyncio, os
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+
+from jodi import config
+from jodi.crypto import billing, groupsig, oprf, audit_logging, merkle, sessions
+from jodi.helpers.coalesce import MicroBatcher
+from jodi.helpers import deadline
+
+POOL_THREAD = 'thread'
+POOL_PROCESS = 'process'
+
+class CryptoPoolBusy(Exception):
+    """Raised instead of queueing when the crypto pool already holds CRYPTO_QUEUE_DEPTH jobs"""
+    pass
+
+pool: Executor = None
+in_flight = 0
+
+receipt_batcher: MicroBatcher = None
+
+def create_pool(kind: str = None, size: int = None) -> Executor:
+    kind = kind or config.CRYPTO_POOL
+    size = size or config.CRYPTO_POOL_SIZE or os.cpu_count()
+    if kind == POOL_PROCESS:
+        return ProcessPoolExecutor(max_workers=size)
+    return ThreadPoolExecutor(max_workers=size, thread_name_prefix='crypto')
+
+def set_pool(executor: Executor):
+    global pool
+    pool = executor
+
+def get_pool() -> Executor:
+    if pool is None:
+        set_pool(create_pool())
+    return pool
+
+def shutdown():
+    global pool
+    if pool:
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = None
+
+def _run_before(expires_at: float, fn, *args):
+    # Checked again once a worker picks the job up, so jobs that went stale in the queue are dropped
+    deadline.check(expires_at)
+    return fn(*args)
+
+async def run(fn, *args):
+    """
+    Runs a blocking function on the crypto pool, shedding load once the queue is full
+    and dropping jobs whose request deadline has passed before they start
+    """
+    global in_flight
+    current = deadline.current.get()
+    expires_at = current.expires_at if current else None
+    deadline.check(expires_at)
+    if in_flight >= config.CRYPTO_QUEUE_DEPTH:
+        raise CryptoPoolBusy(f'Crypto queue is full ({in_flight} jobs)')
+    in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_pool(), _run_before, expires_at, fn, *args)
+    finally:
+        in_flight -= 1
+
+def _verify_group_signature(sig: str, msg: str) -> bool:
+    return groupsig.get_context().verify(sig=sig, msg=msg)
+
+def _verify_group_signatures(pairs: list) -> list:
+    return groupsig.get_context().verify_many(pairs)
+
+async def verify_token(vk, token: str) -> bool:
+    """Checks the node's token ledger first; only unseen tokens reach the pool"""
+    cached = billing.ledger.check(token)
+    if cached is not None:
+        return cached
+    return billing.ledger.record(token, await run(billing.verify_token, vk, token))
+
+async def verify_group_signature(sig: str, msg: str) -> bool:
+    return await run(_verify_group_signature, sig, msg)
+
+async def verify_request(msg: str, sig: str = None, ticket: str = None, mac: str = None) -> bool:
+    """Session requests are checked inline with one HMAC; the others verify their group signature on the pool"""
+    if ticket is not None:
+        return sessions.verify_mac(ticket, mac, msg)
+    return sig is not None and await verify_group_signature(sig=sig, msg=msg)
+
+async def open_session(share: str, nonce: str, sig: str) -> dict:
+    """Verifies a session hello and issues a ticket, signed with the node's receipt key, or returns None"""
+    if not await verify_group_signature(sig=sig, msg=sessions.get_hello_message(share, nonce)):
+        return None
+    issued = sessions.issue(share)
+    data = sessions.get_issued_data(share, nonce, issued['node_share'], issued['ticket'], issued['expires'])
+    return {**issued, 'sig_r': await sign(data)}
+
+async def verify_group_signatures(pairs: list) -> list:
+    """Verifies (sig, msg) pairs in one job so the batch shares its setup"""
+    return await run(_verify_group_signatures, pairs)
+
+async def evaluate(keypairs: list, x: str) -> list:
+    return await run(oprf.evaluate, keypairs, x)
+
+async def sign(data) -> str:
+    """Signs with the node's receipt key under RECEIPT_SCHEME. Keys are loaded inside the worker so jobs stay picklable."""
+    return await run(audit_logging.sign, data)
+
+async def verify(data, sigma: str) -> bool:
+    """Verifies against the nodes' receipt key under RECEIPT_SCHEME"""
+    return await run(audit_logging.verify, data, sigma)
+
+async def _flush_receipts(key: str, leaves: list) -> list:
+    # The shared root serves every request of the window, not just the one whose deadline this task inherited
+    deadline.current.set(None)
+    root, paths = merkle.build(leaves)
+    sig_r = await sign(audit_logging.get_merkle_signed_data(root))
+    return [{'sig_r': sig_r, 'merkle': {'root': root, 'path': path}} for path in paths]
+
+def get_receipt_batcher() -> MicroBatcher:
+    global receipt_batcher
+    if receipt_batcher is None:
+        receipt_batcher = MicroBatcher(
+            flush=_flush_receipts,
+            window_ms=config.RECEIPT_WINDOW_MS,
+            max_size=config.RECEIPT_BATCH_MAX
+        )
+    return receipt_batcher
+
+async def close_receipt_batcher():
+    """Signs the receipts still waiting for a root before the pool goes away"""
+    if receipt_batcher is not None:
+        await receipt_batcher.close()
+
+async def sign_receipt(hreq: str, hres: str) -> dict:
+    """
+    Returns the receipt fields for a response over (hreq, hres). In merkle mode responses
+    arriving within RECEIPT_WINDOW_MS share one signed root and each gets its inclusion path.
+    """
+    if config.RECEIPT_MODE == audit_logging.RECEIPT_MERKLE:
+        leaf = audit_logging.get_merkle_leaf(hreq, hres)
+        return await get_receipt_batcher().submit(audit_logging.RECEIPT_MERKLE, leaf)
+    return {'sig_r': await sign(hreq + hres)}
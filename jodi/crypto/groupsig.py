@@ -1,9 +1,12 @@
 from pygroupsig import groupsig, constants, signature, memkey, grpkey, mgrkey, gml as GML
 from jodi import config
-import time
+from typing import List, Tuple
 
 SCHEME = constants.BBS04_CODE
 
+initialized = False
+context = None
+
 def setup():
     bbs04 = groupsig.setup(SCHEME)
     gsk = mgr_generate_member_keys(bbs04['mgrkey'], bbs04['grpkey'], bbs04['gml'])
@@ -37,26 +40,75 @@ def mgr_generate_member_keys(msk, gpk, gml):
     
     return memkey.memkey_export(usk)
         
+def ensure_init():
+    """The scheme only has to be initialized once per process"""
+    global initialized
+    if not initialized:
+        groupsig.init(SCHEME, 0)
+        initialized = True
+
+class GroupSigContext:
+    """
+    Long-lived group signature state: initializes the scheme once and keeps the
+    imported group public key and (optionally) member key for the life of the process.
+    Keys may be given as exported strings or as already imported objects.
+    """
+    def __init__(self, gpk = None, gsk = None):
+        ensure_init()
+        gpk = gpk if gpk else config.TGS_GPK
+        if not gpk:
+            raise Exception('GPK not set')
+        self.gpk = grpkey.grpkey_import(SCHEME, gpk) if type(gpk) == str else gpk
+        
+        gsk = gsk if gsk else config.TGS_GSK
+        self.gsk = memkey.memkey_import(SCHEME, gsk) if type(gsk) == str and gsk else (gsk or None)
+
+    def sign(self, msg: str) -> str:
+        if self.gsk is None:
+            raise Exception('GSK not set')
+        return signature.signature_export(groupsig.sign(msg, self.gsk, self.gpk))
+
+    def verify(self, sig: str, msg: str) -> bool:
+        try:
+            sig = signature.signature_import(SCHEME, sig) if type(sig) == str else sig
+            return groupsig.verify(sig, msg, self.gpk)
+        except Exception:
+            return False
+
+    def verify_many(self, pairs: List[Tuple[str, str]]) -> List[bool]:
+        """
+        Verifies (sig, msg) pairs in one call so a batch shares the imported keys and one
+        executor job. pygroupsig has no batch verification; each pair is checked on its own.
+        """
+        return [self.verify(sig, msg) for (sig, msg) in pairs]
+
+def get_context() -> GroupSigContext:
+    """Process-wide context built from the configured keys"""
+    global context
+    if context is None:
+        context = GroupSigContext()
+    return context
+        
 def get_gpk(gpk: str = None):
-    groupsig.init(SCHEME, 0)
-    gpk = gpk if gpk else config.TGS_GPK
-    if not gpk:
-        raise Exception('GPK not set')
-    return grpkey.grpkey_import(SCHEME, config.TGS_GPK)
+    if gpk:
+        ensure_init()
+        return grpkey.grpkey_import(SCHEME, gpk)
+    return get_context().gpk
 
 def get_gsk(gsk: str = None):
-    groupsig.init(SCHEME, 0)
-    gsk = gsk if gsk else config.TGS_GSK
-    if not gsk:
+    if gsk:
+        ensure_init()
+        return memkey.memkey_import(SCHEME, gsk)
+    if not get_context().gsk:
         raise Exception('GSK not set')
-    return memkey.memkey_import(SCHEME, config.TGS_GSK)
+    return get_context().gsk
     
 def sign(msg: str, gsk, gpk) -> str:
-    groupsig.init(SCHEME)
+    ensure_init()
     sigma = groupsig.sign(msg, gsk, gpk)
     return signature.signature_export(sigma)
 
 def verify(sig: str, msg: str, gpk) -> bool:
-    groupsig.init(SCHEME)
+    ensure_init()
     sig = signature.signature_import(SCHEME, sig) if type(sig) == str else sig
     return groupsig.verify(sig, msg, gpk)
\ No newline at end of file
@@ -0,0 +1,84 @@
+import hashlib, threading
+from collections import OrderedDict
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from jodi import config
+
+class KeyRegistry:
+    """
+    Bounded LRU of parsed `cryptography` key objects, keyed by the SHA-256 fingerprint
+    of the PEM they were loaded from, so each key or certificate is parsed once.
+    """
+    def __init__(self, capacity: int = None):
+        self.capacity = capacity or config.KEY_REGISTRY_SIZE
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(kind: str, pem: str) -> str:
+        return kind + ':' + hashlib.sha256(pem.strip().encode('utf-8')).hexdigest()
+
+    def get(self, kind: str, pem: str, loader):
+        fp = KeyRegistry.fingerprint(kind, pem)
+        with self.lock:
+            key = self.entries.get(fp)
+            if key is not None:
+                self.entries.move_to_end(fp)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        key = loader(pem)
+
+        with self.lock:
+            self.entries[fp] = key
+            self.entries.move_to_end(fp)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return key
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses}
+
+registry = KeyRegistry()
+
+def _load_private_key(pem: str):
+    return serialization.load_pem_private_key(pem.encode('utf-8'), password=None)
+
+def _load_public_key(pem: str):
+    return serialization.load_pem_public_key(pem.encode('utf-8'))
+
+def _load_public_key_from_cert(pem: str):
+    return x509.load_pem_x509_certificate(pem.encode('utf-8')).public_key()
+
+def load_private_key(key):
+    """Returns a private key object, parsing PEM strings at most once"""
+    if isinstance(key, str):
+        return registry.get('sk', key, _load_private_key)
+    return key
+
+def load_public_key(key):
+    """Returns a public key object, parsing PEM strings at most once"""
+    if isinstance(key, str):
+        return registry.get('pk', key, _load_public_key)
+    return key
+
+def key_id(public_key) -> str:
+    """Fingerprint of a public key object, usable as a cache key"""
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der).hexdigest()
+
+def derive_secret(material: str, label: str, length: int = 32) -> bytes:
+    """Derives `length` bytes bound to `label` from secret key material (HKDF-SHA256)"""
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=label.encode('utf-8')).derive(material.encode('utf-8'))
+
+def load_public_key_from_cert(cert: str):
+    """Returns the public key object of a PEM certificate, parsing each certificate at most once"""
+    return registry.get('cert', cert, _load_public_key_from_cert)
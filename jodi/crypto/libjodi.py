@@ -1,11 +1,13 @@
 from pylibjodi import Voprf, Utils, Ciphering
 import jodi.config as config
-from jodi.crypto import groupsig, billing, audit_logging
-from jodi.helpers import dht, misc
+from jodi.crypto import groupsig, billing, audit_logging, oprf
+from jodi.helpers import dht, codec, http
+from jodi.helpers.deadline import Deadline
 from typing import List
-import re, time, traceback
+import re, time, traceback, asyncio
+from collections import OrderedDict
 from datetime import datetime
-from itertools import product
+from itertools import product, combinations
 
 def get_peers(nodes):
     return ".".join([node.get('id') for node in nodes])
@@ -24,13 +26,18 @@ def get_index_from_call_details(call_details: str) -> int:
     digest: bytes = Utils.hash160(call_details.encode('utf-8'))
     return int(digest.hex(), 16) % config.KEYLIST_SIZE
 
-def create_evaluation_requests(call_details: str, n_ev: int, gsk, gpk, bt) -> bytes:
+def get_evaluation_hash(x: str, i_k: int, bt: str, peers: str, req_type: str = oprf.REQ_RETRIEVE, pinned: bool = False) -> str:
+    # req_type and pinned pick the keys and the response form, so the signature must cover them
+    return Utils.to_base64(Utils.hash256(bytes(x + str(i_k) + bt + peers + ':' + req_type + ':' + str(int(pinned)), 'utf-8')))
+
+def create_evaluation_requests(call_details: str, n_ev: int, gsc: groupsig.GroupSigContext, bt, sign: bool = True, evaluators: List[dict] = None, req_type: str = oprf.REQ_RETRIEVE, pinned: bool = False) -> bytes:
     i_k: int = get_index_from_call_details(call_details)
 
     calldt_hash = Utils.hash256(bytes(call_details, 'utf-8'))
     evaluators = dht.get_evals(
         keys=calldt_hash, 
         count=n_ev,
+        nodes=evaluators,
     )
 
     # Blind and sign the call details
@@ -38,9 +45,14 @@ def create_evaluation_requests(call_details: str, n_ev: int, gsk, gpk, bt) -> by
     x_str = Utils.to_base64(x)
     peers = get_peers(evaluators)
 
-    hreq = Utils.to_base64(Utils.hash256(bytes(x_str + str(i_k) + bt + peers, 'utf-8')))
+    hreq = get_evaluation_hash(x_str, i_k, bt, peers, req_type, pinned)
 
-    sig = groupsig.sign(msg=hreq, gsk=gsk, gpk=gpk)
+    # Batched requests are signed once per batch when they are flushed
+    data = { 'i_k': i_k, 'x': x_str, 'bt': bt, 'peers': peers, 'req_type': req_type }
+    if pinned:
+        data['pinned'] = True
+    if sign:
+        data['sig'] = gsc.sign(msg=hreq)
     
     # Create evaluation requests
     requests = []
@@ -49,25 +61,76 @@ def create_evaluation_requests(call_details: str, n_ev: int, gsk, gpk, bt) -> by
             'nodeId': ev.get('id'),
             'avail': ev.get('avail', None),
             'url': ev.get('url') + '/evaluate', 
-            'data': { 'i_k': i_k, 'x': x_str, 'sig': sig, 'bt': bt, 'peers': peers}
+            'data': data,
+            'msg': hreq
         })
     
     return requests, mask, hreq
 
+def get_evaluator_url(req: dict) -> str:
+    """Base url of the evaluator an evaluation request is sent to"""
+    return req['url'].rsplit('/', 1)[0]
+
+def create_evaluation_batch(requests: List[dict], gsc: groupsig.GroupSigContext):
+    """Merges unsigned evaluation requests bound for one evaluator into a single signed envelope"""
+    items, hreqs = [], []
+    for req in requests:
+        data = req['data']
+        items.append({
+            'i_k': data['i_k'], 'x': data['x'], 'bt': data['bt'], 'peers': data['peers'], 
+            'req_type': data['req_type'], 'pinned': data.get('pinned', False)
+        })
+        hreqs.append(get_evaluation_hash(data['x'], data['i_k'], data['bt'], data['peers'], data['req_type'], data.get('pinned', False)))
+
+    sig = gsc.sign(msg=audit_logging.batch_digest(hreqs))
+    return {'items': items, 'sig': sig}, hreqs
+
+def split_evaluation_batch(response: dict, hreqs: List[str]) -> List[dict]:
+    """Splits a batch evaluation response into one response per request, each carrying the batch receipt"""
+    if '_error' in response:
+        return [response] * len(hreqs)
+
+    evals = response.get('evals') or []
+    if len(evals) != len(hreqs):
+        return [{'_error': 'Malformed batch response'}] * len(hreqs)
+
+    hress = [Utils.to_base64(Utils.hash256(codec.canonical(e))) for e in evals]
+    return attach_batch_receipt([{'evals': e} for e in evals], get_receipt(response), hreqs, hress)
+
+def get_receipt(response: dict) -> dict:
+    """Receipt fields of a node response: `sig_r`, plus the inclusion proof when it signs a Merkle root"""
+    return {k: response[k] for k in ('sig_r', 'merkle') if k in response}
+
+def attach_batch_receipt(items: List[dict], receipt: dict, hreqs: List[str], hress: List[str]) -> List[dict]:
+    return [
+        {**item, **receipt, 'batch': {'hreqs': hreqs, 'hress': hress, 'pos': i}}
+        for i, item in enumerate(items)
+    ]
+
+def get_vk(evaluation: dict) -> bytes:
+    vk = evaluation['vk']
+    return vk if isinstance(vk, bytes) else Utils.from_base64(vk)
+
 def create_call_ids(responses: List[dict], mask: bytes, req_type: str, call_details: str) -> bytes:
+    # Evaluators on the epoch schedule rotate in lockstep, so only same-generation combinations can match
+    if req_type == 'retrieve' and responses and all('age' in ev for res in responses for ev in res):
+        call_ids = create_call_ids_by_generation(responses, mask, call_details)
+        if call_ids:
+            return call_ids
+    
     cidsets, xor, edge_case, X = [], bytes(0), False, None
     
     for res in responses:
         cid_1 = Voprf.unblind(Utils.from_base64(res[0]['fx']), mask)
         
-        if Voprf.verify(Utils.from_base64(res[0]['vk']), call_details, cid_1):
+        if Voprf.verify(get_vk(res[0]), call_details, cid_1):
             xor = Utils.xor(xor, cid_1)
             X = [cid_1]
             
         if req_type == 'retrieve' and len(res) == 2:
             cid_2 = Voprf.unblind(Utils.from_base64(res[1]['fx']), mask)
             
-            if Voprf.verify(Utils.from_base64(res[1]['vk']), call_details, cid_2):
+            if Voprf.verify(get_vk(res[1]), call_details, cid_2):
                 X = [cid_1, cid_2]
                 edge_case = True
                 
@@ -96,7 +159,42 @@ def create_call_ids(responses: List[dict], mask: bytes, req_type: str, call_deta
         
     return [Utils.hash256(answer) for answer in answers]
 
-def create_storage_requests(call_id: bytes, msg: str, n_ms: int, gsk, gpk, bt, stores = None) -> List[dict]:
+def create_threshold_call_ids(responses: List[list], mask: bytes, req_type: str, call_details: str, threshold: int) -> List[bytes]:
+    """
+    Call IDs of every `threshold`-subset of the evaluator responses, in subset order. A publisher
+    stores its record under all of them, so a retriever holding the responses of any `threshold`
+    of the same evaluators derives one of them.
+    """
+    call_ids = []
+    for subset in combinations(responses, threshold):
+        for call_id in create_call_ids(list(subset), mask, req_type, call_details):
+            if call_id not in call_ids:
+                call_ids.append(call_id)
+    return call_ids
+
+def create_call_ids_by_generation(responses: List[list], mask: bytes, call_details: str) -> List[bytes]:
+    """
+    One candidate call ID per key generation answered by every evaluator, most likely first:
+    the current generation, unless it became current less than PUBLISH_RETRIEVE_GAP_SECONDS
+    ago, in which case the call was most likely published under the previous one.
+    """
+    by_gen = {}
+    for res in responses:
+        for ev in res:
+            cid = Voprf.unblind(Utils.from_base64(ev['fx']), mask)
+            if not Voprf.verify(get_vk(ev), call_details, cid):
+                continue
+            entry = by_gen.setdefault(ev['gen'], {'xor': bytes(0), 'count': 0, 'age': ev['age']})
+            entry['xor'] = Utils.xor(entry['xor'], cid)
+            entry['count'] += 1
+    
+    candidates = sorted([gen for gen, e in by_gen.items() if e['count'] == len(responses)], reverse=True)
+    if len(candidates) > 1 and by_gen[candidates[0]]['age'] < config.PUBLISH_RETRIEVE_GAP_SECONDS:
+        candidates = candidates[1:] + candidates[:1]
+    
+    return [Utils.hash256(by_gen[gen]['xor']) for gen in candidates]
+
+def create_storage_requests(call_id: bytes, msg: str, n_ms: int, gsc: groupsig.GroupSigContext, bt, stores = None) -> List[dict]:
     stores = dht.get_stores(keys=call_id, count=n_ms, nodes=stores)
 
     # Generate the index, encrypt msg and sign request
@@ -106,7 +204,7 @@ def create_storage_requests(call_id: bytes, msg: str, n_ms: int, gsk, gpk, bt, s
 
     pp = Utils.to_base64(Utils.hash256(bytes(idx + ctx, 'utf-8')))
     bb = billing.get_billing_hash(bt, peers)
-    sig = groupsig.sign(msg=pp + bb, gsk=gsk, gpk=gpk)
+    sig = gsc.sign(msg=pp + bb)
     
     # Create storage requests for closest n_ms stores
     requests = []
@@ -115,14 +213,32 @@ def create_storage_requests(call_id: bytes, msg: str, n_ms: int, gsk, gpk, bt, s
             'nodeId': store['id'],
             'avail': store.get('avail', None),
             'url': store['url'] + '/publish',
-            'data': {'idx': idx, 'ctx': ctx, 'sig': sig, 'bt': bt, 'peers': peers}
+            'data': {'idx': idx, 'ctx': ctx, 'sig': sig, 'bt': bt, 'peers': peers},
+            'msg': pp + bb
         })
 
     return requests
 
-def create_retrieve_requests(call_ids: List[bytes], n_ms: int, gsk, gpk, bt) -> List[dict]:
+def create_publish_batch(requests: List[dict]) -> dict:
+    """Merges storage requests bound for one store. Records keep their own signatures."""
+    return {'items': [req['data'] for req in requests]}
+
+def split_publish_batch(response: dict, requests: List[dict]) -> List[dict]:
+    if '_error' in response:
+        return [response] * len(requests)
+    
+    hreqs = []
+    for req in requests:
+        data = req['data']
+        pp = Utils.to_base64(Utils.hash256(bytes(data['idx'] + data['ctx'], 'utf-8')))
+        hreqs.append(pp + billing.get_billing_hash(data['bt'], data['peers']))
+        
+    items = [{'message': response.get('message')}] * len(requests)
+    return attach_batch_receipt(items, get_receipt(response), hreqs, ['ok'] * len(requests))
+
+def create_retrieve_requests(call_ids: List[bytes], n_ms: int, gsc: groupsig.GroupSigContext, bt, sign: bool = True, stores: List[dict] = None) -> List[dict]:
     requests = []
-    stores_per_cid = dht.get_stores(keys=call_ids, count=n_ms)
+    stores_per_cid = dht.get_stores(keys=call_ids, count=n_ms, nodes=stores)
 
     assert len(call_ids) == len(stores_per_cid)
 
@@ -133,55 +249,193 @@ def create_retrieve_requests(call_ids: List[bytes], n_ms: int, gsk, gpk, bt) ->
         pp = Utils.to_base64(Utils.hash256(bytes(idx, 'utf-8')))
         bb = billing.get_billing_hash(bt, peers)
 
-        sig = groupsig.sign(msg=pp + bb, gsk=gsk, gpk=gpk)
+        # Batched requests are signed once per batch when they are flushed
+        data = { 'idx': idx, 'bt': bt, 'peers': peers }
+        if sign:
+            data['sig'] = gsc.sign(msg=pp + bb)
 
         for store in stores:
             requests.append({
                 'nodeId': store['id'],
                 'avail': store.get('avail', None),
                 'url': store['url'] + '/retrieve',
-                'data': { 'idx': idx, 'sig': sig, 'bt': bt, 'peers': peers }
+                'data': data,
+                'msg': pp + bb
             })
 
     return requests
 
+def create_retrieve_batch(requests: List[dict], gsc: groupsig.GroupSigContext):
+    """Merges unsigned retrieve requests bound for one store into a single signed envelope"""
+    items, signed, hreqs = [], [], []
+    for req in requests:
+        data = req['data']
+        pp = Utils.to_base64(Utils.hash256(bytes(data['idx'], 'utf-8')))
+        items.append({'idx': data['idx'], 'bt': data['bt'], 'peers': data['peers']})
+        signed.append(pp + billing.get_billing_hash(data['bt'], data['peers']))
+        hreqs.append(pp)
+
+    sig = gsc.sign(msg=audit_logging.batch_digest(signed))
+    return {'items': items, 'sig': sig}, hreqs
+
+def split_retrieve_batch(response: dict, hreqs: List[str]) -> List[dict]:
+    """Splits a batch retrieve response into one response per request; misses become 404 errors"""
+    if '_error' in response:
+        return [response] * len(hreqs)
+    
+    results = response.get('results') or []
+    if len(results) != len(hreqs):
+        return [{'_error': 'Malformed batch response'}] * len(hreqs)
+
+    hress = [Utils.to_base64(Utils.hash256(codec.canonical(res))) for res in results]
+    split = attach_batch_receipt([{'res': res} for res in results], get_receipt(response), hreqs, hress)
+    return [
+        item if 'idx' in item['res'] else {'_error': item['res'].get('message', 'Not Found'), '_status': 404}
+        for item in split
+    ]
+
 def encrypt_and_mac(call_id: bytes, plaintext: str) -> str:
     c_0 = Utils.random_bytes(32)
     kenc = Utils.hash256(Utils.xor(c_0, call_id))
     c_1 = Ciphering.enc(kenc, plaintext.encode('utf-8'))
     return Utils.to_base64(c_0) + ':' + Utils.to_base64(c_1)
 
-def decrypt(call_ids: List[bytes], responses: List[dict], gpk, ipk):
+def get_call_id_map(call_ids: List[bytes]) -> dict:
+    return { Utils.to_base64(Utils.hash256(cid)): cid for cid in call_ids }
+
+def decrypt_response(call_id_map: dict, res_entry: dict, gsc: groupsig.GroupSigContext, ipk) -> str:
+    """Verifies one store response (receipt, publisher's group signature) and decrypts it, or returns None"""
+    if '_error' in res_entry or 'sig_r' not in res_entry:
+        return None
+    
+    res = res_entry['res']
+    
+    hreq = billing.Utils.to_base64(billing.Utils.hash256(bytes(res['idx'], 'utf-8')))
+    hres = billing.Utils.to_base64(billing.Utils.hash256(codec.canonical(res)))
+    
+    if not audit_logging.verify_receipt(public_key=ipk, hreq=hreq, hres=hres, receipt=res_entry):
+        return None
+    
+    pp = Utils.to_base64(Utils.hash256(bytes(res['idx'] + res['ctx'], 'utf-8')))
+    if '_error' in res or not gsc.verify(sig=res['sig'], msg=pp + res['bb']):
+        return None
+    
+    try:
+        c_0, c_1 = res['ctx'].split(':')
+        kenc = Utils.hash256(Utils.xor(Utils.from_base64(c_0), call_id_map[res['idx']]))
+        msg: bytes = Ciphering.dec(kenc, Utils.from_base64(c_1))
+        
+        if msg:
+            return msg.decode('utf-8')
+    except:
+        traceback.print_exc()
+        pass
+    
+    return None
+
+def decrypt(call_ids: List[bytes], responses: List[dict], gsc: groupsig.GroupSigContext, ipk):
     if not (call_ids and responses):
         return None
     
-    call_ids = { Utils.to_base64(Utils.hash256(cid)): cid for cid in call_ids }
+    call_id_map = get_call_id_map(call_ids)
     
     for res_entry in responses:
-        if '_error' in res_entry or 'sig_r' not in res_entry:
-            continue
-        
-        res = res_entry['res']
-        
-        hreq = billing.Utils.to_base64(billing.Utils.hash256(bytes(res['idx'], 'utf-8')))
-        hres = billing.Utils.to_base64(billing.Utils.hash256(bytes(misc.stringify(res), 'utf-8')))
+        msg = decrypt_response(call_id_map, res_entry, gsc, ipk)
+        if msg:
+            return msg
         
-        if not audit_logging.ecdsa_verify(public_key=ipk, data=hreq+hres, sigma=res_entry['sig_r']):
-            continue
-        
-        pp = Utils.to_base64(Utils.hash256(bytes(res['idx'] + res['ctx'], 'utf-8')))
-        if '_error' in res or not groupsig.verify(sig=res['sig'], msg=pp + res['bb'], gpk=gpk):
-            continue
+    return None
+
+class CallIdCache:
+    """
+    Proxy-side cache of call IDs keyed on (call details, request type). An entry lives until
+    the live keys of its index change under the epoch KeySchedule, i.e. the next rotation of
+    that index or the close of the previous key's liveness window, whichever comes first.
+    Only meaningful with KEY_SCHEDULE=epoch, since legacy rotations are not clock-aligned.
+    """
+    def __init__(self, capacity: int = None):
+        self.capacity = capacity or config.CALL_ID_CACHE_SIZE
+        self.entries = OrderedDict()
+        self.metrics = {'hits': 0, 'misses': 0, 'expired': 0}
+
+    def get(self, call_details: str, req_type: str) -> List[bytes]:
+        key = (call_details, req_type)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.metrics['misses'] += 1
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            self.metrics['expired'] += 1
+            self.metrics['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.metrics['hits'] += 1
+        return entry[1]
+
+    def put(self, call_details: str, req_type: str, call_ids: List[bytes]):
+        i_k = get_index_from_call_details(call_details)
+        self.entries[(call_details, req_type)] = (oprf.KeySchedule.next_change(i_k), call_ids)
+        self.entries.move_to_end((call_details, req_type))
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {**self.metrics, 'size': len(self.entries), 'capacity': self.capacity}
+
+
+class KeyDirectory:
+    """
+    Evaluator verification keys pinned by the proxy for the current epoch. Each evaluator's
+    signed directory (GET /keys) is fetched once per epoch; evaluations made against pinned
+    keys only carry `fx`, the generation and a key id, and get their parsed `vk` from here.
+    Keys are indexed by (evaluator url, kid), so an evaluation only resolves to a key that
+    its own evaluator published.
+    """
+    def __init__(self):
+        self.epochs = {}
+        self.keys = {}
+        self.refreshing: asyncio.Future = None
+
+    def is_pinned(self, evaluators: List[dict]) -> bool:
+        epoch = oprf.KeySchedule.epoch()
+        return bool(evaluators) and all(self.epochs.get(ev['url']) == epoch for ev in evaluators)
+
+    def schedule_refresh(self, evaluators: List[dict], phase: Deadline = None):
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.ensure_future(self.refresh(evaluators, phase))
+
+    async def refresh(self, evaluators: List[dict], phase: Deadline = None):
+        """Fetches stale directories; each fetch is bounded by HTTP_TIMEOUT_SECONDS and what is left of `phase`"""
+        if phase and phase.expired():
+            return
+        epoch = oprf.KeySchedule.epoch()
+        stale = [ev for ev in evaluators if self.epochs.get(ev['url']) != epoch]
+        directories = await asyncio.gather(*[http.get(url=ev['url'] + '/keys', phase=phase) for ev in stale])
         
-        try:
-            c_0, c_1 = res['ctx'].split(':')
-            kenc = Utils.hash256(Utils.xor(Utils.from_base64(c_0), call_ids[res['idx']]))
-            msg: bytes = Ciphering.dec(kenc, Utils.from_base64(c_1))
-            
-            if msg:
-                return msg.decode('utf-8')
-        except:
-            traceback.print_exc()
-            pass
+        for ev, directory in zip(stale, directories):
+            if '_error' in directory or directory.get('epoch') != epoch:
+                continue
+            body = {k: v for k, v in directory.items() if k != 'sig'}
+            if not audit_logging.verify(data=body, sigma=directory.get('sig', '')):
+                continue
+            for key in directory['keys']:
+                vk = Utils.from_base64(key['vk'])
+                self.keys[(ev['url'], oprf.get_key_id(vk))] = {'vk': vk, 'i': key['i'], 'gen': key['gen'], 'epoch': epoch}
+            self.epochs[ev['url']] = epoch
         
-    return None
\ No newline at end of file
+        # Keys are kept one epoch longer for calls still in flight across the boundary
+        self.keys = {ref: key for ref, key in self.keys.items() if key['epoch'] >= epoch - 1}
+
+    def expand(self, url: str, evals: List[dict], i_k: int) -> List[dict]:
+        """Restores `vk` and `age` of compact evaluations from the evaluator at `url`, or returns None if a key is not pinned"""
+        expanded, now = [], time.time()
+        for ev in evals:
+            key = self.keys.get((url, ev.get('kid')))
+            if not key or key['i'] != i_k or key['gen'] != ev.get('gen'):
+                return None
+            expanded.append({
+                'fx': ev['fx'], 'vk': key['vk'], 'gen': key['gen'], 
+                'age': now - oprf.KeySchedule.rotated_at(i_k, key['gen'])
+            })
+        return expanded
@@ -0,0 +1,56 @@
+import hashlib
+from typing import List, Tuple
+
+# Leaves and inner nodes are hashed under different prefixes so a leaf can never pose as a subtree
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+LEFT = 'L'
+RIGHT = 'R'
+
+def leaf_hash(data: str) -> str:
+    return hashlib.sha256(LEAF_PREFIX + data.encode('utf-8')).hexdigest()
+
+def node_hash(left: str, right: str) -> str:
+    return hashlib.sha256(NODE_PREFIX + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+def build(leaves: List[str]) -> Tuple[str, List[list]]:
+    """
+    Builds a Merkle tree over already hashed leaves and returns its root together with
+    one inclusion path per leaf. A path is a list of [side, sibling] pairs from the leaf
+    upwards; an odd node at the end of a level is promoted without a sibling.
+    """
+    if not leaves:
+        raise ValueError('Cannot build a Merkle tree without leaves')
+
+    paths = [[] for _ in leaves]
+    positions = list(range(len(leaves)))
+    level = list(leaves)
+
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            parents.append(node_hash(level[i], level[i + 1]))
+        if len(level) % 2:
+            parents.append(level[-1])
+
+        for leaf, pos in enumerate(positions):
+            sibling = pos ^ 1
+            if sibling < len(level):
+                side = RIGHT if pos % 2 == 0 else LEFT
+                paths[leaf].append([side, level[sibling]])
+            positions[leaf] = pos // 2
+        level = parents
+
+    return level[0], paths
+
+def root_from_path(leaf: str, path: List[list]) -> str:
+    node = leaf
+    for (side, sibling) in path:
+        if side == RIGHT:
+            node = node_hash(node, sibling)
+        elif side == LEFT:
+            node = node_hash(sibling, node)
+        else:
+            raise ValueError(f'Invalid Merkle path side {side}')
+    return node
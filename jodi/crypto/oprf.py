@@ -1,11 +1,20 @@
 from pylibjodi import Voprf, Utils
 from jodi import config
 from jodi.models import cache
-import time
-from typing import Tuple
+import time, math, hashlib
+from typing import Tuple, List, Dict
 from jodi.crypto import audit_logging
 
 EXP_PREFIX = 'rexp'
+KEY_SCHEDULE_ROTATION = 'rotation'
+KEY_SCHEDULE_EPOCH = 'epoch'
+
+REQ_PUBLISH = 'publish'
+REQ_RETRIEVE = 'retrieve'
+
+# Generations reported by the legacy rotation, which only knows the current and the expired key
+GEN_CURRENT = 0
+GEN_EXPIRED = -1
 
 def evaluate(keypairs: list, x: str) -> dict:
     evaluations = []
@@ -13,23 +22,77 @@ def evaluate(keypairs: list, x: str) -> dict:
         fx = Voprf.evaluate(sk, Utils.from_base64(x))
         evaluations.append({ "fx": Utils.to_base64(fx), "vk": Utils.to_base64(vk) })
     return evaluations
+
+def select_keys(live: list, req_type: str) -> list:
+    """Publishing only ever uses the current key, so the expired one is evaluated for retrievals only"""
+    return live[:1] if req_type == REQ_PUBLISH else live
+
+def attach_key_meta(evaluations: list, live: list, pinned: bool = False) -> list:
+    """
+    Tags evaluations with their key-epoch metadata. Clients that pinned this evaluator's key
+    directory only get `fx`, the generation and the key id they look the `vk` up with.
+    """
+    if pinned:
+        return [{'fx': e['fx'], 'gen': meta['gen'], 'kid': get_key_id(vk)} for e, ((_, vk), meta) in zip(evaluations, live)]
+    return [{**e, **meta} for e, (_, meta) in zip(evaluations, live)]
+
+def get_key_id(vk: bytes) -> str:
+    return hashlib.sha256(vk).hexdigest()[:16]
+
 class KeyRotation:
     @staticmethod
     def get_keys(i: int) -> Tuple[bytes, bytes]:
-        if i < 0 or i >= config.KEYLIST_SIZE:
-            raise ValueError('Index out of bounds')
-        
-        rkeys = [KeyRotation.get_record_label(i), KeyRotation.get_record_label(f'{EXP_PREFIX}.{i}')]
-        items = cache.find_all(rkeys)
-        
-        keypairs = []
-        for item in items:
-            if not item:
-                continue
-            
-            sk, pk = item.split('.')
-            keypairs.append((Utils.from_base64(sk), Utils.from_base64(pk)))
-        
+        return KeyRotation.get_keys_many([i])[i]
+
+    @staticmethod
+    def get_keys_many(indices: List[int]) -> Dict[int, list]:
+        """Fetches the keypairs of several indices with a single MGET"""
+        return {i: [kp for (kp, _) in live] for i, live in KeyRotation.get_live_keys(indices).items()}
+
+    @staticmethod
+    def get_live_keys(indices: List[int]) -> Dict[int, list]:
+        """
+        Keypairs of each index, current first, each with its key-epoch metadata: the generation
+        and, under the epoch schedule, the seconds since that key became current.
+        """
+        indices = KeyRotation.check_indices(indices)
+        if config.KEY_SCHEDULE == KEY_SCHEDULE_EPOCH:
+            return keyring.get_live_keys(indices)
+        return KeyRotation.parse_live_keys(indices, cache.find_all(KeyRotation.get_live_labels(indices)))
+
+    @staticmethod
+    async def aget_live_keys(indices: List[int]) -> Dict[int, list]:
+        """get_live_keys for request handlers: the rotation MGET does not block the event loop"""
+        indices = KeyRotation.check_indices(indices)
+        if config.KEY_SCHEDULE == KEY_SCHEDULE_EPOCH:
+            return keyring.get_live_keys(indices)
+        return KeyRotation.parse_live_keys(indices, await cache.afind_all(KeyRotation.get_live_labels(indices)))
+
+    @staticmethod
+    def check_indices(indices: List[int]) -> List[int]:
+        indices = list(dict.fromkeys(indices))
+        for i in indices:
+            if i < 0 or i >= config.KEYLIST_SIZE:
+                raise ValueError('Index out of bounds')
+        return indices
+
+    @staticmethod
+    def get_live_labels(indices: List[int]) -> List[str]:
+        rkeys = []
+        for i in indices:
+            rkeys.extend([KeyRotation.get_record_label(i), KeyRotation.get_record_label(f'{EXP_PREFIX}.{i}')])
+        return rkeys
+
+    @staticmethod
+    def parse_live_keys(indices: List[int], items: list) -> Dict[int, list]:
+        keypairs = {}
+        for n, i in enumerate(indices):
+            keypairs[i] = []
+            for gen, item in zip([GEN_CURRENT, GEN_EXPIRED], items[2 * n: 2 * n + 2]):
+                if not item:
+                    continue
+                sk, pk = item.split('.')
+                keypairs[i].append(((Utils.from_base64(sk), Utils.from_base64(pk)), {'gen': gen}))
         return keypairs
 
     @staticmethod
@@ -67,4 +130,127 @@ class KeyRotation:
             exp_idx = (exp_idx + 1) % config.KEYLIST_SIZE
             KeyRotation.save_recently_expired(exp_idx)
             KeyRotation.renew_key(exp_idx)
-            
\ No newline at end of file
+            
+
+class KeySchedule:
+    """
+    Wall-clock key schedule with the same semantics as KeyRotation.begin_rotation: time is split
+    into epochs of ROTATION_INTERVAL_SECONDS and at the start of epoch e the key at index
+    e % KEYLIST_SIZE is replaced. Each key therefore lives KEYLIST_SIZE epochs and its
+    predecessor stays valid for LIVENESS_WINDOW_SECONDS after the rotation.
+    
+    The n-th key of index i (its generation) is stored once under its own label, and any
+    evaluator worker that misses it mints it with SET NX, so rotation needs no dedicated
+    process and never drifts. Clocks of evaluators are assumed to be NTP-synchronized.
+    """
+    @staticmethod
+    def epoch(now: float = None) -> int:
+        now = time.time() if now is None else now
+        return int(now // config.ROTATION_INTERVAL_SECONDS)
+
+    @staticmethod
+    def generation(i: int, epoch: int) -> int:
+        return (epoch - i) // config.KEYLIST_SIZE
+
+    @staticmethod
+    def rotated_at(i: int, gen: int) -> float:
+        return (gen * config.KEYLIST_SIZE + i) * config.ROTATION_INTERVAL_SECONDS
+
+    @staticmethod
+    def expires_at(i: int, gen: int) -> float:
+        return KeySchedule.rotated_at(i, gen + 1) + config.LIVENESS_WINDOW_SECONDS
+
+    @staticmethod
+    def live_generations(i: int, now: float = None) -> List[int]:
+        """Current generation of index i, followed by the previous one while it is in its liveness window"""
+        now = time.time() if now is None else now
+        gen = KeySchedule.generation(i, KeySchedule.epoch(now))
+        if now < KeySchedule.rotated_at(i, gen) + config.LIVENESS_WINDOW_SECONDS:
+            return [gen, gen - 1]
+        return [gen]
+
+    @staticmethod
+    def next_change(i: int, now: float = None) -> float:
+        """Time at which the set of live keys of index i changes next (a rotation or the end of a liveness window)"""
+        now = time.time() if now is None else now
+        gen = KeySchedule.generation(i, KeySchedule.epoch(now))
+        boundaries = [KeySchedule.rotated_at(i, gen + 1), KeySchedule.rotated_at(i, gen) + config.LIVENESS_WINDOW_SECONDS]
+        return min(b for b in boundaries if b > now)
+
+    @staticmethod
+    def get_record_label(i: int, gen: int) -> str:
+        return f'{config.KEY_ROTATION_LABEL}.{i}.g{gen}'
+
+    @staticmethod
+    def load(pairs: List[Tuple[int, int]], create: set = None) -> Dict[Tuple[int, int], Tuple[bytes, bytes]]:
+        """Fetches the keypairs of (index, generation) pairs with one MGET, minting those listed in `create`"""
+        if not pairs:
+            return {}
+        create = create or set()
+        items = cache.find_all([KeySchedule.get_record_label(i, gen) for (i, gen) in pairs])
+        
+        keypairs = {}
+        for (i, gen), item in zip(pairs, items):
+            if not item and (i, gen) in create:
+                item = KeySchedule.mint(i, gen)
+            if item:
+                sk, pk = item.split('.')
+                keypairs[(i, gen)] = (Utils.from_base64(sk), Utils.from_base64(pk))
+        return keypairs
+
+    @staticmethod
+    def mint(i: int, gen: int) -> str:
+        """Creates the key for (i, gen) unless another worker already did, and returns the winning key"""
+        sk, pk = Voprf.keygen()
+        label = KeySchedule.get_record_label(i, gen)
+        ttl = math.ceil(KeySchedule.expires_at(i, gen) - time.time()) + config.ROTATION_INTERVAL_SECONDS
+        if cache.save_if_absent(key=label, value=f'{Utils.to_base64(sk)}.{Utils.to_base64(pk)}', seconds=max(ttl, 1)):
+            return f'{Utils.to_base64(sk)}.{Utils.to_base64(pk)}'
+        return cache.find(key=label)
+
+    @staticmethod
+    def begin_schedule():
+        """Optional pre-warmer: mints each upcoming key shortly before its rotation so evaluators never have to"""
+        while True:
+            epoch = KeySchedule.epoch() + 1
+            i = epoch % config.KEYLIST_SIZE
+            gen = KeySchedule.generation(i, epoch)
+            KeySchedule.load([(i, gen)], create={(i, gen)})
+            print(f"Prepared key generation {gen} for index {i}", flush=True)
+            time.sleep(max(KeySchedule.rotated_at(i, gen) - time.time(), 0) + 0.001)
+
+class Keyring:
+    """
+    Per-process memo of the keys of the epoch schedule. Redis is only read the first time a
+    worker needs a generation, so evaluations stay off the network for the rest of its life.
+    Holds at most two generations per index.
+    """
+    def __init__(self):
+        self.keys: Dict[Tuple[int, int], Tuple[bytes, bytes]] = {}
+
+    def get_keys(self, indices: List[int], now: float = None) -> Dict[int, list]:
+        return {i: [kp for (kp, _) in live] for i, live in self.get_live_keys(indices, now).items()}
+
+    def get_live_keys(self, indices: List[int], now: float = None) -> Dict[int, list]:
+        now = time.time() if now is None else now
+        wanted = {i: KeySchedule.live_generations(i, now) for i in indices}
+
+        missing = [(i, gen) for i, gens in wanted.items() for gen in gens if (i, gen) not in self.keys]
+        if missing:
+            # Only the current generation is minted; an expired one that was never used stays absent
+            self.keys.update(KeySchedule.load(missing, create={(i, gens[0]) for i, gens in wanted.items()}))
+            self.evict(now)
+
+        return {
+            i: [
+                (self.keys[(i, gen)], {'gen': gen, 'age': round(now - KeySchedule.rotated_at(i, gen), 3)}) 
+                for gen in gens if (i, gen) in self.keys
+            ] 
+            for i, gens in wanted.items()
+        }
+
+    def evict(self, now: float):
+        for (i, gen) in [k for k in self.keys if KeySchedule.expires_at(*k) <= now]:
+            del self.keys[(i, gen)]
+
+keyring = Keyring()
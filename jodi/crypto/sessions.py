@@ -0,0 +1,217 @@
+import os, time, hmac, hashlib, base64, struct, asyncio
+from typing import List
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives import hashes
+
+from jodi import config
+from jodi.crypto import groupsig, keys, audit_logging
+from jodi.helpers import http
+from jodi.helpers.coalesce import SingleFlight
+
+TICKET_AAD = b'jodi session ticket v1'
+NONCE_SIZE = 12
+
+ticket_key: bytes = None
+
+def to_base64(data: bytes) -> str:
+    return base64.b64encode(data).decode('utf-8')
+
+def from_base64(data: str) -> bytes:
+    return base64.b64decode(data.encode('utf-8'))
+
+def get_ticket_key() -> bytes:
+    """
+    Node secret sealing tickets. Workers of a node derive the same key, so any worker accepts
+    any ticket; the label carries NODE_FQDN, so nodes sharing TEST_ISK still get distinct keys.
+    """
+    global ticket_key
+    if ticket_key is None:
+        if config.SESSION_TICKET_KEY:
+            ticket_key = from_base64(config.SESSION_TICKET_KEY)
+        else:
+            ticket_key = keys.derive_secret(config.TEST_ISK, f'jodi session ticket key:{config.NODE_FQDN}')
+    return ticket_key
+
+def get_ticket_aad(node: str = None) -> bytes:
+    # Binds a ticket to its issuing node even where nodes were given the same SESSION_TICKET_KEY
+    return TICKET_AAD + b':' + (node or config.NODE_FQDN).encode('utf-8')
+
+def get_share(sk: x25519.X25519PrivateKey) -> str:
+    return to_base64(sk.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    ))
+
+def derive_session_key(sk: x25519.X25519PrivateKey, peer_share: str, client_share: str, node_share: str) -> bytes:
+    shared = sk.exchange(x25519.X25519PublicKey.from_public_bytes(from_base64(peer_share)))
+    info = b'jodi session key' + from_base64(client_share) + from_base64(node_share)
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(shared)
+
+def get_hello_message(share: str, nonce: str) -> str:
+    """What the proxy group-signs to open a session"""
+    return 'session:' + share + ':' + nonce
+
+def get_issued_data(client_share: str, nonce: str, node_share: str, ticket: str, expires: int) -> dict:
+    """What the node signs with its receipt key, binding its share to the proxy's hello"""
+    return {'share': client_share, 'nonce': nonce, 'node_share': node_share, 'ticket': ticket, 'expires': expires}
+
+def issue(client_share: str, node: str = None) -> dict:
+    """
+    Node side: answers a verified hello with a fresh key share and a ticket. The ticket seals
+    the session key and its expiry under the node secret, so nodes keep no session state.
+    """
+    sk = x25519.X25519PrivateKey.generate()
+    node_share = get_share(sk)
+    key = derive_session_key(sk, client_share, client_share, node_share)
+    expires = int(time.time()) + config.SESSION_TTL_SECONDS
+
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = AESGCM(get_ticket_key()).encrypt(nonce, struct.pack('>Q', expires) + key, get_ticket_aad(node))
+    return {'node_share': node_share, 'ticket': to_base64(nonce + sealed), 'expires': expires}
+
+def open_ticket(ticket: str, node: str = None) -> bytes:
+    """Returns the session key sealed in a ticket, or None if the ticket is forged, expired or issued by another node"""
+    try:
+        raw = from_base64(ticket)
+        plain = AESGCM(get_ticket_key()).decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], get_ticket_aad(node))
+    except Exception:
+        return None
+    (expires,) = struct.unpack('>Q', plain[:8])
+    if expires < time.time():
+        return None
+    return plain[8:]
+
+def mac(key: bytes, msg: str) -> str:
+    return to_base64(hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest())
+
+def verify_mac(ticket: str, tag: str, msg: str) -> bool:
+    key = open_ticket(ticket)
+    if key is None or not tag:
+        return False
+    return hmac.compare_digest(mac(key, msg), tag)
+
+def get_ticket_id(ticket: str) -> str:
+    """Short stable id of a ticket, linking log entries of one session without storing the ticket"""
+    return hashlib.sha256(ticket.encode('utf-8')).hexdigest()[:16]
+
+def get_log_fields(sig: str = None, ticket: str = None, tag: str = None) -> dict:
+    """
+    Authentication fields of an audit log entry. `sig` only ever holds a group signature;
+    MAC-authenticated requests log the MAC and their ticket id under their own keys.
+    """
+    if tag and ticket:
+        return {'sig': sig, 'mac': tag, 'tid': get_ticket_id(ticket)}
+    return {'sig': sig}
+
+def get_node_url(req: dict) -> str:
+    return req['url'].rsplit('/', 1)[0]
+
+class Session:
+    __slots__ = ('ticket', 'key', 'expires', 'established_at', 'uses')
+
+    def __init__(self, ticket: str, key: bytes, expires: int):
+        self.ticket = ticket
+        self.key = key
+        self.expires = expires
+        self.established_at = time.time()
+        self.uses = 0
+
+    def is_fresh(self, now: float) -> bool:
+        return (
+            self.uses < config.SESSION_MAX_REQUESTS
+            and now - self.established_at < config.SESSION_INTERVAL_SECONDS
+            and now < self.expires
+        )
+
+class SessionManager:
+    """
+    Proxy side: one session per node, opened with a single group signature and used to MAC
+    later requests. A session is re-established after SESSION_INTERVAL_SECONDS or
+    SESSION_MAX_REQUESTS, whichever comes first; requests within a session are linkable
+    by the node, requests across sessions are not. Concurrent calls share one handshake.
+    """
+    def __init__(self, gsc: groupsig.GroupSigContext):
+        self.gsc = gsc
+        self.sessions = {}
+        # Nodes whose last handshake failed are not asked again before their retry time
+        self.retry_at = {}
+        self.handshakes = SingleFlight()
+        self.established = 0
+        self.failed = 0
+
+    async def get(self, node_url: str) -> Session:
+        session, now = self.sessions.get(node_url), time.time()
+        if session is None or not session.is_fresh(now):
+            if self.retry_at.get(node_url, 0) > now:
+                return None
+            try:
+                session = await self.handshakes.do(node_url, lambda: self.establish(node_url))
+            except Exception:
+                session = self.fail(node_url)
+        if session:
+            session.uses += 1
+        return session
+
+    async def establish(self, node_url: str) -> Session:
+        sk = x25519.X25519PrivateKey.generate()
+        share = get_share(sk)
+        nonce = to_base64(os.urandom(16))
+        res = await http.post(url=node_url + '/session', data={
+            'share': share,
+            'nonce': nonce,
+            'sig': self.gsc.sign(msg=get_hello_message(share, nonce)),
+        }, content_type=config.WIRE_FORMAT)
+
+        # The node's share is only trusted once its receipt signature over the exchange verifies
+        if '_error' in res or not all(k in res for k in ('node_share', 'ticket', 'expires', 'sig_r')):
+            return self.fail(node_url)
+        issued = get_issued_data(share, nonce, res['node_share'], res['ticket'], res['expires'])
+        if not audit_logging.verify(data=issued, sigma=res['sig_r']):
+            return self.fail(node_url)
+
+        key = derive_session_key(sk, res['node_share'], share, res['node_share'])
+        session = Session(ticket=res['ticket'], key=key, expires=res['expires'])
+        self.sessions[node_url] = session
+        self.retry_at.pop(node_url, None)
+        self.established += 1
+        return session
+
+    def fail(self, node_url: str):
+        self.sessions.pop(node_url, None)
+        self.retry_at[node_url] = time.time() + config.SESSION_RETRY_SECONDS
+        self.failed += 1
+        return None
+
+    async def authenticate(self, requests: List[dict], keep_sig: bool = False) -> List[dict]:
+        """
+        Authenticates each request with its node's ticket and a MAC over the message it would
+        otherwise group-sign (`msg`), dropping the group signature unless `keep_sig` is set.
+        Requests to nodes without a session fall back to a group signature.
+        """
+        urls = list({get_node_url(req) for req in requests})
+        sessions = dict(zip(urls, await asyncio.gather(*[self.get(url) for url in urls])))
+        signatures = {}
+        for req in requests:
+            session, data = sessions[get_node_url(req)], req['data']
+            if session is None:
+                if 'sig' not in data:
+                    if req['msg'] not in signatures:
+                        signatures[req['msg']] = self.gsc.sign(msg=req['msg'])
+                    req['data'] = {**data, 'sig': signatures[req['msg']]}
+                continue
+            if not keep_sig:
+                data = {k: v for k, v in data.items() if k != 'sig'}
+            req['data'] = {**data, 'ticket': session.ticket, 'mac': mac(session.key, req['msg'])}
+        return requests
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            'sessions': len(self.sessions),
+            'cooling_down': sum(1 for at in self.retry_at.values() if at > now),
+            'established': self.established,
+            'failed': self.failed,
+        }
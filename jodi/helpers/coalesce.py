@@ -0,0 +1,111 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+class MicroBatcher:
+    """
+    Merges concurrent submissions that share a key (e.g. a node url) into a single
+    flush call. A batch is flushed when `window_ms` has elapsed since its first item
+    or when it reaches `max_size` items, whichever comes first.
+
+    `flush(key, items)` must return one result per item, in order. If it raises,
+    every caller waiting on that batch receives the exception. `close()` flushes what is
+    still pending and waits for every in-flight flush.
+    """
+    def __init__(self, flush: Callable[[str, List[Any]], Awaitable[List[Any]]], window_ms: float = 2, max_size: int = 64):
+        self.flush = flush
+        self.window = max(window_ms, 0) / 1000
+        self.max_size = max(max_size, 1)
+        self.pending: Dict[str, List[tuple]] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        # The loop only keeps weak references to tasks, so in-flight flushes are held here
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, key: str, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((item, future))
+
+        if len(batch) >= self.max_size:
+            self._dispatch(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.window, self._dispatch, key)
+
+        return await future
+
+    def _dispatch(self, key: str):
+        timer = self.timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if batch:
+            task = asyncio.ensure_future(self._run(key, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def close(self):
+        for key in list(self.pending):
+            self._dispatch(key)
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    async def _run(self, key: str, batch: List[tuple]):
+        # Callers that gave up (e.g. the losers of posts_race) are dropped before flushing
+        batch = [(item, future) for (item, future) in batch if not future.done()]
+        if not batch:
+            return
+        try:
+            results = await self.flush(key, [item for (item, _) in batch])
+            if len(results) != len(batch):
+                raise ValueError(f'Batch flush returned {len(results)} results for {len(batch)} items')
+        except Exception as e:
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+class SingleFlight:
+    """
+    Runs at most one `fn()` per key at a time. Callers arriving while a call for their key is
+    in flight await the leader's result (or exception) instead of starting their own.
+    A caller that is cancelled only stops waiting; the shared call is cancelled once no
+    caller is left waiting for it.
+    """
+    def __init__(self):
+        self.calls: Dict[Any, asyncio.Future] = {}
+        self.waiters: Dict[Any, int] = {}
+        self.metrics = {'leaders': 0, 'followers': 0}
+
+    async def do(self, key: Any, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            self.waiters[key] = 0
+            task.add_done_callback(lambda _: self._forget(key, task))
+            self.metrics['leaders'] += 1
+        else:
+            self.metrics['followers'] += 1
+
+        self.waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self.waiters.get(key) == 1:
+                task.cancel()
+            raise
+        finally:
+            if key in self.waiters and self.calls.get(key) is task:
+                self.waiters[key] -= 1
+
+    def _forget(self, key: Any, task: asyncio.Future):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+            del self.waiters[key]
+
+    def stats(self) -> dict:
+        return {**self.metrics, 'in_flight': len(self.calls)}
@@ -0,0 +1,108 @@
+import base64, binascii, json
+from contextvars import ContextVar
+
+import msgpack
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Base64 fields carried as raw bytes in msgpack. Values that do not round-trip
+# exactly through base64 are sent as they are.
+BINARY_FIELDS = frozenset([
+    'x', 'fx', 'vk', 'sig', 'sig_r', 'bt', 'idx', 'mac', 'ticket', 'share', 'node_share', 'nonce',
+])
+
+def to_wire(data):
+    """Replaces base64 strings of BINARY_FIELDS by the bytes they encode"""
+    if isinstance(data, dict):
+        return {k: _to_bytes(v) if k in BINARY_FIELDS else to_wire(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_wire(v) for v in data]
+    return data
+
+def _to_bytes(value):
+    if not isinstance(value, str):
+        return to_wire(value)
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return value
+    return raw if base64.b64encode(raw).decode('utf-8') == value else value
+
+def from_wire(data):
+    """Inverse of to_wire: the application always sees base64 strings"""
+    if isinstance(data, dict):
+        return {k: from_wire(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [from_wire(v) for v in data]
+    if isinstance(data, bytes):
+        return base64.b64encode(data).decode('utf-8')
+    return data
+
+def encode(data, content_type: str = JSON) -> bytes:
+    if content_type == MSGPACK:
+        return msgpack.packb(to_wire(data), use_bin_type=True)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def decode(body: bytes, content_type: str = JSON):
+    if content_type and content_type.startswith(MSGPACK):
+        return from_wire(msgpack.unpackb(body, raw=False))
+    return json.loads(body)
+
+def _sorted(data):
+    if isinstance(data, dict):
+        return {k: _sorted(data[k]) for k in sorted(data)}
+    if isinstance(data, (list, tuple)):
+        return [_sorted(v) for v in data]
+    return data
+
+def canonical(data) -> bytes:
+    """Deterministic encoding (msgpack with sorted keys) used to hash responses for receipts"""
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return msgpack.packb(_sorted(data), use_bin_type=True)
+
+def negotiate(accept: str) -> str:
+    return MSGPACK if accept and MSGPACK in accept else JSON
+
+# Response format negotiated for the request being handled
+accepted: ContextVar[str] = ContextVar('jodi_accepted', default=JSON)
+
+class WireResponse(JSONResponse):
+    """JSONResponse rendered in the format the client accepts"""
+    def __init__(self, content, status_code: int = 200, **kwargs):
+        self.media_type = accepted.get()
+        super().__init__(content, status_code=status_code, **kwargs)
+
+    def render(self, content) -> bytes:
+        return encode(content, self.media_type)
+
+class WireRoute(APIRoute):
+    """
+    Route accepting msgpack bodies besides JSON. Msgpack bodies are decoded here and handed
+    to FastAPI as an already parsed JSON body, so pydantic models are unchanged.
+    """
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def wire_handler(request: Request):
+            accepted.set(negotiate(request.headers.get('accept')))
+            if request.headers.get('content-type', '').startswith(MSGPACK):
+                request = await as_json_request(request)
+            return await handler(request)
+
+        return wire_handler
+
+async def as_json_request(request: Request) -> Request:
+    body = await request.body()
+    scope = dict(request.scope)
+    scope['headers'] = [(k, v) for (k, v) in request.scope['headers'] if k != b'content-type']
+    scope['headers'].append((b'content-type', JSON.encode('utf-8')))
+
+    parsed = Request(scope, request.receive)
+    parsed._body = body
+    parsed._json = decode(body, MSGPACK)
+    return parsed
@@ -0,0 +1,48 @@
+import time
+from contextvars import ContextVar
+from typing import Mapping
+
+# Remaining budget in milliseconds. Relative like grpc-timeout, so nodes need no clock sync.
+HEADER = 'X-Jodi-Timeout-Ms'
+
+class DeadlineExceeded(Exception):
+    """Raised when work would start after the deadline of the request it belongs to"""
+    pass
+
+class Deadline:
+    """Absolute point on this process' monotonic clock after which a call's work is useless"""
+    __slots__ = ('expires_at',)
+
+    def __init__(self, budget_ms: float, start: float = None):
+        self.expires_at = (time.monotonic() if start is None else start) + budget_ms / 1000
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str], received_at: float = None) -> 'Deadline':
+        value = headers.get(HEADER)
+        if value is None:
+            return None
+        try:
+            return cls(float(value), start=received_at)
+        except ValueError:
+            return None
+
+    def remaining(self) -> float:
+        """Seconds left, never negative"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def slice(self, share: float) -> 'Deadline':
+        """Deadline of a phase that may use `share` of what is left of this one"""
+        return Deadline(self.remaining() * share * 1000)
+
+    def headers(self) -> dict:
+        return {HEADER: str(int(self.remaining() * 1000))}
+
+# Deadline of the request being handled by a node, set by its middleware
+current: ContextVar[Deadline] = ContextVar('jodi_deadline', default=None)
+
+def check(expires_at: float):
+    if expires_at is not None and time.monotonic() >= expires_at:
+        raise DeadlineExceeded('Deadline exceeded before the work started')
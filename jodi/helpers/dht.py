@@ -1,10 +1,11 @@
-import heapq
+import heapq, time
 from jodi.models import cache
 from jodi import config
-from typing import List
+from jodi.helpers import http
+from typing import List, Callable
 from pylibjodi import Oprf, Utils, Ciphering
 
-def get_nodes(nodes: List[dict], key: bytes, count: int) -> dict:
+def get_nodes(nodes: List[dict], key: bytes, count: int, available: Callable[[dict], bool] = None) -> dict:
     if not isinstance(key, bytes) or len(key) == 0:
         raise ValueError('Key must be a non-empty bytes object')
     if len(key) != 32:
@@ -16,19 +17,30 @@ def get_nodes(nodes: List[dict], key: bytes, count: int) -> dict:
         xor = Utils.xor(bytes.fromhex(node['id']), key)
         distance = int.from_bytes(xor, byteorder='big')
         heapq.heappush(heap, (distance, node))
-    return [heapq.heappop(heap)[1] for _ in range(min(count, len(heap)))]
+    
+    picked, skipped = [], []
+    while heap and len(picked) < count:
+        node = heapq.heappop(heap)[1]
+        (picked if available is None or available(node) else skipped).append(node)
+    # With too few available nodes, the closest unavailable ones are still better than fewer requests
+    return picked + skipped[:count - len(picked)]
+
+def is_available(node: dict) -> bool:
+    return http.scoreboard.is_available(node['id'])
 
 def get_stores(keys, count: int, nodes: List[dict] = None):
     stores = nodes if nodes else cache.find(key=config.STORES_KEY, dtype=dict)
 
+    # Stores with an open circuit are replaced by the next closest ones. Evaluators are not:
+    # the call ID depends on which evaluators answered, so both sides must pick the same set.
     if type(keys) == bytes:
-        return get_nodes(stores, keys, count)
+        return get_nodes(stores, keys, count, available=is_available)
     
     data = []
     node_count = config.STORES_PER_MULTI_CID if len(keys) > 1 else count
     
     for key in keys:
-        data.append(get_nodes(stores, key, node_count))
+        data.append(get_nodes(stores, key, node_count, available=is_available))
 
     return data
 
@@ -42,4 +54,27 @@ def get_evals(keys, count: int, nodes: List[dict] = None):
     for key in keys:
         data.append(get_nodes(evals, key, count))
 
-    return data
\ No newline at end of file
+    return data
+
+class Membership:
+    """
+    Process-local view of the evaluator and store lists kept in the cache.
+    Re-read at most every `refresh_seconds` instead of on every call.
+    """
+    def __init__(self, refresh_seconds: float = None):
+        self.refresh_seconds = config.MEMBERSHIP_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        self.nodes = {}
+        self.loaded_at = {}
+
+    def get(self, key: str) -> List[dict]:
+        now = time.monotonic()
+        if not self.nodes.get(key) or now - self.loaded_at[key] >= self.refresh_seconds:
+            self.nodes[key] = cache.find(key=key, dtype=dict) or []
+            self.loaded_at[key] = now
+        return self.nodes[key]
+
+    def get_evals(self) -> List[dict]:
+        return self.get(config.EVALS_KEY)
+
+    def get_stores(self) -> List[dict]:
+        return self.get(config.STORES_KEY)
@@ -1,6 +1,12 @@
-from typing import List, Dict
+from typing import Callable, List, Dict
+from collections import deque
 import aiohttp
-import asyncio, traceback
+import asyncio, traceback, time
+
+from jodi import config
+from jodi.helpers import codec
+from jodi.helpers.coalesce import MicroBatcher
+from jodi.helpers.deadline import Deadline
 
 import logging
 
@@ -10,6 +16,129 @@ aiohttp_log.addHandler(logging.StreamHandler())
 
 keep_alive_session: aiohttp.ClientSession = None
 
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half-open'
+
+# Status of replies that never arrived: the node could not be reached or timed out
+STATUS_UNREACHABLE = 599
+TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+class NodeScore:
+    """Health of one node as seen by this process: EWMA latency and error rate plus a circuit breaker"""
+    __slots__ = ('latency_ms', 'error_rate', 'samples', 'state', 'opened_at', 'failures', 'probing', 'requests', 'errors')
+
+    def __init__(self):
+        self.latency_ms = None
+        self.error_rate = 0.0
+        self.samples = deque(maxlen=config.HTTP_LATENCY_SAMPLES)
+        self.state = CIRCUIT_CLOSED
+        self.opened_at = 0
+        self.failures = 0 # consecutive
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+
+    def percentile(self, p: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'latency_ms': round(self.latency_ms, 3) if self.latency_ms is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'requests': self.requests,
+            'errors': self.errors,
+        }
+
+class Scoreboard:
+    """
+    Per-node scores keyed by node id (or url). A node's circuit opens after
+    HTTP_BREAKER_FAILURES consecutive failures or once its error rate passes
+    HTTP_BREAKER_ERROR_RATE; requests to it then fail immediately. After
+    HTTP_BREAKER_COOLDOWN_SECONDS one probe request is let through (half-open)
+    and its outcome closes or re-opens the circuit. Client errors (4xx) are answers,
+    not failures: a store without the record is healthy.
+    """
+    def __init__(self):
+        self.nodes: Dict[str, NodeScore] = {}
+
+    def get(self, node: str) -> NodeScore:
+        score = self.nodes.get(node)
+        if score is None:
+            score = self.nodes[node] = NodeScore()
+        return score
+
+    def is_available(self, node: str) -> bool:
+        """Whether a request to the node would be sent, without taking the half-open probe"""
+        score = self.nodes.get(node)
+        if score is None or score.state == CIRCUIT_CLOSED:
+            return True
+        if score.state == CIRCUIT_OPEN:
+            return time.monotonic() - score.opened_at >= config.HTTP_BREAKER_COOLDOWN_SECONDS
+        return not score.probing
+
+    def allow(self, node: str) -> bool:
+        score = self.get(node)
+        if score.state == CIRCUIT_CLOSED:
+            return True
+        if not self.is_available(node):
+            return False
+        score.state = CIRCUIT_HALF_OPEN
+        score.probing = True
+        return True
+
+    def record(self, node: str, latency: float, ok: bool):
+        score = self.get(node)
+        alpha = config.HTTP_EWMA_ALPHA
+        score.requests += 1
+        score.probing = False
+        score.error_rate = (1 - alpha) * score.error_rate + alpha * (0.0 if ok else 1.0)
+
+        if ok:
+            latency_ms = latency * 1000
+            score.latency_ms = latency_ms if score.latency_ms is None else (1 - alpha) * score.latency_ms + alpha * latency_ms
+            score.samples.append(latency_ms)
+            score.failures = 0
+            if score.state == CIRCUIT_HALF_OPEN:
+                score.state = CIRCUIT_CLOSED
+                score.error_rate = 0.0
+            return
+
+        score.errors += 1
+        score.failures += 1
+        if (score.state == CIRCUIT_HALF_OPEN 
+            or score.failures >= config.HTTP_BREAKER_FAILURES 
+            or (score.requests >= config.HTTP_BREAKER_MIN_REQUESTS and score.error_rate >= config.HTTP_BREAKER_ERROR_RATE)):
+            score.state = CIRCUIT_OPEN
+            score.opened_at = time.monotonic()
+
+    def release(self, node: str):
+        """Frees the half-open probe of a request that was cancelled before it answered"""
+        score = self.nodes.get(node)
+        if score:
+            score.probing = False
+
+    def hedge_delay_ms(self, node: str) -> float:
+        """HTTP_HEDGE_PERCENTILE of the node's recent latency, or 0 while hedging is off or samples are few"""
+        score = self.nodes.get(node)
+        if not config.HTTP_HEDGE_PERCENTILE or score is None or len(score.samples) < config.HTTP_HEDGE_MIN_SAMPLES:
+            return 0
+        return score.percentile(config.HTTP_HEDGE_PERCENTILE)
+
+    def stats(self) -> dict:
+        return {node: score.stats() for node, score in self.nodes.items()}
+
+scoreboard = Scoreboard()
+
+def get_node_key(req: dict) -> str:
+    return req.get('nodeId') or req['url']
+
+def is_node_failure(response: dict) -> bool:
+    """Only server errors and unreachable nodes count; errors without a status are not the node's"""
+    return '_error' in response and response.get('_status', 0) >= 500
+
 def create_session(event_loop=None, limit=1000, keepalive_timeout=60) -> aiohttp.ClientSession:
     connector = aiohttp.TCPConnector(loop=event_loop, limit=limit, keepalive_timeout=keepalive_timeout)
     return aiohttp.ClientSession(loop=event_loop, connector=connector)
@@ -35,43 +164,132 @@ def get_headers(headers: dict = {}) -> dict:
         **headers
     }
 
-async def post(url: str, data: dict, headers: dict = {}) -> dict:
+def get_timeout(phase: Deadline = None) -> aiohttp.ClientTimeout:
+    """HTTP_TIMEOUT_SECONDS, cut to what is left of `phase`"""
+    total = config.HTTP_TIMEOUT_SECONDS or None
+    if phase:
+        # aiohttp reads a zero total as no timeout at all
+        left = max(phase.remaining(), 0.001)
+        total = min(total, left) if total else left
+    return aiohttp.ClientTimeout(total=total)
+
+async def post(url: str, data: dict, headers: dict = {}, content_type: str = codec.JSON) -> dict:
+    """Posts the body as `content_type` and decodes the response by its Content-Type, so JSON-only nodes still work"""
     try:
-        async with keep_alive_session.post(url, json=data, headers=get_headers(headers)) as response:
+        headers = get_headers({'Content-Type': content_type, 'Accept': f'{content_type}, {codec.JSON}', **headers})
+        async with keep_alive_session.post(url, data=codec.encode(data, content_type), headers=headers, timeout=get_timeout()) as response:
             response.raise_for_status()
-            return await response.json()
+            return codec.decode(await response.read(), response.content_type)
+    except aiohttp.ClientResponseError as e:
+        return {"_error": str(e), "_status": e.status}
+    except TRANSPORT_ERRORS as e:
+        return {"_error": str(e) or type(e).__name__, "_status": STATUS_UNREACHABLE}
     except Exception as e:
         # traceback.print_exc()
         return {"_error": str(e)}
 
-async def posts(reqs: List[dict]) -> List[dict]:
-    tasks = [ post(url=req['url'], data=req['data'], headers=req.get('headers', {})) for req in reqs ]
+async def post_batched(req: dict, batcher: MicroBatcher) -> dict:
+    """Queues a request on a micro-batcher keyed by its url, which coalesces it with concurrent requests to the same node"""
+    try:
+        return await batcher.submit(req['url'], req)
+    except asyncio.CancelledError:
+        raise
+    except TRANSPORT_ERRORS as e:
+        return {"_error": str(e) or type(e).__name__, "_status": STATUS_UNREACHABLE}
+    except Exception as e:
+        return {"_error": str(e)}
+
+async def send(req: dict, batcher: MicroBatcher = None) -> dict:
+    """
+    Sends one request unless its node's circuit is open or its deadline (`req['deadline']`)
+    has passed, and scores the node on the outcome. The remaining budget travels in a header.
+    """
+    node = get_node_key(req)
+    phase: Deadline = req.get('deadline')
+    if phase and phase.expired():
+        return {"_error": "Deadline exceeded"}
+    if not scoreboard.allow(node):
+        return {"_error": f"Circuit open for {node}"}
+    
+    start = time.perf_counter()
+    try:
+        if batcher:
+            response = await post_batched(req, batcher)
+        else:
+            headers = {**req.get('headers', {}), **phase.headers()} if phase else req.get('headers', {})
+            response = await post(url=req['url'], data=req['data'], headers=headers, content_type=req.get('content_type', codec.JSON))
+    except asyncio.CancelledError:
+        scoreboard.release(node)
+        raise
+    scoreboard.record(node, time.perf_counter() - start, not is_node_failure(response))
+    return response
+
+async def cancel_all(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def within(phase: Deadline, coro, default):
+    """Awaits a fan-out until the phase deadline; past it the fan-out is cancelled and `default` returned"""
+    if phase is None:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, timeout=phase.remaining())
+    except asyncio.TimeoutError:
+        return default
+
+async def posts(reqs: List[dict], batcher: MicroBatcher = None) -> List[dict]:
+    tasks = [ send(req, batcher) for req in reqs ]
     return await asyncio.gather(*tasks)
     
-async def posts_race(reqs: List[Dict]) -> Dict:
-    tasks = {asyncio.create_task(post(url=req["url"], data=req["data"], headers=req.get("headers", {}))): req for req in reqs}
-    failures = []
-    while tasks:
-        done, pending = await asyncio.wait(tasks.keys(), return_when=asyncio.FIRST_COMPLETED)
-
-        for task in done:
-            result = await task
-            if "_error" not in result:
-                for p in pending:
-                    p.cancel()
-                await asyncio.gather(*pending, return_exceptions=True)
-                return [result]
-            else:
+async def posts_race(reqs: List[Dict], batcher: MicroBatcher = None, accept: Callable[[dict], bool] = None, hedge_ms: float = 0, initial: int = 1, k: int = 1) -> List[Dict]:
+    """
+    Races the requests and returns the first `k` responses that pass `accept` (by default:
+    any response without `_error`), in arrival order, cancelling the rest. Rejected responses
+    do not end the race. With `hedge_ms`, only `initial` requests are sent at first and one
+    more is started each time `hedge_ms` passes without an answer or a response is rejected.
+    Without `hedge_ms`, the delay is the first node's latency percentile once HTTP_HEDGE_PERCENTILE
+    is set. If fewer than `k` are accepted, returns those followed by every rejected response.
+    """
+    accept = accept or (lambda res: "_error" not in res)
+    queue = list(reqs)
+    if not hedge_ms and queue:
+        hedge_ms = scoreboard.hedge_delay_ms(get_node_key(queue[0]))
+    first = max(initial, 1) if hedge_ms else len(queue)
+    pending = {asyncio.create_task(send(req, batcher)) for req in queue[:first]}
+    queue = queue[first:]
+    accepted, failures = [], []
+    
+    try:
+        while pending or queue:
+            if not pending:
+                pending.add(asyncio.create_task(send(queue.pop(0), batcher)))
+            
+            timeout = hedge_ms / 1000 if hedge_ms and queue else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            
+            if not done:
+                pending.add(asyncio.create_task(send(queue.pop(0), batcher)))
+                continue
+            
+            for task in done:
+                result = task.result()
+                if accept(result):
+                    accepted.append(result)
+                    if len(accepted) >= k:
+                        return accepted
+                    continue
                 failures.append(result)
-        
-        for task in done:
-            tasks.pop(task, None)
+                if hedge_ms and queue:
+                    pending.add(asyncio.create_task(send(queue.pop(0), batcher)))
+    finally:
+        await cancel_all(pending)
 
-    return failures
+    return accepted + failures
 
-async def get(url: str, params: dict = {}, headers: dict = {}) -> dict:
+async def get(url: str, params: dict = {}, headers: dict = {}, phase: Deadline = None) -> dict:
     try:
-        async with keep_alive_session.get(url, params=params, headers=get_headers(headers)) as response:
+        async with keep_alive_session.get(url, params=params, headers=get_headers(headers), timeout=get_timeout(phase)) as response:
             response.raise_for_status()
             return await response.json()
     except Exception as e:
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Dict, Set
+
+class WaiterTable:
+    """
+    Futures keyed by what they wait for (e.g. a record idx), resolved by `notify(key)`.
+    Callers `register` before checking whether the key already exists and `wait` only if it
+    does not, so a notification landing between the check and the wait is never lost.
+    """
+    def __init__(self, max_waiters: int = 10000):
+        self.max_waiters = max_waiters
+        self.waiters: Dict[Any, Set[asyncio.Future]] = {}
+        self.size = 0
+        self.metrics = {'waited': 0, 'woken': 0, 'timed_out': 0, 'rejected': 0}
+
+    def register(self, key: Any) -> asyncio.Future:
+        """A future for `key`, or None when the table is full"""
+        if self.size >= self.max_waiters:
+            self.metrics['rejected'] += 1
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, set()).add(future)
+        self.size += 1
+        return future
+
+    def discard(self, key: Any, future: asyncio.Future):
+        futures = self.waiters.get(key)
+        if futures is None or future not in futures:
+            return
+        futures.discard(future)
+        self.size -= 1
+        if not futures:
+            del self.waiters[key]
+
+    async def wait(self, key: Any, future: asyncio.Future, timeout: float) -> bool:
+        """True if `key` was notified within `timeout` seconds"""
+        self.metrics['waited'] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=max(timeout, 0))
+            self.metrics['woken'] += 1
+            return True
+        except asyncio.TimeoutError:
+            self.metrics['timed_out'] += 1
+            return False
+        finally:
+            self.discard(key, future)
+
+    def notify(self, key: Any) -> int:
+        """Wakes every waiter of `key`; returns how many were waiting"""
+        futures = self.waiters.pop(key, None)
+        if not futures:
+            return 0
+        self.size -= len(futures)
+        for future in futures:
+            if not future.done():
+                future.set_result(True)
+        return len(futures)
+
+    def stats(self) -> dict:
+        return {'waiting': self.size, 'keys': len(self.waiters), **self.metrics}
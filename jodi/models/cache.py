@@ -1,12 +1,34 @@
 import json, redis, datetime
-from jodi.config import CACHE_HOST, CACHE_PORT, CACHE_PASS, CACHE_DB, NODE_FQDN, LOG_BATCH_KEY
+import redis.asyncio as aioredis
+from contextlib import asynccontextmanager
+from jodi.config import CACHE_BACKEND, CACHE_HOST, CACHE_PORT, CACHE_PASS, CACHE_DB, CACHE_POOL_SIZE, NODE_FQDN, LOG_BATCH_KEY
+from jodi.models import memory_cache
 
+BACKEND_REDIS = 'redis'
+BACKEND_MEMORY = 'memory'
+
+# Blocking client for RQ workers, scripts and start-up code
 client = None
 
+# Asyncio client for request handlers, so cache round trips do not block the event loop
+aclient: aioredis.Redis = None
+
+# Asyncio client of Message Store records, returning bytes. With CACHE_BACKEND=memory it is the
+# in-process engine; logs, keys and certificates stay on Redis for the RQ workers and other processes.
+arecords: aioredis.Redis = None
+
 def set_client(cclient: redis.Redis = None):
     global client
     client = cclient
 
+def set_async_client(cclient: aioredis.Redis = None):
+    global aclient
+    aclient = cclient
+
+def set_async_records_client(cclient: aioredis.Redis = None):
+    global arecords
+    arecords = cclient
+
 def connect(decode_responses: bool = True):
     return redis.Redis(
         host=CACHE_HOST,
@@ -16,8 +38,28 @@ def connect(decode_responses: bool = True):
         decode_responses=decode_responses
     )
 
-def find(key: str, dtype = str):
-    data = client.get(key) or None
+def connect_async(decode_responses: bool = True, max_connections: int = CACHE_POOL_SIZE) -> aioredis.Redis:
+    """Asyncio client over a bounded connection pool; create it inside the server's event loop"""
+    return aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+        host=CACHE_HOST,
+        port=CACHE_PORT,
+        password=CACHE_PASS,
+        db=CACHE_DB,
+        decode_responses=decode_responses,
+        max_connections=max_connections
+    ))
+
+def uses_memory_records() -> bool:
+    return CACHE_BACKEND == BACKEND_MEMORY
+
+def connect_records_async():
+    """Client of the configured record backend. The memory backend is one engine per process."""
+    if uses_memory_records():
+        return memory_cache.AsyncMemoryCache(memory_cache.get_engine())
+    return connect_async(decode_responses=False)
+
+def parse(data, dtype = str):
+    data = data or None
 
     if data and dtype == int:
         return int(data)
@@ -27,8 +69,7 @@ def find(key: str, dtype = str):
     
     return data
 
-def find_all(keys: list, dtype = str):
-    data = client.mget(keys)
+def parse_all(data: list, dtype = str):
     if dtype == int:
         return [int(d) for d in data if d]
     if dtype == dict:
@@ -36,20 +77,40 @@ def find_all(keys: list, dtype = str):
     
     return data
 
+def find(key: str, dtype = str):
+    return parse(client.get(key), dtype)
+
+def find_all(keys: list, dtype = str):
+    return parse_all(client.mget(keys), dtype)
+
 def save(key: str, value: str):
     if type(value) != str:
         raise TypeError("Value must be a string")
     return client.set(key, value)
 
+def save_if_absent(key: str, value: str, seconds: int) -> bool:
+    return bool(client.set(key, value, ex=seconds, nx=True))
+
 def save_all(data: dict):
     return client.mset(data)
 
-def cache_for_seconds(key: str, value: str, seconds: int):
+def serialize(value) -> str:
+    if type(value) == bytes:
+        return value
     if type(value) == dict or type(value) == list:
         value = json.dumps(value)
     if type(value) != str:
         raise TypeError("Value must be a string")
-    return client.setex(key, seconds, value)
+    return value
+
+def cache_for_seconds(key: str, value: str, seconds: int, pipe = None):
+    return (pipe or client).setex(key, seconds, serialize(value))
+
+def stats() -> dict:
+    """Engine statistics of the memory record backend, None on Redis"""
+    if uses_memory_records():
+        return memory_cache.get_engine().stats()
+    return None
 
 def get_other_cpses(key):
     # print("Finding other CPSes except", key, flush=True)
@@ -64,6 +125,66 @@ def save_certificates(certificates: dict):
         save(key=key, value=cred['cert'])
         
         
-def enqueue_log(entry:dict):
+def pipeline(transaction: bool = False):
+    """Queues commands and sends them in one round trip on execute()"""
+    return client.pipeline(transaction=transaction)
+
+def create_log_record(entry: dict) -> str:
     entry['timestamp'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-    client.lpush(LOG_BATCH_KEY, json.dumps(entry))
+    return json.dumps(entry)
+
+def enqueue_log(entry:dict):
+    client.lpush(LOG_BATCH_KEY, create_log_record(entry))
+
+def enqueue_logs(entries: list, pipe = None):
+    if not entries:
+        return
+    (pipe or client).lpush(LOG_BATCH_KEY, *[create_log_record(entry) for entry in entries])
+
+# Asyncio counterparts of the above. Inside `apipeline()` pass `pipe` to queue a command
+# instead of sending it; the queued commands go out in one round trip when the block exits.
+
+async def afind(key: str, dtype = str):
+    return parse(await aclient.get(key), dtype)
+
+async def afind_all(keys: list, dtype = str):
+    return parse_all(await aclient.mget(keys), dtype)
+
+async def afind_record(key: str) -> bytes:
+    return await arecords.get(key)
+
+async def afind_records(keys: list) -> list:
+    return await arecords.mget(keys)
+
+async def acache_record(key: str, value: bytes, seconds: int, pipe = None):
+    """Stores a record; on Redis it is queued on `pipe` if given, the memory engine writes it at once"""
+    if pipe is not None and not uses_memory_records():
+        return pipe.setex(key, seconds, serialize(value))
+    return await arecords.setex(key, seconds, serialize(value))
+
+async def acache_for_seconds(key: str, value: str, seconds: int, pipe = None):
+    if pipe is not None:
+        return pipe.setex(key, seconds, serialize(value))
+    return await aclient.setex(key, seconds, serialize(value))
+
+async def aenqueue_log(entry: dict, pipe = None):
+    await aenqueue_logs([entry], pipe=pipe)
+
+async def aenqueue_logs(entries: list, pipe = None):
+    if not entries:
+        return
+    records = [create_log_record(entry) for entry in entries]
+    if pipe is not None:
+        pipe.lpush(LOG_BATCH_KEY, *records)
+    else:
+        await aclient.lpush(LOG_BATCH_KEY, *records)
+
+@asynccontextmanager
+async def apipeline(transaction: bool = False):
+    """
+    Yields an async pipeline and executes it when the block exits without error.
+    With `transaction`, the queued commands run as one MULTI/EXEC.
+    """
+    async with aclient.pipeline(transaction=transaction) as pipe:
+        yield pipe
+        await pipe.execute()
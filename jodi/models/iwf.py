@@ -1,59 +1,130 @@
 import time
+from functools import partial
 import jodi.config as config
-from jodi.helpers import misc, http
+from jodi.helpers import misc, http, dht, codec
+from jodi.helpers.deadline import Deadline
+from jodi.helpers.coalesce import MicroBatcher
 from typing import List
 from jodi.crypto import libjodi, groupsig, audit_logging
 from pylibjodi import Utils, Oprf
 import numpy as np
-from jodi.prototype.stirshaken import certs
 
-class JodiIWF:
-    def __init__(self, params: dict):
-        self.n_ev = params['n_ev']
-        self.n_ms = params['n_ms']
-        self.gpk = params['gpk']
-        self.gsk = params['gsk']
-        self.ipk = certs.get_public_key_from_cert(config.TEST_ICERT)
-        self.logger = params.get('logger')
-        self.metrics_logger = params.get('metrics_logger')
-        self.fake_proxy = params.get('fake_proxy', False)
-        self.bt = params['bt']
-        self.sim_overhead = []
-        
-        self.reset()
-        
-    def reset(self):
-        """Resets compute times which does not include wait times"""
+class CallTimings:
+    """Compute times of one call, excluding wait times"""
+    __slots__ = (
+        'publish_provider_time', 'retrieve_provider_time',
+        'publish_ev_time', 'retrieve_ev_time',
+        'publish_ms_time', 'retrieve_ms_time',
+        'sim_overhead',
+    )
+
+    def __init__(self):
         self.publish_provider_time = 0
         self.retrieve_provider_time = 0
-        
         self.publish_ev_time = 0
         self.retrieve_ev_time = 0
-        
         self.publish_ms_time = 0
         self.retrieve_ms_time = 0
-        
         self.sim_overhead = []
-        
-    async def jodi_generate_call_ids(self, src: str, dst: str, req_type: str) -> str:
+
+class CallContext:
+    """Per-call state: the billing token spent by the call, its deadline (if any) and its timings"""
+    __slots__ = ('bt', 'deadline', 'timings')
+
+    def __init__(self, bt: str, deadline: Deadline = None):
+        self.bt = bt
+        self.deadline = deadline
+        self.timings = CallTimings()
+
+    def phase(self, share: float = 1) -> Deadline:
+        """Deadline of the next protocol phase: `share` of the call's remaining budget"""
+        return self.deadline.slice(share) if self.deadline else None
+
+class JodiEngine:
+    """
+    Long-lived Jodi protocol engine. Holds what is shared by every call of a process
+    (group signature context, receipt key, membership view, batchers, loggers) and keeps
+    per-call state in a CallContext, so one engine serves any number of concurrent calls.
+    The HTTP session is the process-wide keep-alive session of `helpers.http`.
+    """
+    def __init__(self, params: dict):
+        self.n_ev = params['n_ev']
+        self.n_ms = params['n_ms']
+        self.gsc = params.get('gsc') or groupsig.GroupSigContext(gpk=params['gpk'], gsk=params['gsk'])
+        self.gpk = self.gsc.gpk
+        self.gsk = self.gsc.gsk
+        self.ipk = audit_logging.get_scheme().verification_key()
+        self.logger = params.get('logger')
+        self.metrics_logger = params.get('metrics_logger')
+        self.fake_proxy = params.get('fake_proxy', False)
+        self.batchers = params.get('batchers') or {}
+        self.membership = params.get('membership')
+        self.cid_cache = params.get('cid_cache')
+        self.key_directory = params.get('key_directory')
+        self.sessions = params.get('sessions')
+
+    def new_call(self, bt: str, deadline: Deadline = None) -> CallContext:
+        return CallContext(bt, deadline)
+
+    def get_evals(self) -> List[dict]:
+        return self.membership.get_evals() if self.membership else None
+
+    def get_stores(self) -> List[dict]:
+        return self.membership.get_stores() if self.membership else None
+
+    async def generate_call_ids(self, ctx: CallContext, src: str, dst: str, req_type: str) -> str:
+        timings = ctx.timings
         start_compute = time.perf_counter()
 
         self.log_msg(f'==================== CALL ID GENERATION')
         self.log_msg(f'--> This is call id generation for {req_type} request')
         call_details: str = libjodi.normalize_call_details(src=src, dst=dst)
         self.log_msg(f'--> Generates Call Details: {call_details}')
+        
+        if self.cid_cache:
+            call_ids = self.cid_cache.get(call_details, req_type)
+            if call_ids:
+                self.log_msg(f'==================== END CALL ID GENERATION (cached)')
+                return call_ids, {'compute_time': time.perf_counter() - start_compute, 'net_time': 0}
+        
+        phase = ctx.phase(config.CALL_DEADLINE_CID_SHARE)
+        threshold = self.get_ev_threshold()
+        pinned = False
+        # Pinned keys are resolved per evaluator, but a threshold race does not say who answered
+        if self.key_directory and not threshold:
+            evaluators = self.get_evals() or []
+            pinned = self.key_directory.is_pinned(evaluators)
+            if not pinned:
+                self.key_directory.schedule_refresh(evaluators, phase)
+        
         requests, mask, hreq = libjodi.create_evaluation_requests(
             call_details, 
             n_ev=self.n_ev, 
-            gsk=self.gsk, 
-            gpk=self.gpk,
-            bt=self.bt
+            gsc=self.gsc,
+            bt=ctx.bt,
+            sign=not (self.is_batched('evaluate') or self.uses_sessions('evaluate')),
+            evaluators=self.get_evals(),
+            req_type=req_type,
+            pinned=pinned
         )
+        if self.uses_sessions('evaluate'):
+            await self.sessions.authenticate(requests)
         self.log_msg(f'--> Created Requests for the Following EVs: {[r["nodeId"]+":::"+str(r["data"]["i_k"]) for r in requests]}')
         
+        # A threshold retrieve verifies receipts as they arrive and stops on the first `threshold` valid ones
+        accepted, verify_time = set(), [0]
+        def accept(response: dict) -> bool:
+            start = time.perf_counter()
+            valid = self.is_valid_evaluation(hreq, response)
+            verify_time[0] += time.perf_counter() - start
+            if valid:
+                accepted.add(id(response))
+            return valid
+        
         end_compute = time.perf_counter()
-        responses = await self.make_request('evaluate', requests=requests)
-        req_time_taken = time.perf_counter() - end_compute
+        race = accept if threshold and req_type == 'retrieve' else None
+        responses = await self.make_request('evaluate', requests=requests, accept=race, phase=phase)
+        req_time_taken = time.perf_counter() - end_compute - verify_time[0]
         
         self.log_msg(f'--> Responses from Evaluators: {responses}')
         
@@ -72,36 +143,51 @@ class JodiIWF:
             pass
         
         if req_type == 'publish':
-            self.publish_ev_time = ev_avg_time
-            self.publish_provider_time -= req_time_taken # Subtract wait time from compute time
-            self.publish_provider_time -= sim_ovrhd # Subtract simulation overhead
+            timings.publish_ev_time = ev_avg_time
+            timings.publish_provider_time -= req_time_taken # Subtract wait time from compute time
+            timings.publish_provider_time -= sim_ovrhd # Subtract simulation overhead
         if req_type == 'retrieve':
-            self.retrieve_ev_time = ev_avg_time
-            self.retrieve_provider_time -= req_time_taken # Subtract wait time from compute time
-            self.retrieve_provider_time -= sim_ovrhd # Subtract simulation overhead
+            timings.retrieve_ev_time = ev_avg_time
+            timings.retrieve_provider_time -= req_time_taken # Subtract wait time from compute time
+            timings.retrieve_provider_time -= sim_ovrhd # Subtract simulation overhead
             
-        self.sim_overhead.append(sim_ovrhd)
+        timings.sim_overhead.append(sim_ovrhd)
         
-        compute_time = end_compute - start_compute
+        compute_time = end_compute - start_compute + verify_time[0]
         net_time = req_time_taken
         
         start_compute = time.perf_counter()
         self.log_msg(f"--> Validating EV Responses")
         
         valid_responses = []
-        for response in responses:
-            hres = Utils.to_base64(Utils.hash256(bytes(misc.stringify(response['evals']), 'utf-8')))
-            if audit_logging.ecdsa_verify(public_key=self.ipk, data=hreq+hres, sigma=response['sig_r']):
-                valid_responses.append(response['evals'])
+        for req, response in zip(requests, responses):
+            if id(response) not in accepted and not self.is_valid_evaluation(hreq, response):
+                continue
+            evals = self.key_directory.expand(libjodi.get_evaluator_url(req), response['evals'], req['data']['i_k']) if pinned else response['evals']
+            if evals:
+                valid_responses.append(evals)
                 
         self.log_msg(f'--> Valid Responses: {valid_responses}')
         
-        call_ids = libjodi.create_call_ids(
-            responses=valid_responses, 
-            mask=mask, 
-            req_type=req_type,
-            call_details=call_details
-        )
+        if not threshold:
+            call_ids = libjodi.create_call_ids(
+                responses=valid_responses, 
+                mask=mask, 
+                req_type=req_type,
+                call_details=call_details
+            )
+            complete = self.n_ev
+        elif req_type == 'publish':
+            call_ids = libjodi.create_threshold_call_ids(valid_responses, mask, req_type, call_details, threshold)
+            complete = self.n_ev
+        else:
+            valid_responses = valid_responses[:threshold]
+            call_ids = libjodi.create_threshold_call_ids(valid_responses, mask, req_type, call_details, threshold)
+            complete = threshold
+        
+        # Only complete answers are cached; a partial XOR would not match the other side's call ID
+        if self.cid_cache and call_ids and len(valid_responses) == complete:
+            self.cid_cache.put(call_details, req_type, call_ids)
         
         compute_time += time.perf_counter() - start_compute
         
@@ -119,9 +205,9 @@ class JodiIWF:
         
         return call_ids, runtime
     
-    async def jodi_publish(self, src, dst, token):
+    async def publish_call(self, ctx: CallContext, src, dst, token):
         self.log_msg(f'===== START PUBLISH PROTOCOL =====')
-        call_ids, cid_runtime = await self.jodi_generate_call_ids(src=src, dst=dst, req_type='publish')
+        call_ids, cid_runtime = await self.generate_call_ids(ctx, src=src, dst=dst, req_type='publish')
         
         if not call_ids:
             self.log_msg(f'===== END PUBLISH because no call id generated =====')
@@ -129,28 +215,38 @@ class JodiIWF:
         
         start_compute = time.perf_counter()
         
-        reqs = libjodi.create_storage_requests(
-            call_id=call_ids[0], # Only publish the recent call ID
-            msg=token,
-            n_ms=self.n_ms,
-            gsk=self.gsk,
-            gpk=self.gpk,
-            bt=self.bt
-        )
+        # Only publish the recent call ID, or under EV_THRESHOLD the one of every evaluator subset
+        reqs = []
+        for call_id in (call_ids if self.get_ev_threshold() else call_ids[:1]):
+            reqs.extend(libjodi.create_storage_requests(
+                call_id=call_id,
+                msg=token,
+                n_ms=self.n_ms,
+                gsc=self.gsc,
+                bt=ctx.bt,
+                stores=self.get_stores()
+            ))
+        # Records keep the publisher's group signature since retrievers verify it end-to-end
+        if self.uses_sessions('publish'):
+            await self.sessions.authenticate(reqs, keep_sig=True)
         self.log_msg(f'--> Created Requests for the Following MSs: {[r["nodeId"] for r in reqs]}')
         
         end_compute = time.perf_counter()
-        responses = await self.make_request('publish', requests=reqs)
+        responses = await self.make_request('publish', requests=reqs, phase=ctx.phase())
         req_time_taken = time.perf_counter() - end_compute
         self.log_msg(f'--> Responses From MS: {responses}')
         
+        if ctx.deadline and ctx.deadline.expired() and all('_error' in res for res in responses):
+            self.log_msg(f'===== END PUBLISH because the call deadline passed =====')
+            return {'_error': 'Deadline exceeded'}
+        
         try:
             sim_ovrhd = time.perf_counter()
             # Subtract wait time from compute time
-            self.publish_provider_time -= req_time_taken
+            ctx.timings.publish_provider_time -= req_time_taken
             # Average time taken to store a message by a single store
-            self.publish_ms_time = np.mean([res.get('time_taken', 0) for res in responses])
-            self.sim_overhead.append(time.perf_counter() - sim_ovrhd)
+            ctx.timings.publish_ms_time = np.mean([res.get('time_taken', 0) for res in responses])
+            ctx.timings.sim_overhead.append(time.perf_counter() - sim_ovrhd)
         except:
             pass
         self.log_msg(f'===== END PUBLISH PROTOCOL =====\n')
@@ -161,9 +257,9 @@ class JodiIWF:
         
         return {'_success': 'message published'}
 
-    async def jodi_retrieve(self, src: str, dst: str) -> str:
+    async def retrieve_call(self, ctx: CallContext, src: str, dst: str) -> str:
         self.log_msg(f'===== START RETRIEVE PROTOCOL =====')
-        call_ids, cid_runtime = await self.jodi_generate_call_ids(src=src, dst=dst, req_type='retrieve')
+        call_ids, cid_runtime = await self.generate_call_ids(ctx, src=src, dst=dst, req_type='retrieve')
         
         if not call_ids:
             self.log_msg(f'===== END RETRIEVE PROTOCOL because no call id generated =====')
@@ -173,29 +269,52 @@ class JodiIWF:
         requests = libjodi.create_retrieve_requests(
             call_ids=call_ids, 
             n_ms=self.n_ms, 
-            gsk=self.gsk, 
-            gpk=self.gpk,
-            bt=self.bt
+            gsc=self.gsc,
+            bt=ctx.bt,
+            sign=not (self.is_batched('retrieve') or self.uses_sessions('retrieve')),
+            stores=self.get_stores()
         )
+        phase = ctx.phase()
+        wait_ms = self.get_retrieve_wait_ms(phase)
+        if wait_ms:
+            for req in requests:
+                req['data']['wait_ms'] = wait_ms
+        if self.uses_sessions('retrieve'):
+            await self.sessions.authenticate(requests)
         # self.log_msg(f'--> Retrieve Requests: {requests}')
         self.log_msg(f'--> Created Retrieve Requests for the Following MSs: {[r["nodeId"] for r in requests]}')
         
+        # The race goes on until a response passes the full verify-and-decrypt check
+        call_id_map, found, verify_time = libjodi.get_call_id_map(call_ids), {}, [0]
+        def accept(response: dict) -> bool:
+            start = time.perf_counter()
+            msg = libjodi.decrypt_response(call_id_map, response, self.gsc, self.ipk)
+            verify_time[0] += time.perf_counter() - start
+            if msg:
+                found['token'] = msg
+            return msg is not None
+        
         end_compute = time.perf_counter()
-        responses = await self.make_request('retrieve', requests=requests)
-        req_time_taken = time.perf_counter() - end_compute
+        # With several candidate call IDs, the stores of the most likely one are asked first
+        initial = len(requests) // len(call_ids) if len(call_ids) > 1 else None
+        responses = await self.make_request('retrieve', requests=requests, accept=accept, initial=initial, phase=phase)
+        req_time_taken = time.perf_counter() - end_compute - verify_time[0]
         self.log_msg(f'--> Responses from Stores: {responses}')
         
-        self.retrieve_provider_time -= req_time_taken # Subtract wait time from compute time
+        ctx.timings.retrieve_provider_time -= req_time_taken # Subtract wait time from compute time
         
-        self.retrieve_ms_time = np.mean([res.get('time_taken', 0) for res in responses]) # Average time taken to store a message by a single store
+        ctx.timings.retrieve_ms_time = np.mean([res.get('time_taken', 0) for res in responses]) # Average time taken to store a message by a single store
         
-        compute_time = cid_runtime['compute_time'] + (end_compute - start_compute)
+        compute_time = cid_runtime['compute_time'] + (end_compute - start_compute) + verify_time[0]
         net_time = cid_runtime['net_time'] + req_time_taken
         
         # self.log_msg(f"\n--> Filtered Responses: {responses}")
         # self.log_msg(f"--> Call IDs: {call_ids}\n")
         start_compute = time.perf_counter()
-        token = libjodi.decrypt(call_ids=call_ids, responses=responses, gpk=self.gpk, ipk=self.ipk)
+        token = found.get('token')
+        if token is None:
+            # Nothing was accepted, or the fan-out never called `accept` (the fake proxy, simulators)
+            token = libjodi.decrypt(call_ids=call_ids, responses=responses, gsc=self.gsc, ipk=self.ipk)
         compute_time += time.perf_counter() - start_compute
         
         self.log_msg(f'--> Retrieved Token: {token}')
@@ -205,7 +324,13 @@ class JodiIWF:
         
         return token
     
-    async def make_request(self, req_type: str, requests: List[dict]):
+    def is_valid_evaluation(self, hreq: str, response: dict) -> bool:
+        if '_error' in response or 'sig_r' not in response:
+            return False
+        hres = Utils.to_base64(Utils.hash256(codec.canonical(response['evals'])))
+        return audit_logging.verify_receipt(public_key=self.ipk, hreq=hreq, hres=hres, receipt=response)
+    
+    async def make_request(self, req_type: str, requests: List[dict], accept=None, initial: int = None, phase: Deadline = None):
         if self.fake_proxy:
             return await make_fake_request(
                 req_type=req_type, 
@@ -213,11 +338,97 @@ class JodiIWF:
                 gsk=self.gsk,
                 gpk=self.gpk
             )
+        
+        # Nodes get the phase's remaining budget and drop requests that are already late;
+        # the fan-out itself is cancelled when the phase runs out
+        for req in requests:
+            req['deadline'] = phase
+            req['content_type'] = config.WIRE_FORMAT
+        return await http.within(phase, self.fan_out(req_type, requests, accept, initial), default=[{'_error': 'Deadline exceeded'}])
+    
+    async def fan_out(self, req_type: str, requests: List[dict], accept=None, initial: int = None):
+        batcher = self.batchers.get(req_type)
+        if req_type == 'evaluate' and accept:
+            # Every evaluator is asked at once; the race ends on the first EV_THRESHOLD valid answers
+            return await http.posts_race(reqs=requests, batcher=batcher, accept=accept, initial=len(requests), k=self.get_ev_threshold())
+        elif req_type == 'retrieve':
+            hedge_ms = config.RETRIEVE_HEDGE_MS or (config.RETRIEVE_CANDIDATE_HEDGE_MS if initial else 0)
+            return await http.posts_race(
+                reqs=requests, 
+                batcher=batcher, 
+                accept=accept, 
+                hedge_ms=hedge_ms, 
+                initial=initial or config.RETRIEVE_INITIAL_FANOUT
+            )
         else:
-            if req_type == 'retrieve':
-                return await http.posts_race(reqs=requests)
-            else:
-                return await http.posts(reqs=requests)
+            return await http.posts(reqs=requests, batcher=batcher)
+            
+    def get_ev_threshold(self) -> int:
+        """Evaluators a call ID is made of under EV_THRESHOLD, or 0 when it takes all n_ev"""
+        threshold = config.EV_THRESHOLD
+        return threshold if 0 < threshold < int(self.n_ev) else 0
+
+    def get_retrieve_wait_ms(self, phase: Deadline = None) -> int:
+        """How long stores may hold a retrieve open for a record that is not yet published"""
+        if not config.RETRIEVE_WAIT_MS or self.fake_proxy or self.is_batched('retrieve'):
+            return 0
+        # Stores must answer before the phase ends and before the proxy's HTTP timeout
+        wait_ms = min(config.RETRIEVE_WAIT_MS, config.HTTP_TIMEOUT_SECONDS * 1000 / 2)
+        if phase:
+            wait_ms = min(wait_ms, phase.remaining() * 1000)
+        return int(wait_ms)
+
+    def is_batched(self, req_type: str) -> bool:
+        return not self.fake_proxy and req_type in self.batchers
+    
+    def uses_sessions(self, req_type: str) -> bool:
+        # Batches already amortize the group signature over their items
+        return self.sessions is not None and not self.fake_proxy and not self.is_batched(req_type)
+    
+    def log_msg(self, msg):
+        if config.DEBUG and self.logger:
+            self.logger.debug(msg)
+
+    def log_metric(self, metric: str):
+        if self.metrics_logger:
+            self.metrics_logger.info(metric)
+
+def _timing(name: str):
+    return property(
+        lambda self: getattr(self.ctx.timings, name),
+        lambda self, value: setattr(self.ctx.timings, name, value),
+    )
+
+class JodiIWF(JodiEngine):
+    """
+    Single-call view of a JodiEngine used by the simulated providers: it owns one
+    CallContext and exposes its timings as attributes.
+    """
+    publish_provider_time = _timing('publish_provider_time')
+    retrieve_provider_time = _timing('retrieve_provider_time')
+    publish_ev_time = _timing('publish_ev_time')
+    retrieve_ev_time = _timing('retrieve_ev_time')
+    publish_ms_time = _timing('publish_ms_time')
+    retrieve_ms_time = _timing('retrieve_ms_time')
+    sim_overhead = _timing('sim_overhead')
+
+    def __init__(self, params: dict):
+        JodiEngine.__init__(self, params)
+        self.bt = params['bt']
+        self.ctx = self.new_call(self.bt)
+        
+    def reset(self):
+        """Resets compute times which does not include wait times"""
+        self.ctx.timings = CallTimings()
+        
+    async def jodi_generate_call_ids(self, src: str, dst: str, req_type: str) -> str:
+        return await self.generate_call_ids(self.ctx, src=src, dst=dst, req_type=req_type)
+    
+    async def jodi_publish(self, src, dst, token):
+        return await self.publish_call(self.ctx, src=src, dst=dst, token=token)
+
+    async def jodi_retrieve(self, src: str, dst: str) -> str:
+        return await self.retrieve_call(self.ctx, src=src, dst=dst)
     
     def get_publish_compute_times(self):
         return {
@@ -238,14 +449,30 @@ class JodiIWF:
             self.publish_provider_time + self.publish_ev_time + self.publish_ms_time +
             self.retrieve_provider_time + self.retrieve_ev_time + self.retrieve_ms_time
         )
-    
-    def log_msg(self, msg):
-        if config.DEBUG and self.logger:
-            self.logger.debug(msg)
+            
+def create_batchers(gsc: groupsig.GroupSigContext, window_ms: float = None, max_size: int = None) -> dict:
+    """Process-wide micro-batchers, one per protocol phase, shared by every call of a proxy"""
+    window_ms = config.BATCH_WINDOW_MS if window_ms is None else window_ms
+    max_size = config.BATCH_MAX_SIZE if max_size is None else max_size
+    return {
+        'evaluate': MicroBatcher(flush=partial(flush_evaluations, gsc=gsc), window_ms=window_ms, max_size=max_size),
+        'publish': MicroBatcher(flush=flush_publications, window_ms=window_ms, max_size=max_size),
+        'retrieve': MicroBatcher(flush=partial(flush_retrievals, gsc=gsc), window_ms=window_ms, max_size=max_size),
+    }
 
-    def log_metric(self, metric: str):
-        if self.metrics_logger:
-            self.metrics_logger.info(metric)
+async def flush_evaluations(url: str, requests: List[dict], gsc: groupsig.GroupSigContext) -> List[dict]:
+    data, hreqs = libjodi.create_evaluation_batch(requests, gsc=gsc)
+    response = await http.post(url=url + '/batch', data=data, content_type=config.WIRE_FORMAT)
+    return libjodi.split_evaluation_batch(response, hreqs)
+
+async def flush_publications(url: str, requests: List[dict]) -> List[dict]:
+    response = await http.post(url=url + '/batch', data=libjodi.create_publish_batch(requests), content_type=config.WIRE_FORMAT)
+    return libjodi.split_publish_batch(response, requests)
+
+async def flush_retrievals(url: str, requests: List[dict], gsc: groupsig.GroupSigContext) -> List[dict]:
+    data, hreqs = libjodi.create_retrieve_batch(requests, gsc=gsc)
+    response = await http.post(url=url + '/batch', data=data, content_type=config.WIRE_FORMAT)
+    return libjodi.split_retrieve_batch(response, hreqs)
             
 async def make_fake_request(req_type: str, requests: List[dict], gsk: str, gpk: str):
     if req_type == 'evaluate':
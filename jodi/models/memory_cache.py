@@ -0,0 +1,274 @@
+import threading, time
+from typing import Dict, List
+
+from jodi import config
+
+# Rough per-entry overhead of the dicts and bookkeeping, added to key and value sizes
+ENTRY_OVERHEAD = 96
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel. Level 0 has `slots` buckets of one tick each and every further
+    level covers `slots` times the span of the level below. An entry sits in the coarsest
+    level that fits its delay and cascades down as its bucket comes due, so scheduling and
+    expiry are O(1) per entry. Entries beyond the top level wait in an overflow list.
+    """
+    def __init__(self, tick: float, slots: int = 64, levels: int = 4, now: float = None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.origin = time.monotonic() if now is None else now
+        self.current = 0 # ticks elapsed since origin
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []
+        self.size = 0
+
+    def to_tick(self, at: float) -> int:
+        return int((at - self.origin) / self.tick)
+
+    def schedule(self, key, at: float):
+        self.size += 1
+        self._place(key, max(self.to_tick(at), self.current + 1))
+
+    def _place(self, key, due: int):
+        delta = due - self.current
+        for level in range(self.levels):
+            span = self.slots ** (level + 1)
+            if delta < span:
+                self.wheels[level][(due // self.slots ** level) % self.slots].append((key, due))
+                return
+        self.overflow.append((key, due))
+
+    def advance(self, now: float) -> List:
+        """Moves the wheel to `now` and returns the keys that came due"""
+        target = self.to_tick(now)
+        due = []
+        if self.size == 0:
+            self.current = max(self.current, target)
+            return due
+
+        while self.current < target and self.size:
+            self.current += 1
+            # Coarser levels cascade first so their entries can land in the finer buckets due now
+            top = 0
+            while top + 1 < self.levels and self.current % self.slots ** (top + 1) == 0:
+                top += 1
+            if top == self.levels - 1 and self.current % self.slots ** self.levels == 0:
+                entries, self.overflow = self.overflow, []
+                for (key, at) in entries:
+                    self._place(key, at)
+            for level in range(top, 0, -1):
+                self._cascade(self.wheels[level], (self.current // self.slots ** level) % self.slots)
+
+            bucket = self.wheels[0][self.current % self.slots]
+            self.wheels[0][self.current % self.slots] = []
+            for (key, _) in bucket:
+                due.append(key)
+            self.size -= len(bucket)
+
+        self.current = max(self.current, target)
+        return due
+
+    def _cascade(self, wheel: list, slot: int):
+        entries, wheel[slot] = wheel[slot], []
+        for (key, at) in entries:
+            self._place(key, at)
+
+def sizeof(key: str, value) -> int:
+    return len(key) + len(value) + ENTRY_OVERHEAD
+
+class Shard:
+    """One lock, one dict in insertion (eviction) order and one timing wheel"""
+    def __init__(self, max_bytes: int, tick: float):
+        self.lock = threading.Lock()
+        self.data: Dict[str, object] = {}
+        self.expires: Dict[str, float] = {}
+        self.wheel = TimingWheel(tick=tick)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def expire(self, now: float):
+        for key in self.wheel.advance(now):
+            at = self.expires.get(key)
+            # Keys overwritten with a later expiry are still in the wheel under their old tick
+            if at is not None and at <= now:
+                self.remove(key)
+                self.expired += 1
+
+    def lookup(self, key: str, now: float):
+        at = self.expires.get(key)
+        if at is not None and at <= now:
+            self.remove(key)
+            self.expired += 1
+            return None
+        return self.data.get(key)
+
+    def store(self, key: str, value, ttl: float, now: float):
+        self.remove(key)
+        self.data[key] = value
+        self.bytes += sizeof(key, value)
+        if ttl is not None:
+            self.expires[key] = now + ttl
+            self.wheel.schedule(key, now + ttl)
+        self.evict(keep=key)
+
+    def remove(self, key: str) -> bool:
+        if key not in self.data:
+            return False
+        self.bytes -= sizeof(key, self.data.pop(key))
+        self.expires.pop(key, None)
+        return True
+
+    def evict(self, keep: str = None):
+        # Oldest writes go first; with one TTL for all records that is also the earliest to expire
+        while self.bytes > self.max_bytes and len(self.data) > 1:
+            key = next(iter(self.data))
+            if key == keep:
+                break
+            self.remove(key)
+            self.evicted += 1
+
+class MemoryCache:
+    """
+    In-process cache engine with the subset of the redis client API used by `jodi.models.cache`
+    (get, mget, set, setex, mset, delete, pipeline). Keys are spread over sharded dicts, expiry
+    is driven by a hierarchical timing wheel per shard and total memory is capped at `max_bytes`;
+    writes past the cap evict the oldest entries of their shard. It only holds Message Store
+    records, and its state is per process, so it suits Message Stores running as a single process.
+    """
+    def __init__(self, shards: int = None, max_bytes: int = None, tick_ms: float = None):
+        shards = shards or config.MEMORY_CACHE_SHARDS
+        max_bytes = max_bytes or config.MEMORY_CACHE_MAX_BYTES
+        tick = (tick_ms or config.MEMORY_CACHE_TICK_MS) / 1000
+        self.shards = [Shard(max_bytes // shards, tick) for _ in range(shards)]
+        self.hits = 0
+        self.misses = 0
+
+    def shard(self, key: str) -> Shard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key: str):
+        shard, now = self.shard(key), time.monotonic()
+        with shard.lock:
+            shard.expire(now)
+            value = shard.lookup(key, now)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def mget(self, keys: List[str]) -> list:
+        return [self.get(key) for key in keys]
+
+    def set(self, key: str, value, ex: int = None, nx: bool = False) -> bool:
+        shard, now = self.shard(key), time.monotonic()
+        with shard.lock:
+            shard.expire(now)
+            if nx and shard.lookup(key, now) is not None:
+                return None
+            shard.store(key, value, ex, now)
+        return True
+
+    def setex(self, key: str, seconds: int, value) -> bool:
+        return self.set(key, value, ex=seconds)
+
+    def mset(self, mapping: dict) -> bool:
+        for key, value in mapping.items():
+            self.set(key, value)
+        return True
+
+    def delete(self, *keys) -> int:
+        removed = 0
+        for key in keys:
+            shard = self.shard(key)
+            with shard.lock:
+                removed += shard.remove(key)
+        return removed
+
+    def pipeline(self, transaction: bool = False) -> 'MemoryPipeline':
+        return MemoryPipeline(self)
+
+    def expire(self):
+        """Drops every entry whose TTL has passed"""
+        now = time.monotonic()
+        for shard in self.shards:
+            with shard.lock:
+                shard.expire(now)
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            'keys': sum(len(shard.data) for shard in self.shards),
+            'bytes': sum(shard.bytes for shard in self.shards),
+            'max_bytes': sum(shard.max_bytes for shard in self.shards),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': sum(shard.expired for shard in self.shards),
+            'evicted': sum(shard.evicted for shard in self.shards),
+        }
+
+class MemoryPipeline:
+    """Queues commands and runs them on execute(). Commands run back to back, not atomically across shards."""
+    def __init__(self, engine: MemoryCache):
+        self.engine = engine
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        method = getattr(self.engine, name)
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self) -> list:
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for (method, args, kwargs) in commands]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.commands = []
+
+class AsyncMemoryCache:
+    """Asyncio facade of a MemoryCache matching the redis.asyncio client API used by `jodi.models.cache`"""
+    def __init__(self, engine: MemoryCache):
+        self.engine = engine
+
+    def __getattr__(self, name: str):
+        method = getattr(self.engine, name)
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction: bool = False) -> 'AsyncMemoryPipeline':
+        return AsyncMemoryPipeline(self.engine)
+
+    async def aclose(self):
+        self.engine.close()
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def execute(self) -> list:
+        return MemoryPipeline.execute(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.commands = []
+
+engine: MemoryCache = None
+lock = threading.Lock()
+
+def get_engine() -> MemoryCache:
+    """The process-wide engine, shared by the sync and asyncio clients"""
+    global engine
+    with lock:
+        if engine is None:
+            engine = MemoryCache()
+    return engine
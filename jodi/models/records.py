@@ -0,0 +1,101 @@
+import base64, binascii, struct
+from typing import NamedTuple
+
+# Message Store record layout (version 1):
+#   version (1 byte) | flags (1 byte) | 4 field lengths (2 bytes each) | c_0 | c_1 | sig | bb
+# The header has a fixed size, so a record is parsed with one unpack and four slices. The idx
+# is the record key and is not repeated. Fields are raw bytes, or UTF-8 text when they were not
+# canonical base64; flag bit i marks field i as text.
+VERSION = 1
+HEADER = struct.Struct('>BBHHHH')
+MAX_FIELD_BYTES = 0xffff
+
+FIELDS = ('c_0', 'c_1', 'sig', 'bb')
+
+class Record(NamedTuple):
+    """Parsed record. Fields are memoryviews into the stored buffer, not copies."""
+    c_0: memoryview
+    c_1: memoryview
+    sig: memoryview
+    bb: memoryview
+    flags: int
+
+    def text(self, field: str) -> str:
+        """A field in the base64 text form used on the wire and in receipts"""
+        i = FIELDS.index(field)
+        return _to_text(self[i], self.flags & (1 << i))
+
+    def ctx(self) -> str:
+        return self.text('c_0') + ':' + self.text('c_1')
+
+def _to_text(value: memoryview, is_text: int) -> str:
+    if is_text:
+        return str(value, 'utf-8')
+    return binascii.b2a_base64(value, newline=False).decode('ascii')
+
+def _to_bytes(value: str):
+    """Raw bytes of a canonical base64 string, or None if it does not round-trip"""
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return raw if base64.b64encode(raw).decode('utf-8') == value else None
+
+def encode(ctx: str, sig: str, bb: str) -> bytes:
+    c_0, c_1 = ctx.split(':')
+    flags, fields = 0, []
+    for i, value in enumerate((c_0, c_1, sig, bb)):
+        raw = _to_bytes(value)
+        if raw is None:
+            raw = value.encode('utf-8')
+            flags |= 1 << i
+        if len(raw) > MAX_FIELD_BYTES:
+            raise ValueError(f'Record field {FIELDS[i]} is longer than {MAX_FIELD_BYTES} bytes')
+        fields.append(raw)
+    return HEADER.pack(VERSION, flags, *[len(raw) for raw in fields]) + b''.join(fields)
+
+def _slices(buf):
+    (version, flags, n_0, n_1, n_2, n_3) = HEADER.unpack_from(buf)
+    if version != VERSION:
+        raise ValueError(f'Unsupported record version {version}')
+    view = memoryview(buf)
+    a = HEADER.size
+    b = a + n_0
+    c = b + n_1
+    d = c + n_2
+    return view[a:b], view[b:c], view[c:d], view[d:d + n_3], flags
+
+def decode(buf: bytes) -> Record:
+    return Record(*_slices(buf))
+
+def encode_text(idx: str, ctx: str, sig: str, bb: str) -> bytes:
+    """Original text layout, kept for comparison and for MS_RECORD_FORMAT=text"""
+    return (idx + '.' + ctx + '.' + sig + '.' + bb).encode('utf-8')
+
+def is_binary(buf) -> bool:
+    # Text records start with a base64 character, never with a version byte
+    return isinstance(buf, (bytes, bytearray, memoryview)) and len(buf) > 0 and buf[0] == VERSION
+
+def to_response(idx: str, buf) -> dict:
+    """The retrieve response fields {idx, ctx, sig, bb} of a stored record in either layout"""
+    if is_binary(buf):
+        c_0, c_1, sig, bb, flags = _slices(buf)
+        if not flags:
+            # Usual case, every field raw: encode to bytes and decode each string to ASCII once
+            b64 = binascii.b2a_base64
+            return {
+                "idx": idx,
+                "ctx": (b64(c_0, newline=False) + b':' + b64(c_1, newline=False)).decode('ascii'),
+                "sig": b64(sig, newline=False).decode('ascii'),
+                'bb': b64(bb, newline=False).decode('ascii'),
+            }
+        return {
+            "idx": idx,
+            "ctx": _to_text(c_0, flags & 1) + ':' + _to_text(c_1, flags & 2),
+            "sig": _to_text(sig, flags & 4),
+            'bb': _to_text(bb, flags & 8),
+        }
+    if not isinstance(buf, str):
+        buf = str(buf, 'utf-8')
+    (idx, ctx, sig, bill_h) = buf.split('.')
+    return {"idx": idx, "ctx": ctx, "sig": sig, 'bb': bill_h}
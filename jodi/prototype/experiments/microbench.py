@@ -7,7 +7,7 @@ from jodi.models import cache
 from multiprocessing import Pool
 from jodi.prototype import provider as providerMod
 from jodi.prototype.simulations import entities, local
-from jodi.prototype.stirshaken import stirsetup, certs
+from jodi.prototype.stirshaken import stirsetup
 
 
 numIters = 1000
@@ -16,13 +16,11 @@ gpk = groupsig.get_gpk()
 gsk = groupsig.get_gsk()
 n_evs = [3]
 n_mss = [3]
-isk = certs.get_private_key(config.TEST_ISK)
 cred, allcreds = stirsetup.load_certs()
 
 def init_worker():
     cache.set_client(cache_client)
     entities.set_evaluator_keys(cache.find(key=config.EVAL_KEYSETS_KEY, dtype=dict))
-    entities.set_isk(isk)
 
 def bench_sync(options):
     return asyncio.run(bench_async(options))
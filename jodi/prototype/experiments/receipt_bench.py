@@ -0,0 +1,51 @@
+import os, time, argparse
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from jodi.helpers import files, misc
+from jodi.crypto import audit_logging
+
+numIters = 5000
+
+def get_keys(name: str, scheme: audit_logging.ReceiptScheme):
+    """Configured keys of ECDSA; throwaway keys of the schemes that need their own"""
+    if name == audit_logging.SCHEME_ED25519:
+        sk = ed25519.Ed25519PrivateKey.generate()
+        return sk, sk.public_key()
+    if name == audit_logging.SCHEME_HMAC_SESSION:
+        key = os.urandom(32)
+        return key, key
+    return scheme.signing_key(), scheme.verification_key()
+
+def bench_scheme(name: str, iters: int) -> list:
+    scheme = audit_logging.get_scheme(name)
+    sk, vk = get_keys(name, scheme)
+    payloads = [misc.stringify({'hreq': f'request-{i}', 'hres': f'response-{i}'}) for i in range(iters)]
+
+    start = time.perf_counter()
+    sigmas = [scheme.sign(sk, data) for data in payloads]
+    sign_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for data, sigma in zip(payloads, sigmas):
+        assert scheme.verify(vk, data, sigma), f'{name} failed to verify its own signature'
+    verify_time = time.perf_counter() - start
+
+    return [name, iters, round(iters / sign_time), round(iters / verify_time)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Receipt signature scheme benchmark')
+    parser.add_argument('--iters', type=int, default=numIters)
+    args = parser.parse_args()
+
+    resutlsloc = f"{os.path.dirname(os.path.abspath(__file__))}/results/receipt-schemes.csv"
+    files.write_csv(resutlsloc, [['scheme', 'iters', 'sign_ops_per_sec', 'verify_ops_per_sec']])
+
+    print(f"Running {args.iters} sign/verify iterations per receipt scheme...")
+    results = [bench_scheme(name, args.iters) for name in audit_logging.SCHEMES]
+    for row in results:
+        print(f"{row[0]:>14}: sign {row[2]} ops/s, verify {row[3]} ops/s")
+    files.append_csv(resutlsloc, results)
+    print(f"Results have been saved to {resutlsloc}.")
+
+if __name__ == '__main__':
+    main()
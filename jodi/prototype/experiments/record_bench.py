@@ -0,0 +1,98 @@
+import os, time, base64, hashlib, argparse
+
+from jodi import config
+from jodi.helpers import files, codec
+from jodi.models import cache, records, memory_cache
+
+numRecords = 10000
+
+# Field sizes in raw bytes: idx and bb are SHA-256 digests, c_0 is 32 random bytes and c_1 the
+# encrypted PASSporT (nonce and tag included). BBS04 signatures exported by pygroupsig are 373 bytes.
+IDX_BYTES = 32
+C0_BYTES = 32
+PASSPORT_BYTES = 480
+CIPHER_OVERHEAD = 28
+SIG_BYTES = 373
+
+def b64(n: int) -> str:
+    return base64.b64encode(os.urandom(n)).decode('utf-8')
+
+def create_fields(n: int, passport_bytes: int, sig_bytes: int) -> list:
+    return [
+        (b64(IDX_BYTES), b64(C0_BYTES) + ':' + b64(passport_bytes + CIPHER_OVERHEAD), b64(sig_bytes), b64(32))
+        for _ in range(n)
+    ]
+
+def encode_all(layout: str, fields: list) -> list:
+    if layout == 'text':
+        return [records.encode_text(idx, ctx, sig, bb) for (idx, ctx, sig, bb) in fields]
+    return [records.encode(ctx, sig, bb) for (_, ctx, sig, bb) in fields]
+
+def redis_bytes(keys: list, values: list) -> int:
+    client = cache.connect(decode_responses=False)
+    with client.pipeline(transaction=False) as pipe:
+        for key, value in zip(keys, values):
+            pipe.setex(key, 60, value)
+        pipe.execute()
+    with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.memory_usage(key, samples=0)
+        used = sum(pipe.execute())
+    client.delete(*keys)
+    return used
+
+def bench_layout(layout: str, fields: list, use_redis: bool) -> list:
+    n = len(fields)
+    values = encode_all(layout, fields)
+    keys = [f"ms:{config.NODE_FQDN}:{idx}" for (idx, _, _, _) in fields]
+
+    # Parsing yields the fields; the response also re-encodes them as the base64 strings nodes answer with
+    parse = (lambda value: value.decode('utf-8').split('.')) if layout == 'text' else records.decode
+    start = time.perf_counter()
+    for value in values:
+        parse(value)
+    parse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for (idx, _, _, _), value in zip(fields, values):
+        records.to_response(idx, value)
+    response_time = time.perf_counter() - start
+
+    # What a retrieve does with the record besides auth and signing: response, receipt hash, wire body
+    start = time.perf_counter()
+    for (idx, _, _, _), value in zip(fields, values):
+        res = records.to_response(idx, value)
+        hashlib.sha256(codec.canonical(res)).digest()
+        codec.encode({'res': res, 'sig_r': idx}, config.WIRE_FORMAT)
+    serve_time = time.perf_counter() - start
+
+    engine = memory_cache.MemoryCache(shards=1, max_bytes=1 << 40)
+    for key, value in zip(keys, values):
+        engine.set(key, value)
+
+    value_bytes = sum(len(value) for value in values) / n
+    row = [layout, n, round(value_bytes, 1), round(engine.stats()['bytes'] / n, 1), round(n / parse_time), round(n / response_time), round(n / serve_time)]
+    row.append(round(redis_bytes(keys, values) / n, 1) if use_redis else '')
+    return row
+
+def main():
+    parser = argparse.ArgumentParser(description='Message Store record size benchmark')
+    parser.add_argument('--records', type=int, default=numRecords)
+    parser.add_argument('--passport-bytes', type=int, default=PASSPORT_BYTES)
+    parser.add_argument('--sig-bytes', type=int, default=SIG_BYTES)
+    parser.add_argument('--redis', action='store_true', help='Also measure MEMORY USAGE on the configured Redis')
+    args = parser.parse_args()
+
+    resutlsloc = f"{os.path.dirname(os.path.abspath(__file__))}/results/ms-records.csv"
+    files.write_csv(resutlsloc, [['layout', 'records', 'value_bytes', 'memory_cache_bytes', 'parse_ops_per_sec', 'response_ops_per_sec', 'serve_ops_per_sec', 'redis_bytes']])
+
+    print(f"Encoding {args.records} records per layout...")
+    fields = create_fields(args.records, args.passport_bytes, args.sig_bytes)
+    results = [bench_layout(layout, fields, args.redis) for layout in ('text', 'binary')]
+    for row in results:
+        print(f"{row[0]:>6}: {row[2]} B/value, {row[3]} B/record in memory cache, parse {row[4]} ops/s, response {row[5]} ops/s, serve {row[6]} ops/s")
+    files.append_csv(resutlsloc, results)
+    print(f"Results have been saved to {resutlsloc}.")
+
+if __name__ == '__main__':
+    main()
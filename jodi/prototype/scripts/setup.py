@@ -179,7 +179,7 @@ def setup_sample_loads(creds=None):
         
         billable_tk = billing.create_endorsed_token(config.VOPRF_SK)
         
-        eval_hreq = Utils.to_base64(Utils.hash256(bytes(x + str(i_k) + billable_tk + evs_peers, 'utf-8')))
+        eval_hreq = libjodi.get_evaluation_hash(x, i_k, billable_tk, evs_peers)
 
         pp_pub = Utils.to_base64(Utils.hash256(bytes(idx + ctx, 'utf-8')))
         pp_ret = Utils.to_base64(Utils.hash256(bytes(idx, 'utf-8')))
@@ -2,17 +2,12 @@ import json, os, time
 from typing import List
 from jodi.crypto import libjodi, groupsig, billing, audit_logging
 from jodi.models import cache
-from jodi.helpers import misc
+from jodi.helpers import codec
 from jodi import config
 from pylibjodi import Voprf, Utils
 from jodi.prototype.provider import Provider as BaseProvider
 
 evKeySets = None
-isk = None
-
-def set_isk(key):
-    global isk
-    isk = key
 
 def set_evaluator_keys(keys: dict):
     global evKeySets
@@ -29,8 +24,8 @@ def get_evaluator_keyset(nodeId: str):
     return evKeySets.get(nodeId, None)
 
 class MessageStore:
-    def __init__(self, nodeId: str, gpk, available: bool, logger):
-        self.gpk = gpk
+    def __init__(self, nodeId: str, gsc: groupsig.GroupSigContext, available: bool, logger):
+        self.gsc = gsc
         self.nodeId = nodeId
         self.name = f'sim.ms.{nodeId}'
         self.available = available
@@ -59,7 +54,7 @@ class MessageStore:
         pp = Utils.to_base64(Utils.hash256(bytes(request['idx'] + request['ctx'], 'utf-8')))
         bb = billing.get_billing_hash(request['bt'], request['peers'])
 
-        if not groupsig.verify(sig=request['sig'], msg=pp + bb, gpk=self.gpk):
+        if not self.gsc.verify(sig=request['sig'], msg=pp + bb):
             res = {'_error': 'invalid signature', 'time_taken': time.perf_counter() - start_time}
             self.log_msg(res)
             return res
@@ -72,7 +67,7 @@ class MessageStore:
             seconds=config.T_MAX_SECONDS
         )
         
-        sig_r = audit_logging.ecdsa_sign(private_key=isk, data=pp+bb+"ok")
+        sig_r = audit_logging.sign(data=pp+bb+"ok")
         
         return {'_success': 'message stored', 'sig_r': sig_r, 'time_taken': time.perf_counter() - start_time}
     
@@ -92,7 +87,7 @@ class MessageStore:
         pp = Utils.to_base64(Utils.hash256(bytes(request['idx'], 'utf-8')))
         bb = billing.get_billing_hash(request['bt'], request['peers'])
         
-        if not groupsig.verify(sig=request['sig'], msg=pp + bb, gpk=self.gpk):
+        if not self.gsc.verify(sig=request['sig'], msg=pp + bb):
             res = {'_error': 'invalid signature', 'time_taken': time.perf_counter() - start_time}
             self.log_msg(res)
             return res
@@ -105,9 +100,9 @@ class MessageStore:
         (msidx, msctx, mssig, bill_h) = value.split('.')
         res = {'idx': msidx, 'ctx': msctx, 'sig': mssig, 'bb': bill_h}
         hreq = billing.Utils.to_base64(billing.Utils.hash256(bytes(request['idx'], 'utf-8')))
-        hres = billing.Utils.to_base64(billing.Utils.hash256(bytes(misc.stringify(res), 'utf-8')))
+        hres = billing.Utils.to_base64(billing.Utils.hash256(codec.canonical(res)))
         
-        sig_r = audit_logging.ecdsa_sign(private_key=isk, data=hreq+hres)
+        sig_r = audit_logging.sign(data=hreq+hres)
         
         return {'res': res, 'sig_r': sig_r, 'time_taken': time.perf_counter() - start_time}
 
@@ -120,8 +115,8 @@ class Evaluator:
             keys.append(Utils.to_base64(sk) + '.' + Utils.to_base64(vk))
         return keys
         
-    def __init__(self, nodeId: str, gpk, available: bool, logger):
-        self.gpk = gpk
+    def __init__(self, nodeId: str, gsc: groupsig.GroupSigContext, available: bool, logger):
+        self.gsc = gsc
         self.nodeId = nodeId
         self.logger = logger
         self.available = available
@@ -144,11 +139,12 @@ class Evaluator:
             self.log_msg(res)
             return res
 
-        hreq = Utils.to_base64(Utils.hash256(
-            bytes(request['x'] + str(request['i_k']) + request['bt'] + request['peers'], 'utf-8')
-        ))
+        hreq = libjodi.get_evaluation_hash(
+            request['x'], request['i_k'], request['bt'], request['peers'], 
+            request['req_type'], request.get('pinned', False)
+        )
         
-        if not groupsig.verify(sig=request['sig'], msg=hreq, gpk=self.gpk):
+        if not self.gsc.verify(sig=request['sig'], msg=hreq):
             res = {'_error': 'invalid signature', 'time_taken': time.perf_counter() - start_time}
             self.log_msg(res)
             return res
@@ -159,8 +155,8 @@ class Evaluator:
         sk, vk = self.keys[request['i_k']][0], self.keys[request['i_k']][1]
         fx = Voprf.evaluate(sk, Utils.from_base64(request['x']))
         evals = [{"fx": Utils.to_base64(fx), "vk": Utils.to_base64(vk)}]
-        hres = Utils.to_base64(Utils.hash256(bytes(misc.stringify(evals), 'utf-8')))
-        sig_r = audit_logging.ecdsa_sign(private_key=isk, data=hreq+hres)
+        hres = Utils.to_base64(Utils.hash256(codec.canonical(evals)))
+        sig_r = audit_logging.sign(data=hreq+hres)
         
         return {
             "evals": evals,
@@ -172,40 +168,51 @@ class Provider(BaseProvider):
     def __init__(self, params: dict):
         super().__init__(params=params)
     
-    async def make_request(self, req_type, requests):
-        responses = []
+    async def make_request(self, req_type, requests, accept=None, initial=None, phase=None):
+        # Nodes are asked one after the other in request order, so the stores of the most
+        # likely call ID (`initial`) are asked first without any hedging. Like http.posts_race,
+        # a retrieve stops at the first response that passes `accept` and returns only that one.
+        if req_type == 'retrieve':
+            accept = accept or (lambda res: '_error' not in res)
+        responses, winner = [], None
         timer = time.perf_counter()
         for req in requests:
             available = req.get('avail')
             available = available['up'] if available is not None else True
             
-            if req_type == 'evaluate':
+            # Like http.send, nothing is sent once the phase deadline has passed
+            if phase and phase.expired():
+                payload = {'_error': 'Deadline exceeded'}
+            elif req_type == 'evaluate':
                 payload = Evaluator(
                     nodeId=req['nodeId'], 
-                    gpk=self.gpk, 
+                    gsc=self.gsc, 
                     available=available,
                     logger=self.logger
                 ).evaluate(req['data'])
             elif req_type == 'publish':
                 payload = MessageStore(
                     nodeId=req['nodeId'], 
-                    gpk=self.gpk, 
+                    gsc=self.gsc, 
                     available=available,
                     logger=self.logger
                 ).publish(req['data'])
             elif req_type == 'retrieve':
                 payload = MessageStore(
                     nodeId=req['nodeId'], 
-                    gpk=self.gpk, 
+                    gsc=self.gsc, 
                     available=available,
                     logger=self.logger
                 ).retrieve(req['data'])
                 
             responses.append(payload)
+            if req_type == 'retrieve' and accept(payload):
+                winner = payload
+                break
         
         # This section makes it appear as if the requests were parallelized
         n = len(responses)
         time_taken = time.perf_counter() - timer
         avg_time_taken = time_taken/n
         self.sim_overhead.append(time_taken - avg_time_taken)
-        return responses
\ No newline at end of file
+        return [winner] if winner else responses
\ No newline at end of file
@@ -5,7 +5,7 @@ from jodi.crypto import groupsig, billing
 from jodi.prototype import network
 from jodi.models import cache, persistence
 from jodi.helpers import errors, mylogging, http
-from jodi.prototype.stirshaken import stirsetup, certs
+from jodi.prototype.stirshaken import stirsetup
 from jodi import config, constants
 from jodi.prototype import provider as providerModule
 from jodi.prototype.simulations import entities
@@ -16,20 +16,21 @@ credentials = None
 call_placement_services = []
 certificate_repos = []
 cache_client = None
+token_pool = None
 
 def set_cache_client(client):
     global cache_client
     cache_client = client
 
 def init_worker():
-    global gsk, gpk, call_placement_services, certificate_repos, credentials
+    global gsk, gpk, call_placement_services, certificate_repos, credentials, token_pool
     cache.set_client(cache_client)
     gsk, gpk = groupsig.get_gsk(), groupsig.get_gpk()
     call_placement_services = cache.find(key=config.CPS_KEY, dtype=dict) or []
     certificate_repos = cache.find(key=config.CR_KEY, dtype=dict) or []
     _, credentials = stirsetup.load_certs()
     entities.set_evaluator_keys(cache.find(key=config.EVAL_KEYSETS_KEY, dtype=dict))
-    entities.set_isk(certs.get_private_key(config.TEST_ISK))
+    token_pool = billing.TokenPool(config.VOPRF_SK).start()
     
     if not http.keep_alive_session:
         loop = asyncio.new_event_loop()
@@ -38,6 +39,8 @@ def init_worker():
         
 def teardown_worker(args):
     print(f"{os.getpid()}: teardown worker")
+    if token_pool:
+        token_pool.stop()
     loop = asyncio.get_event_loop()
     if loop and http.keep_alive_session:
         loop.run_until_complete(http.keep_alive_session.close())
@@ -74,7 +77,7 @@ class NetworkedSimulator:
             'next_prov': next_prov,
             'cps': { 'url': cps['url'], 'fqdn': cps['fqdn'] } if cps else None,
             'cr': {'x5u': cr['url'] + f'/certs/{ck}', 'sk': cred['sk']},
-            'bt': billing.create_endorsed_token(config.VOPRF_SK),
+            'bt': token_pool.get() if token_pool else billing.create_endorsed_token(config.VOPRF_SK),
         }
         
     def create_provider_instance(self, pid, impl, mode, options, next_prov):
@@ -5,6 +5,7 @@ from datetime import datetime, timedelta, timezone
 from cryptography.hazmat.primitives.asymmetric import ec
 
 from jodi.helpers import http, mylogging
+from jodi.crypto import keys
 import jodi.config as config
 import jodi.constants as constants
 
@@ -101,15 +102,10 @@ async def download(url: str) -> str:
         return None
 
 
-def get_public_key_from_cert(cert: str) -> str:
+def get_public_key_from_cert(cert: str):
+    """Returns the certificate's public key object. Parsed keys are cached by certificate fingerprint."""
     try:
-        cert: x509.Certificate = x509.load_pem_x509_certificate(cert.encode('utf-8'))
-        public_key = cert.public_key()
-        pem_public_key = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        return pem_public_key.decode()
+        return keys.load_public_key_from_cert(cert)
     except Exception as e:
         traceback.print_exc()
         raise ValueError(f'Error getting certificate: {e}')
@@ -118,11 +114,7 @@ def get_public_key_from_cert(cert: str) -> str:
 def get_private_key(key_str: str):
     if not key_str:
         raise ValueError('Must provide a key')
-    private_key = serialization.load_pem_private_key(
-        key_str.encode(),
-        password=None,
-    )
-    return private_key
+    return keys.load_private_key(key_str)
 
 
 def verify_chain_of_trust(certificate_pem: str) -> bool:
@@ -29,7 +29,9 @@ class RepublishRequest(PublishRequest):
 async def lifespan(app: FastAPI):
     keep_alive_session = http.create_session()
     http.set_session(keep_alive_session)
+    cache.set_async_client(cache.connect_async())
     yield
+    await cache.aclient.aclose()
     await keep_alive_session.close()
 
 def init_server():
@@ -130,7 +132,7 @@ async def handle_publish_req(dest: str, orig: str, request: PublishRequest, auth
     
     mylogging.mylogger.debug(f"{os.getpid()}: Caching Passports")
 
-    cache.cache_for_seconds(
+    await cache.acache_for_seconds(
         key=get_record_key(dest=dest, orig=orig), 
         value=request.passports, 
         seconds=config.T_MAX_SECONDS
@@ -157,7 +159,7 @@ async def handle_republish_req(dest: str, orig: str, request: RepublishRequest,
     
     mylogging.mylogger.debug(f"Passports key: {get_record_key(dest=dest, orig=orig)}")
     
-    cache.cache_for_seconds(
+    await cache.acache_for_seconds(
         key=get_record_key(dest=dest, orig=orig), 
         value=request.passports, 
         seconds=config.T_MAX_SECONDS
@@ -176,7 +178,7 @@ async def handle_retrieve_req(dest: str, orig: str, authorization: str = Header(
         return unauthorized_response()
     
     mylogging.mylogger.debug(f"Passports key: {get_record_key(dest=dest, orig=orig)}")
-    passports = cache.find(
+    passports = await cache.afind(
         key=get_record_key(dest=dest, orig=orig), 
         dtype=dict
     )
@@ -1,14 +1,14 @@
 import os, time
 from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import List
+from contextlib import asynccontextmanager
 
-from jodi.crypto import audit_logging, groupsig
+from jodi.crypto import executor
 from jodi.models import cache
 from jodi.helpers import mylogging, misc
+from jodi.helpers.codec import WireResponse, WireRoute
 from jodi import config
-from jodi.prototype.stirshaken import certs
 
 mylogging.init_mylogger('auditlog', 'logs/auditlog.log')
 cache.set_client(cache.connect())
@@ -19,10 +19,22 @@ benchmark = mylogging.init_logger(
     formatter="%(message)s",
 )
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor.set_pool(executor.create_pool())
+    yield
+    executor.shutdown()
 
-private_key = certs.get_private_key(config.TEST_ISK)
-public_key = certs.get_public_key_from_cert(config.TEST_ICERT)
+app = FastAPI(lifespan=lifespan)
+# Bodies may be JSON or msgpack; responses follow the client's Accept header
+app.router.route_class = WireRoute
+
+@app.exception_handler(executor.CryptoPoolBusy)
+async def crypto_pool_busy(request, exc):
+    return WireResponse(
+        content={"message": "Service Busy"}, 
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
 
 class Request(BaseModel):
     auth_token: str
@@ -32,9 +44,9 @@ class Request(BaseModel):
 async def write_log(req: Request):
     start_time = time.perf_counter()
     
-    if not audit_logging.ecdsa_verify(public_key=public_key, data=req.logs, sigma=req.auth_token):
+    if not await executor.verify(data=req.logs, sigma=req.auth_token):
         print("Invalid signature", flush=True)
-        return JSONResponse(
+        return WireResponse(
             content={"message": "Unauthorized: Invalid signature"}, 
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY
         )
@@ -45,7 +57,7 @@ async def write_log(req: Request):
     time_taken = time.perf_counter() - start_time
     benchmark.info(f"als_s,log,{misc.toMs(time_taken)}")
     
-    return JSONResponse(
+    return WireResponse(
         content={"message": "Successfully logged"}, 
         status_code=status.HTTP_201_CREATED
     )
@@ -1,18 +1,17 @@
-import os, time
-from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse
+import os, time, asyncio
+from fastapi import FastAPI, status, Request
 from pydantic import BaseModel
+from typing import List
+from contextlib import asynccontextmanager
 
-from jodi.crypto import groupsig, oprf, billing, audit_logging
+from jodi.crypto import oprf, billing, audit_logging, executor, sessions
 from jodi.models import cache
-from jodi.helpers import mylogging, misc
+from jodi.helpers import mylogging, misc, deadline, codec
+from jodi.helpers.codec import WireResponse, WireRoute
 from jodi import config
-from jodi.prototype.stirshaken import certs
 
 mylogging.init_mylogger('evaluator', 'logs/evaluator.log')
 cache.set_client(cache.connect())
-gpk = groupsig.get_gpk()
-isk = certs.get_private_key(config.TEST_ISK)
 
 benchmark = mylogging.init_logger(
     name='ev_benchmark',
@@ -20,59 +19,228 @@ benchmark = mylogging.init_logger(
     formatter="%(message)s",
 )
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor.set_pool(executor.create_pool())
+    cache.set_async_client(cache.connect_async())
+    yield
+    await executor.close_receipt_batcher()
+    await cache.aclient.aclose()
+    executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+# Bodies may be JSON or msgpack; responses follow the client's Accept header
+app.router.route_class = WireRoute
+
+@app.exception_handler(executor.CryptoPoolBusy)
+async def crypto_pool_busy(request, exc):
+    return WireResponse(
+        content={"message": "Service Busy"}, 
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+
+def deadline_exceeded_response():
+    return WireResponse(
+        content={"message": "Deadline Exceeded"},
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT
+    )
+
+@app.exception_handler(deadline.DeadlineExceeded)
+async def deadline_exceeded(request, exc):
+    return deadline_exceeded_response()
+
+@app.middleware("http")
+async def request_deadline(request: Request, call_next):
+    """Requests carrying a budget are dropped once it runs out instead of waiting for the crypto pool"""
+    current = deadline.Deadline.from_headers(request.headers)
+    if current and current.expired():
+        return deadline_exceeded_response()
+    deadline.current.set(current)
+    return await call_next(request)
 
 class EvaluateRequest(BaseModel):
     i_k: int
     x: str
-    sig: str
     bt: str
     peers: str
+    req_type: str = oprf.REQ_RETRIEVE
+    pinned: bool = False
+    # Either a group signature or a session ticket with a MAC
+    sig: str = None
+    ticket: str = None
+    mac: str = None
+
+class EvaluateItem(BaseModel):
+    i_k: int
+    x: str
+    bt: str
+    peers: str
+    req_type: str = oprf.REQ_RETRIEVE
+    pinned: bool = False
+
+class EvaluateBatchRequest(BaseModel):
+    items: List[EvaluateItem]
+    sig: str
+
+class SessionRequest(BaseModel):
+    share: str
+    nonce: str
+    sig: str
+
+def get_request_hash(x: str, i_k: int, bt: str, peers: str, req_type: str, pinned: bool) -> str:
+    return oprf.Utils.to_base64(oprf.Utils.hash256(
+        bytes(x + str(i_k) + bt + peers + ':' + req_type + ':' + str(int(pinned)), 'utf-8')
+    ))
+
+def get_response_hash(evals: list) -> str:
+    return oprf.Utils.to_base64(oprf.Utils.hash256(codec.canonical(evals)))
     
+def is_pinned(req) -> bool:
+    # Pinned keys are only published under the epoch schedule
+    return req.pinned and config.KEY_SCHEDULE == oprf.KEY_SCHEDULE_EPOCH
+
+# Signed key directory of the current epoch, built once per worker
+key_directories = {}
+
+async def get_key_directory() -> dict:
+    epoch = oprf.KeySchedule.epoch()
+    if epoch not in key_directories:
+        live = await oprf.KeyRotation.aget_live_keys(list(range(config.KEYLIST_SIZE)))
+        body = {
+            'node': config.NODE_FQDN,
+            'epoch': epoch,
+            'keys': [
+                {'i': i, 'gen': meta['gen'], 'vk': oprf.Utils.to_base64(vk)} 
+                for i, keys in live.items() for ((_, vk), meta) in keys
+            ],
+        }
+        key_directories.clear()
+        key_directories[epoch] = {**body, 'sig': await executor.sign(body)}
+    return key_directories[epoch]
+
+@app.get("/keys")
+async def keys():
+    """Verification keys of every index for the current epoch, signed with the node's receipt key"""
+    if config.KEY_SCHEDULE != oprf.KEY_SCHEDULE_EPOCH:
+        return WireResponse(
+            content={"message": "Key directory requires the epoch key schedule"}, 
+            status_code=status.HTTP_404_NOT_FOUND
+        )
+    return WireResponse(
+        content=await get_key_directory(), 
+        status_code=status.HTTP_200_OK
+    )
+
+@app.post("/session")
+async def session(req: SessionRequest):
+    """Opens an anonymous session: one group signature buys a ticket for MAC-authenticated requests"""
+    issued = await executor.open_session(req.share, req.nonce, req.sig)
+    if issued is None:
+        return WireResponse(
+            content={"message": "Invalid Signature"}, 
+            status_code=status.HTTP_401_UNAUTHORIZED
+        )
+    return WireResponse(
+        content=issued, 
+        status_code=status.HTTP_201_CREATED
+    )
+
 @app.post("/evaluate")
 async def evaluate(req: EvaluateRequest):
     start_time = time.perf_counter()
 
-    if not billing.verify_token(config.VOPRF_VK, req.bt):
-        return JSONResponse(
+    if not await executor.verify_token(config.VOPRF_VK, req.bt):
+        return WireResponse(
             content={"message": "Invalid Token"}, 
             status_code=status.HTTP_401_UNAUTHORIZED
         )
     
-    hreq = oprf.Utils.to_base64(oprf.Utils.hash256(
-        bytes(req.x + str(req.i_k) + req.bt + req.peers, 'utf-8')
-    ))
+    hreq = get_request_hash(req.x, req.i_k, req.bt, req.peers, req.req_type, req.pinned)
 
-    if not groupsig.verify(sig=req.sig, msg=hreq, gpk=gpk):
-        return JSONResponse(
+    if not await executor.verify_request(hreq, sig=req.sig, ticket=req.ticket, mac=req.mac):
+        return WireResponse(
             content={"message": "Invalid Signature"}, 
             status_code=status.HTTP_401_UNAUTHORIZED
         )
     
     mylogging.mylogger.debug(f"{config.KEY_ROTATION_LABEL}:{os.getpid()} --> Received request to evaluate with index {req.i_k}")
-    keypairs = oprf.KeyRotation.get_keys(req.i_k)
+    live = oprf.select_keys((await oprf.KeyRotation.aget_live_keys([req.i_k]))[req.i_k], req.req_type)
     
-    evals = oprf.evaluate(keypairs, req.x)
-    hres = oprf.Utils.to_base64(oprf.Utils.hash256(bytes(misc.stringify(evals), 'utf-8')))
+    evals = oprf.attach_key_meta(await executor.evaluate([kp for (kp, _) in live], req.x), live, pinned=is_pinned(req))
+    hres = get_response_hash(evals)
     content = {
         "evals": evals, 
-        "sig_r": audit_logging.ecdsa_sign(private_key=isk, data=hreq+hres)
+        **await executor.sign_receipt(hreq, hres)
     }
 
-    cache.enqueue_log({
+    await cache.aenqueue_log({
         "type": config.LOG_TYPE_CID_GEN,
         "x": req.x,
         "i_k": req.i_k,
         "tk": req.bt,
         "peers": req.peers,
-        "hres": oprf.Utils.to_base64(oprf.Utils.hash256(bytes(misc.stringify(content), 'utf-8'))),
-        "sig": req.sig,
+        "hres": oprf.Utils.to_base64(oprf.Utils.hash256(codec.canonical(content))),
+        **sessions.get_log_fields(req.sig, req.ticket, req.mac),
     })
     
     time_taken = time.perf_counter() - start_time
     benchmark.info(f"ev,evaluate,{misc.toMs(time_taken)}")
 
-    return JSONResponse(
+    return WireResponse(
+        content=content, 
+        status_code=status.HTTP_201_CREATED
+    )
+
+@app.post("/evaluate/batch")
+async def evaluate_batch(req: EvaluateBatchRequest):
+    """
+    Evaluates many blinded points under one group signature and returns one receipt.
+    Each item keeps its own billing token since billing stays per call.
+    """
+    start_time = time.perf_counter()
+
+    if not req.items:
+        return WireResponse(
+            content={"message": "Empty Batch"}, 
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+
+    tokens = list(set(item.bt for item in req.items))
+    if not all(await asyncio.gather(*[executor.verify_token(config.VOPRF_VK, bt) for bt in tokens])):
+        return WireResponse(
+            content={"message": "Invalid Token"}, 
+            status_code=status.HTTP_401_UNAUTHORIZED
+        )
+
+    hreqs = [get_request_hash(item.x, item.i_k, item.bt, item.peers, item.req_type, item.pinned) for item in req.items]
+
+    if not await executor.verify_group_signature(sig=req.sig, msg=audit_logging.batch_digest(hreqs)):
+        return WireResponse(
+            content={"message": "Invalid Signature"}, 
+            status_code=status.HTTP_401_UNAUTHORIZED
+        )
+
+    keys = await oprf.KeyRotation.aget_live_keys([item.i_k for item in req.items])
+    lives = [oprf.select_keys(keys[item.i_k], item.req_type) for item in req.items]
+    evals = await asyncio.gather(*[executor.evaluate([kp for (kp, _) in live], item.x) for (item, live) in zip(req.items, lives)])
+    evals = [oprf.attach_key_meta(e, live, pinned=is_pinned(item)) for (e, live, item) in zip(evals, lives, req.items)]
+    hress = [get_response_hash(e) for e in evals]
+    content = {
+        "evals": evals,
+        **await executor.sign_receipt(audit_logging.batch_digest(hreqs), audit_logging.batch_digest(hress))
+    }
+
+    await cache.aenqueue_log({
+        "type": config.LOG_TYPE_CID_GEN,
+        "batch": [{"x": item.x, "i_k": item.i_k, "tk": item.bt, "peers": item.peers} for item in req.items],
+        "hres": oprf.Utils.to_base64(oprf.Utils.hash256(codec.canonical(content))),
+        "sig": req.sig,
+    })
+
+    time_taken = time.perf_counter() - start_time
+    benchmark.info(f"ev,evaluate_batch,{misc.toMs(time_taken)},{len(req.items)}")
+
+    return WireResponse(
         content=content, 
         status_code=status.HTTP_201_CREATED
     )
@@ -83,4 +251,5 @@ async def health():
         "Status": 200,
         "Message": "OK", 
         "Type": "Evaluator",
+        "BillingTokens": billing.ledger.stats(),
     }
\ No newline at end of file
@@ -4,11 +4,12 @@ from fastapi import FastAPI, status, Request
 from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 
-from jodi.crypto import groupsig, billing
+from jodi.crypto import groupsig, billing, libjodi, oprf, sessions
 from jodi.models import cache, iwf
 from jodi import config
 from jodi.prototype.scripts import setup
-from jodi.helpers import mylogging, http
+from jodi.helpers import mylogging, http, dht, deadline
+from jodi.helpers.coalesce import SingleFlight
 
 mylogging.init_mylogger('jodi_proxy', 'logs/jodi-proxy.log')
 cache.set_client(cache.connect())
@@ -20,21 +21,37 @@ metrics_logger = mylogging.init_logger(
     formatter=None
 )
 
+gsc = groupsig.get_context()
+token_pool = billing.TokenPool(config.VOPRF_SK)
+
 proxy_params = {
-    'gsk': groupsig.get_gsk(),
-    'gpk': groupsig.get_gpk(),
+    'gsc': gsc,
     'n_ev': config.n_ev, 
     'n_ms': config.n_ms,
     'fake_proxy': config.FAKE_PROXY,
     'logger': mylogging.mylogger,
     'metrics_logger': metrics_logger,
+    'batchers': iwf.create_batchers(gsc=gsc) if config.BATCH_WINDOW_MS > 0 else None,
+    'membership': dht.Membership(),
+    'cid_cache': libjodi.CallIdCache() if config.CALL_ID_CACHE and config.KEY_SCHEDULE == oprf.KEY_SCHEDULE_EPOCH else None,
+    'key_directory': libjodi.KeyDirectory() if config.PIN_EVALUATOR_KEYS and config.KEY_SCHEDULE == oprf.KEY_SCHEDULE_EPOCH else None,
+    'sessions': sessions.SessionManager(gsc) if config.SESSION_TICKETS else None,
 }
 
+engine = iwf.JodiEngine(proxy_params)
+
+# Duplicate publish/retrieve requests for the same call (SIP retransmits, forking) share one execution
+inflight = SingleFlight()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     keep_alive_session = http.create_session()
     http.set_session(keep_alive_session)
+    token_pool.start()
     yield
+    token_pool.stop()
+    for batcher in (proxy_params['batchers'] or {}).values():
+        await batcher.close()
     await keep_alive_session.close()
 
 def init_server():
@@ -60,25 +77,34 @@ def error_response(content = {"_error": "Unprocessable Entity"}):
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY
     )
     
+def get_deadline(request: Request) -> deadline.Deadline:
+    """Budget given by ingress, else the configured call budget"""
+    current = deadline.Deadline.from_headers(request.headers)
+    if current is None and config.CALL_DEADLINE_MS:
+        current = deadline.Deadline(config.CALL_DEADLINE_MS)
+    return current
+
 class Publish(BaseModel):
     src: str
     dst: str
     passport: str
     
 @app.post("/publish")
-async def oob_proxy_publish(req: Publish):
-    bt = billing.create_endorsed_token(config.VOPRF_SK)
-    proxy = iwf.JodiIWF({**proxy_params, 'bt': bt})
-    res = await proxy.jodi_publish(src=req.src, dst=req.dst, token=req.passport)
+async def oob_proxy_publish(req: Publish, request: Request):
+    key = ('publish', libjodi.normalize_call_details(src=req.src, dst=req.dst), req.passport)
+    res = await inflight.do(key, lambda: engine.publish_call(
+        engine.new_call(token_pool.get(), get_deadline(request)), src=req.src, dst=req.dst, token=req.passport
+    ))
     if '_error' in res:
         return error_response(content=res)
     return success_response()
 
 @app.get("/retrieve/{src}/{dst}")
 async def oob_proxy_retrieve(src: str, dst: str, req: Request):
-    bt = billing.create_endorsed_token(config.VOPRF_SK)
-    proxy = iwf.JodiIWF({**proxy_params, 'bt': bt})
-    token = await proxy.jodi_retrieve(src=src, dst=dst)
+    key = ('retrieve', libjodi.normalize_call_details(src=src, dst=dst))
+    token = await inflight.do(key, lambda: engine.retrieve_call(
+        engine.new_call(token_pool.get(), get_deadline(req)), src=src, dst=dst
+    ))
     return success_response(content={"token": token})
 
 @app.get("/health")
@@ -86,5 +112,10 @@ async def health():
     return {
         "message": "OK",
         "type": "OOB Proxy",
+        "token_pool": token_pool.stats(),
+        "call_id_cache": engine.cid_cache.stats() if engine.cid_cache else None,
+        "sessions": engine.sessions.stats() if engine.sessions else None,
+        "nodes": http.scoreboard.stats(),
+        "inflight": inflight.stats(),
         "status": 200
     }
\ No newline at end of file
@@ -1,9 +1,13 @@
-from jodi.crypto.oprf import KeyRotation
+from jodi.crypto.oprf import KeyRotation, KeySchedule, KEY_SCHEDULE_EPOCH
 from jodi.models import cache
+from jodi import config
 
 cache.set_client(cache.connect())
 
 def main():
+    if config.KEY_SCHEDULE == KEY_SCHEDULE_EPOCH:
+        KeySchedule.begin_schedule()
+        return
     KeyRotation.initialize_keys()
     KeyRotation.begin_rotation()
 
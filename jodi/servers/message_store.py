@@ -1,18 +1,38 @@
-from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, status, Request
 from pydantic import BaseModel
+from typing import List
+from contextlib import asynccontextmanager
 
-import time
+import time, asyncio
 import jodi.config as config
-from jodi.crypto import groupsig, billing, audit_logging
-from jodi.models import cache
-from jodi.helpers import misc, mylogging
-from jodi.prototype.stirshaken import certs
+from jodi.crypto import billing, audit_logging, executor, sessions
+from jodi.models import cache, records
+from jodi.helpers import misc, mylogging, deadline, codec
+from jodi.helpers.codec import WireResponse, WireRoute
+from jodi.helpers.waiters import WaiterTable
 
 cache.set_client(cache.connect())
-app = FastAPI()
-gpk = groupsig.get_gpk()
-isk = certs.get_private_key(config.TEST_ISK)
+
+# Retrieves waiting for a record to be published, by idx
+waiters = WaiterTable(max_waiters=config.MS_RETRIEVE_MAX_WAITERS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor.set_pool(executor.create_pool())
+    cache.set_async_client(cache.connect_async())
+    cache.set_async_records_client(cache.connect_records_async())
+    listener = asyncio.create_task(listen_for_publishes()) if shares_publishes() else None
+    yield
+    if listener:
+        listener.cancel()
+    await executor.close_receipt_batcher()
+    await cache.aclient.aclose()
+    await cache.arecords.aclose()
+    executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+# Bodies may be JSON or msgpack; responses follow the client's Accept header
+app.router.route_class = WireRoute
 
 benchmark = mylogging.init_logger(
     name='ms_benchmark',
@@ -25,117 +45,354 @@ class PublishRequest(BaseModel):
     sig: str
     bt: str
     peers: str
+    # Session-authenticated publishes are not group-verified here; retrievers verify `sig` end-to-end
+    ticket: str = None
+    mac: str = None
     
 class RetrieveRequest(BaseModel):
     idx: str
-    sig: str
     bt: str
     peers: str
+    # Either a group signature or a session ticket with a MAC
+    sig: str = None
+    ticket: str = None
+    mac: str = None
+    # How long to hold the request if the record is not yet published
+    wait_ms: float = 0
+
+class PublishBatchRequest(BaseModel):
+    items: List[PublishRequest]
+
+class RetrieveItem(BaseModel):
+    idx: str
+    bt: str
+    peers: str
+
+class RetrieveBatchRequest(BaseModel):
+    items: List[RetrieveItem]
+    sig: str
+
+class SessionRequest(BaseModel):
+    share: str
+    nonce: str
+    sig: str
     
 def unauthorized_response(content={"message": "Unauthorized"}):
-    return JSONResponse(
+    return WireResponse(
         content=content,
         status_code=status.HTTP_401_UNAUTHORIZED
     )
     
 def success_response(content):
-    return JSONResponse(
+    return WireResponse(
         content=content, 
         status_code=status.HTTP_200_OK
     )
     
+def unprocessable_response(content={"message": "Unprocessable Entity"}):
+    return WireResponse(
+        content=content,
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY
+    )
+    
+@app.exception_handler(executor.CryptoPoolBusy)
+async def crypto_pool_busy(request, exc):
+    return WireResponse(
+        content={"message": "Service Busy"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+
+def deadline_exceeded_response():
+    return WireResponse(
+        content={"message": "Deadline Exceeded"},
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT
+    )
+
+@app.exception_handler(deadline.DeadlineExceeded)
+async def deadline_exceeded(request, exc):
+    return deadline_exceeded_response()
+
+@app.middleware("http")
+async def request_deadline(request: Request, call_next):
+    """Requests carrying a budget are dropped once it runs out instead of waiting for the crypto pool"""
+    current = deadline.Deadline.from_headers(request.headers)
+    if current and current.expired():
+        return deadline_exceeded_response()
+    deadline.current.set(current)
+    return await call_next(request)
+    
 def get_record_key(idx: str):
     return f"ms:{config.NODE_FQDN}:{idx}"
+
+def create_record(idx: str, ctx: str, sig: str, bb: str):
+    if config.MS_RECORD_FORMAT == 'text':
+        return idx + '.' + ctx + '.' + sig + '.' + bb
+    return records.encode(ctx, sig, bb)
+
+def get_publish_channel():
+    return f"ms:{config.NODE_FQDN}:published"
+
+def shares_publishes() -> bool:
+    # The memory backend lives in one process, whose waiters are woken directly
+    return config.MS_RETRIEVE_WAIT_MAX_MS > 0 and not cache.uses_memory_records()
+
+def announce_publish(idxs: List[str], pipe):
+    """Queues a pub/sub message per record for the waiters in other workers of this store"""
+    if shares_publishes():
+        for idx in idxs:
+            pipe.publish(get_publish_channel(), idx)
+
+async def listen_for_publishes():
+    """Relays records published through any worker of this store to this worker's waiters"""
+    while True:
+        pubsub = cache.aclient.pubsub()
+        try:
+            await pubsub.subscribe(get_publish_channel())
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    waiters.notify(message['data'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Publish listener failed, resubscribing: {e}", flush=True)
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+async def wait_for_record(idx: str, wait_ms: float):
+    """
+    Holds a retrieve that missed until the record is published, the wait runs out or the
+    request's deadline passes. The waiter is registered before the record is read again,
+    so a publish landing in between still wakes it.
+    """
+    timeout = min(wait_ms, config.MS_RETRIEVE_WAIT_MAX_MS) / 1000
+    current = deadline.current.get()
+    if current:
+        timeout = min(timeout, current.remaining())
+    if timeout <= 0:
+        return None
+
+    future = waiters.register(idx)
+    if future is None:
+        return None
+    value = await cache.afind_record(key=get_record_key(idx))
+    if value is not None:
+        waiters.discard(idx, future)
+        return value
+    if await waiters.wait(idx, future, timeout):
+        return await cache.afind_record(key=get_record_key(idx))
+    return None
+
+async def verify_billing_tokens(tokens: List[str]) -> bool:
+    results = await asyncio.gather(*[executor.verify_token(config.VOPRF_VK, bt) for bt in set(tokens)])
+    return all(results)
+
+def get_response_hash(res: dict) -> str:
+    return billing.Utils.to_base64(billing.Utils.hash256(codec.canonical(res)))
+    
+@app.post("/session")
+async def session(req: SessionRequest):
+    """Opens an anonymous session: one group signature buys a ticket for MAC-authenticated requests"""
+    issued = await executor.open_session(req.share, req.nonce, req.sig)
+    if issued is None:
+        return unauthorized_response({"message": "Invalid Signature"})
+    return WireResponse(
+        content=issued, 
+        status_code=status.HTTP_201_CREATED
+    )
     
 @app.post("/publish")
 async def publish(req: PublishRequest):
     start_time = time.perf_counter()
     
-    if not billing.verify_token(config.VOPRF_VK, req.bt):
+    if not await executor.verify_token(config.VOPRF_VK, req.bt):
         return unauthorized_response({"message": "Invalid billing Token"})
     
     pp = billing.Utils.to_base64(billing.Utils.hash256(bytes(req.idx + req.ctx, 'utf-8')))
     bb = billing.get_billing_hash(req.bt, req.peers)
     
-    if not groupsig.verify(sig=req.sig, msg=pp + bb, gpk=gpk):
+    if not await executor.verify_request(pp + bb, sig=req.sig, ticket=req.ticket, mac=req.mac):
         return unauthorized_response()
     
-    value = req.idx + '.' + req.ctx + '.' + req.sig + '.' + bb
-    cache.cache_for_seconds(
-        key=get_record_key(req.idx), 
-        value=value, 
-        seconds=config.T_MAX_SECONDS
-    )
-    
-    cache.enqueue_log({
-        "type": config.LOG_TYPE_PUBLISH,
-        "hreq": billing.Utils.to_base64(
-            billing.Utils.hash256(bytes(req.idx + req.ctx, 'utf-8'))
-        ),
-        "tk": req.bt,
-        "peers": req.peers,
-        "sig": req.sig,
-    })
+    # The record and its audit log entry go out in one round trip
+    value = create_record(req.idx, req.ctx, req.sig, bb)
+    async with cache.apipeline() as pipe:
+        await cache.acache_record(
+            key=get_record_key(req.idx), 
+            value=value, 
+            seconds=config.T_MAX_SECONDS,
+            pipe=pipe
+        )
+        
+        await cache.aenqueue_log({
+            "type": config.LOG_TYPE_PUBLISH,
+            "hreq": billing.Utils.to_base64(
+                billing.Utils.hash256(bytes(req.idx + req.ctx, 'utf-8'))
+            ),
+            "tk": req.bt,
+            "peers": req.peers,
+            "sig": req.sig,
+        }, pipe=pipe)
+        announce_publish([req.idx], pipe)
+    waiters.notify(req.idx)
     
-    sig_r = audit_logging.ecdsa_sign(private_key=isk, data=pp + bb + "ok")
+    receipt = await executor.sign_receipt(pp + bb, "ok")
     
     time_taken = time.perf_counter() - start_time
     benchmark.info(f"ms,publish,{misc.toMs(time_taken)}")
     
     return success_response({
         "message": "Created",
-        "sig_r": sig_r
+        **receipt
     })
     
 @app.post("/retrieve")
 async def retrieve(req: RetrieveRequest):
     start_time = time.perf_counter()
     
-    if not billing.verify_token(config.VOPRF_VK, req.bt):
+    if not await executor.verify_token(config.VOPRF_VK, req.bt):
         return unauthorized_response({"message": "Invalid billing Token"})
     
     pp = billing.Utils.to_base64(billing.Utils.hash256(bytes(req.idx, 'utf-8')))
     bb = billing.get_billing_hash(req.bt, req.peers)
     
-    if not groupsig.verify(sig=req.sig, msg=pp + bb, gpk=gpk):
+    if not await executor.verify_request(pp + bb, sig=req.sig, ticket=req.ticket, mac=req.mac):
         return unauthorized_response()
     
-    value = cache.find(key=get_record_key(req.idx))
+    value = await cache.afind_record(key=get_record_key(req.idx))
+    if value is None and req.wait_ms > 0:
+        value = await wait_for_record(req.idx, req.wait_ms)
     
     if value is None:
         res = {"message": "Not Found"}
     else:
-        (idx, ctx, sig, bill_h) = value.split('.')
-        res = {"idx": idx, "ctx": ctx, "sig": sig, 'bb': bill_h}
+        res = records.to_response(req.idx, value)
     
     log_entry = {
         "type": config.LOG_TYPE_RETRIEVE,
         "hreq": billing.Utils.to_base64(billing.Utils.hash256(bytes(req.idx, 'utf-8'))),
-        "hres": billing.Utils.to_base64(billing.Utils.hash256(bytes(misc.stringify(res), 'utf-8'))),
+        "hres": billing.Utils.to_base64(billing.Utils.hash256(codec.canonical(res))),
         "tk": req.bt,
         "peers": req.peers,
-        "sig": req.sig,
+        **sessions.get_log_fields(req.sig, req.ticket, req.mac),
     }
-    cache.enqueue_log(log_entry)
+    await cache.aenqueue_log(log_entry)
     
-    sig_r = audit_logging.ecdsa_sign(private_key=isk, data=log_entry['hreq'] + log_entry['hres'])
+    receipt = await executor.sign_receipt(log_entry['hreq'], log_entry['hres'])
     
     time_taken = time.perf_counter() - start_time
     benchmark.info(f"ms,retrieve,{misc.toMs(time_taken)}")
     
     if "message" in res:
-        res['sig_r'] = sig_r
-        return JSONResponse(
+        res.update(receipt)
+        return WireResponse(
             content=res,
             status_code=status.HTTP_404_NOT_FOUND
         )
     else:
-        res = {'res': res, 'sig_r': sig_r}
+        res = {'res': res, **receipt}
         return success_response(res)
 
+@app.post("/publish/batch")
+async def publish_batch(req: PublishBatchRequest):
+    """
+    Stores many records in one Redis pipeline and answers with one receipt.
+    Every record keeps its own group signature because retrievers verify it end-to-end.
+    """
+    start_time = time.perf_counter()
+    
+    if not req.items:
+        return unprocessable_response({"message": "Empty Batch"})
+    
+    if not await verify_billing_tokens([item.bt for item in req.items]):
+        return unauthorized_response({"message": "Invalid billing Token"})
+    
+    hreqs, bbs, log_entries = [], [], []
+    for item in req.items:
+        pp = billing.Utils.to_base64(billing.Utils.hash256(bytes(item.idx + item.ctx, 'utf-8')))
+        bb = billing.get_billing_hash(item.bt, item.peers)
+        hreqs.append(pp + bb)
+        bbs.append(bb)
+        log_entries.append({
+            "type": config.LOG_TYPE_PUBLISH,
+            "hreq": pp,
+            "tk": item.bt,
+            "peers": item.peers,
+            "sig": item.sig,
+        })
+    
+    verified = await executor.verify_group_signatures([(item.sig, hreq) for (item, hreq) in zip(req.items, hreqs)])
+    if not all(verified):
+        return unauthorized_response()
+    
+    async with cache.apipeline() as pipe:
+        for (item, bb) in zip(req.items, bbs):
+            value = create_record(item.idx, item.ctx, item.sig, bb)
+            await cache.acache_record(get_record_key(item.idx), value, config.T_MAX_SECONDS, pipe=pipe)
+        await cache.aenqueue_logs(log_entries, pipe=pipe)
+        announce_publish([item.idx for item in req.items], pipe)
+    for item in req.items:
+        waiters.notify(item.idx)
+    
+    receipt = await executor.sign_receipt(
+        audit_logging.batch_digest(hreqs), audit_logging.batch_digest(["ok"] * len(hreqs))
+    )
+    
+    time_taken = time.perf_counter() - start_time
+    benchmark.info(f"ms,publish_batch,{misc.toMs(time_taken)},{len(req.items)}")
+    
+    return success_response({
+        "message": "Created",
+        **receipt
+    })
+
+@app.post("/retrieve/batch")
+async def retrieve_batch(req: RetrieveBatchRequest):
+    """Looks up many records with one MGET under one group signature and answers with one receipt"""
+    start_time = time.perf_counter()
+    
+    if not req.items:
+        return unprocessable_response({"message": "Empty Batch"})
+    
+    if not await verify_billing_tokens([item.bt for item in req.items]):
+        return unauthorized_response({"message": "Invalid billing Token"})
+    
+    pps = [billing.Utils.to_base64(billing.Utils.hash256(bytes(item.idx, 'utf-8'))) for item in req.items]
+    signed = [pp + billing.get_billing_hash(item.bt, item.peers) for (pp, item) in zip(pps, req.items)]
+    
+    if not await executor.verify_group_signature(sig=req.sig, msg=audit_logging.batch_digest(signed)):
+        return unauthorized_response()
+    
+    values = await cache.afind_records([get_record_key(item.idx) for item in req.items])
+    
+    results, hress, log_entries = [], [], []
+    for (item, pp, value) in zip(req.items, pps, values):
+        if value is None:
+            res = {"message": "Not Found"}
+        else:
+            res = records.to_response(item.idx, value)
+        results.append(res)
+        hress.append(get_response_hash(res))
+        log_entries.append({
+            "type": config.LOG_TYPE_RETRIEVE,
+            "hreq": pp,
+            "hres": hress[-1],
+            "tk": item.bt,
+            "peers": item.peers,
+            "sig": req.sig,
+        })
+    await cache.aenqueue_logs(log_entries)
+    
+    receipt = await executor.sign_receipt(audit_logging.batch_digest(pps), audit_logging.batch_digest(hress))
+    
+    time_taken = time.perf_counter() - start_time
+    benchmark.info(f"ms,retrieve_batch,{misc.toMs(time_taken)},{len(req.items)}")
+    
+    return success_response({"results": results, **receipt})
+
 @app.get("/health")
 async def health():
-    cache.enqueue_log({
+    await cache.aenqueue_log({
         'type': 'health',
         'message': 'Health check successful'
     })
@@ -143,4 +400,7 @@ async def health():
         "Status": 200,
         "Message": "OK", 
         "Type": "Message Store", 
+        "BillingTokens": billing.ledger.stats(),
+        "Cache": cache.stats(),
+        "Waiters": waiters.stats(),
     }
\ No newline at end of file
@@ -5,11 +5,10 @@ import asyncio, time
 from rq import get_current_job
 import numpy as np
 
-from jodi.config import LOG_BATCH_KEY, AUDIT_SERVER_URL, TEST_ISK, TEST_ICERT, BENCHMARK_LOG_FILE
+from jodi.config import LOG_BATCH_KEY, AUDIT_SERVER_URL, BENCHMARK_LOG_FILE
 from jodi.models import cache, persistence
 from jodi.helpers import http,  mylogging, misc
 from jodi.crypto import audit_logging
-from jodi.prototype.stirshaken import certs
 
 def _get_job_details():
     """
@@ -98,11 +97,10 @@ async def _handle_server_logs(chunks, benchmark=None):
     
     start_time = time.perf_counter()
     
-    public_key = certs.get_public_key_from_cert(TEST_ICERT)
     logs = []
     for chunk in chunks:
         for log in chunk['logs']:
-            if audit_logging.ecdsa_verify(public_key=public_key, data=log['payload'], sigma=log['sigma']):
+            if audit_logging.verify(data=log['payload'], sigma=log['sigma']):
                 logs.append(log)
     persistence.save_logs(logs)
     print(f"\n\n{len(logs)} Saved to DB", flush=True)
@@ -115,14 +113,13 @@ async def _handle_client_logs(logs_list, benchmark=None):
     if len(logs_list) == 0:
         return
     
-    priv_key = certs.get_private_key(TEST_ISK)
     signed_logs = []
     start_time = time.perf_counter()
     # Sign each log entry with the private key
     for log in logs_list:
         signed_logs.append({
             'payload': log, 
-            'sigma': audit_logging.ecdsa_sign(private_key=priv_key, data=log)
+            'sigma': audit_logging.sign(data=log)
         })
     
     # Chunk the signed logs into manageable sizes for HTTP requests
@@ -132,7 +129,7 @@ async def _handle_client_logs(logs_list, benchmark=None):
         reqs.append({
             'url': AUDIT_SERVER_URL,
             'data': {
-                'auth_token': audit_logging.ecdsa_sign(private_key=priv_key, data=chunk),
+                'auth_token': audit_logging.sign(data=chunk),
                 'logs': signed_logs,
             }
         })
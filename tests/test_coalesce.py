@@ -0,0 +1,123 @@
+import asyncio
+import unittest
+
+from jodi.helpers.coalesce import MicroBatcher, SingleFlight
+
+class TestMicroBatcher(unittest.TestCase):
+    def test_merges_concurrent_submissions_per_key(self):
+        """Concurrent items for the same key are flushed together, other keys separately."""
+        flushed = []
+
+        async def flush(key, items):
+            flushed.append((key, list(items)))
+            return [f'{key}:{item}' for item in items]
+
+        async def run():
+            batcher = MicroBatcher(flush=flush, window_ms=5)
+            return await asyncio.gather(
+                batcher.submit('ev1', 1),
+                batcher.submit('ev1', 2),
+                batcher.submit('ev2', 3),
+            )
+
+        results = asyncio.run(run())
+        self.assertEqual(results, ['ev1:1', 'ev1:2', 'ev2:3'])
+        self.assertEqual(sorted(flushed), [('ev1', [1, 2]), ('ev2', [3])])
+
+    def test_flushes_when_batch_is_full(self):
+        """A full batch is flushed without waiting for the window."""
+        sizes = []
+
+        async def flush(key, items):
+            sizes.append(len(items))
+            return items
+
+        async def run():
+            batcher = MicroBatcher(flush=flush, window_ms=10000, max_size=2)
+            return await asyncio.wait_for(asyncio.gather(batcher.submit('k', 'a'), batcher.submit('k', 'b')), timeout=1)
+
+        self.assertEqual(asyncio.run(run()), ['a', 'b'])
+        self.assertEqual(sizes, [2])
+
+    def test_flush_errors_reach_every_caller(self):
+        """An exception raised by flush is propagated to all callers of the batch."""
+        async def flush(key, items):
+            raise RuntimeError('node down')
+
+        async def run():
+            batcher = MicroBatcher(flush=flush, window_ms=1)
+            return await asyncio.gather(batcher.submit('k', 1), batcher.submit('k', 2), return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+
+    def test_close_flushes_pending_and_awaits_tasks(self):
+        """close() flushes batches still inside their window and waits for in-flight flushes."""
+        flushed = []
+
+        async def flush(key, items):
+            await asyncio.sleep(0.01)
+            flushed.append(list(items))
+            return items
+
+        async def run():
+            batcher = MicroBatcher(flush=flush, window_ms=10000)
+            caller = asyncio.ensure_future(batcher.submit('k', 1))
+            await asyncio.sleep(0)
+            await batcher.close()
+            self.assertEqual(batcher.tasks, set())
+            return await caller
+
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(flushed, [[1]])
+
+class TestSingleFlight(unittest.TestCase):
+    def test_followers_share_the_leaders_result(self):
+        """Concurrent calls for one key run fn once; other keys run separately."""
+        calls = []
+
+        async def run():
+            flight = SingleFlight()
+
+            async def fn(key):
+                calls.append(key)
+                await asyncio.sleep(0.01)
+                return key.upper()
+
+            return await asyncio.gather(
+                flight.do('a', lambda: fn('a')),
+                flight.do('a', lambda: fn('a')),
+                flight.do('b', lambda: fn('b')),
+            )
+
+        self.assertEqual(asyncio.run(run()), ['A', 'A', 'B'])
+        self.assertEqual(sorted(calls), ['a', 'b'])
+
+    def test_errors_and_cancellation(self):
+        """Errors reach every waiter; a cancelled follower does not cancel the leader."""
+        async def run():
+            flight = SingleFlight()
+
+            async def fail():
+                await asyncio.sleep(0.01)
+                raise RuntimeError('no call id')
+
+            errors = await asyncio.gather(flight.do('k', fail), flight.do('k', fail), return_exceptions=True)
+
+            async def slow():
+                await asyncio.sleep(0.02)
+                return 'ok'
+
+            leader = asyncio.ensure_future(flight.do('s', slow))
+            follower = asyncio.ensure_future(flight.do('s', slow))
+            await asyncio.sleep(0)
+            follower.cancel()
+            return errors, await leader, flight.stats()['in_flight']
+
+        errors, result, in_flight = asyncio.run(run())
+        self.assertTrue(all(isinstance(e, RuntimeError) for e in errors))
+        self.assertEqual(result, 'ok')
+        self.assertEqual(in_flight, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import base64
+import unittest
+
+from jodi.helpers import codec
+
+class TestCodec(unittest.TestCase):
+    def test_msgpack_round_trip_carries_binary_fields_as_bytes(self):
+        """Base64 fields travel as raw bytes and come back as the same strings."""
+        point = base64.b64encode(bytes(range(32))).decode('utf-8')
+        data = {'x': point, 'i_k': 3, 'peers': 'a.b', 'evals': [{'fx': point, 'gen': 0}], 'sig': 'not base64!'}
+
+        body = codec.encode(data, codec.MSGPACK)
+        self.assertLess(len(body), len(codec.encode(data, codec.JSON)))
+        self.assertEqual(codec.decode(body, codec.MSGPACK), data)
+
+    def test_canonical_encoding_ignores_key_order(self):
+        self.assertEqual(
+            codec.canonical({'b': [1, {'y': 'v', 'x': 2.5}], 'a': True}),
+            codec.canonical({'a': True, 'b': [1, {'x': 2.5, 'y': 'v'}]})
+        )
+
+if __name__ == '__main__':
+    unittest.main()
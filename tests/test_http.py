@@ -0,0 +1,154 @@
+import asyncio
+import importlib.util
+import unittest
+
+from jodi.helpers import http
+from jodi.helpers.coalesce import MicroBatcher
+from jodi.helpers.deadline import Deadline
+
+def create_batcher(delays: dict) -> MicroBatcher:
+    """Batcher standing in for the nodes: each url answers after its delay, 'bad' urls with an error"""
+    async def flush(url, reqs):
+        await asyncio.sleep(delays[url])
+        return [{'_error': 'down'} if url.startswith('bad') else {'url': url} for _ in reqs]
+    return MicroBatcher(flush=flush, window_ms=0)
+
+class TestPostsRace(unittest.TestCase):
+    def test_race_continues_past_rejected_responses(self):
+        """A fast but rejected response does not win the race."""
+        delays = {'ms1': 0.01, 'ms2': 0.03, 'ms3': 0.05}
+        reqs = [{'url': url, 'data': {}} for url in delays]
+
+        async def run():
+            return await http.posts_race(reqs, batcher=create_batcher(delays), accept=lambda res: res.get('url') != 'ms1')
+
+        self.assertEqual(asyncio.run(run()), [{'url': 'ms2'}])
+
+    def test_hedges_after_delay(self):
+        """With hedging, a further store is only asked once the first is slow."""
+        delays = {'ms1': 5, 'ms2': 0.01, 'ms3': 0.01}
+        reqs = [{'url': url, 'data': {}} for url in delays]
+        sent = []
+        batcher = create_batcher(delays)
+        submit = batcher.submit
+
+        async def tracking_submit(key, item):
+            sent.append(key)
+            return await submit(key, item)
+        batcher.submit = tracking_submit
+
+        async def run():
+            return await asyncio.wait_for(http.posts_race(reqs, batcher=batcher, hedge_ms=20), timeout=1)
+
+        self.assertEqual(asyncio.run(run()), [{'url': 'ms2'}])
+        self.assertEqual(sent, ['ms1', 'ms2'])
+
+    def test_threshold_returns_the_first_k_accepted(self):
+        """With k, the race ends on the k-th accepted response; failures and slow nodes are skipped."""
+        delays = {'bad1': 0.01, 'ev1': 0.02, 'ev2': 0.03, 'ev3': 5}
+        reqs = [{'url': url, 'data': {}} for url in delays]
+
+        async def run():
+            quorum = await asyncio.wait_for(http.posts_race(reqs, batcher=create_batcher(delays), k=2), timeout=1)
+            short = await http.posts_race(reqs[:2], batcher=create_batcher(delays), k=2)
+            return quorum, short
+
+        quorum, short = asyncio.run(run())
+        self.assertEqual(quorum, [{'url': 'ev1'}, {'url': 'ev2'}])
+        self.assertEqual(short, [{'url': 'ev1'}, {'_error': 'down'}])
+
+class TestDeadline(unittest.TestCase):
+    def test_phase_deadline_cancels_fan_out_and_drops_late_requests(self):
+        """A fan-out past its phase deadline is cancelled; requests already late are not sent."""
+        delays = {'ev1': 0.01, 'ev2': 5}
+        sent = []
+        batcher = create_batcher(delays)
+        submit = batcher.submit
+
+        async def tracking_submit(key, item):
+            sent.append(key)
+            return await submit(key, item)
+        batcher.submit = tracking_submit
+
+        async def run():
+            phase = Deadline(50)
+            reqs = [{'url': url, 'data': {}, 'deadline': phase} for url in delays]
+            timed_out = await asyncio.wait_for(
+                http.within(phase, http.posts(reqs, batcher=batcher), default='late'), timeout=1
+            )
+            late = await http.send({'url': 'ev1', 'data': {}, 'deadline': Deadline(0)}, batcher)
+            return timed_out, late
+
+        timed_out, late = asyncio.run(run())
+        self.assertEqual(timed_out, 'late')
+        self.assertEqual(late, {'_error': 'Deadline exceeded'})
+        self.assertEqual(sorted(sent), ['ev1', 'ev2'])
+
+    def test_client_timeout_is_bounded_by_the_phase(self):
+        """The client timeout never outlasts the phase, nor HTTP_TIMEOUT_SECONDS."""
+        self.assertLessEqual(http.get_timeout(Deadline(100)).total, 0.1)
+        self.assertGreater(http.get_timeout(Deadline(0)).total, 0)
+        self.assertEqual(http.get_timeout(Deadline(10 ** 9)).total, http.get_timeout().total)
+
+class TestScoreboard(unittest.TestCase):
+    def test_breaker_opens_probes_and_closes(self):
+        """Consecutive failures open the circuit; after the cooldown one probe may close it again."""
+        board = http.Scoreboard()
+        for _ in range(http.config.HTTP_BREAKER_FAILURES):
+            self.assertTrue(board.allow('ms1'))
+            board.record('ms1', 0.01, ok=False)
+        self.assertFalse(board.allow('ms1'))
+
+        board.get('ms1').opened_at -= http.config.HTTP_BREAKER_COOLDOWN_SECONDS
+        self.assertTrue(board.allow('ms1'))
+        self.assertFalse(board.allow('ms1'))
+        board.record('ms1', 0.01, ok=True)
+        self.assertEqual(board.get('ms1').state, http.CIRCUIT_CLOSED)
+
+    def test_send_skips_open_nodes_and_ignores_client_errors(self):
+        """Open-circuit nodes are not contacted; a 404 answer does not count against a node."""
+        async def not_found(url, reqs):
+            return [{'_error': 'Not Found', '_status': 404} for _ in reqs]
+
+        self.addCleanup(http.scoreboard.nodes.clear)
+        http.scoreboard.get('ms1').state = http.CIRCUIT_OPEN
+        http.scoreboard.get('ms1').opened_at = float('inf')
+
+        async def run():
+            batcher = MicroBatcher(flush=not_found, window_ms=0)
+            return await http.posts([{'url': url, 'data': {}} for url in ('ms1', 'ms2')], batcher=batcher)
+
+        skipped, answered = asyncio.run(run())
+        self.assertIn('Circuit open', skipped['_error'])
+        self.assertEqual(answered['_status'], 404)
+        self.assertEqual(http.scoreboard.get('ms2').errors, 0)
+
+    def test_only_server_errors_and_unreachable_nodes_are_failures(self):
+        self.assertFalse(http.is_node_failure({'_error': 'Malformed batch response'}))
+        self.assertFalse(http.is_node_failure({'_error': 'Not Found', '_status': 404}))
+        self.assertTrue(http.is_node_failure({'_error': 'Bad Gateway', '_status': 502}))
+        self.assertTrue(http.is_node_failure({'_error': 'Timeout', '_status': http.STATUS_UNREACHABLE}))
+
+    @unittest.skipUnless(importlib.util.find_spec('pylibjodi') and importlib.util.find_spec('pygroupsig'), 'needs pylibjodi and pygroupsig')
+    def test_batched_retrieve_misses_keep_the_circuit_closed(self):
+        """Misses split out of a real batch retrieve response are 404s, not node failures."""
+        from jodi.crypto import libjodi
+
+        async def not_found(url, reqs):
+            response = {'results': [{'message': 'Not Found'} for _ in reqs], 'sig_r': 'receipt'}
+            return libjodi.split_retrieve_batch(response, [f'hreq{i}' for i in range(len(reqs))])
+
+        self.addCleanup(http.scoreboard.nodes.clear)
+
+        async def run():
+            batcher = MicroBatcher(flush=not_found, window_ms=0)
+            reqs = [{'url': 'ms1', 'data': {}} for _ in range(2 * http.config.HTTP_BREAKER_FAILURES)]
+            return [await http.send(req, batcher) for req in reqs]
+
+        responses = asyncio.run(run())
+        self.assertTrue(all(res.get('_status') == 404 for res in responses))
+        self.assertEqual(http.scoreboard.get('ms1').state, http.CIRCUIT_CLOSED)
+        self.assertEqual(http.scoreboard.get('ms1').errors, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from jodi.crypto.keys import KeyRegistry, load_private_key
+from jodi.prototype.stirshaken.certs import generate_key_pair
+
+class TestKeyRegistry(unittest.TestCase):
+    def test_parses_each_pem_once(self):
+        """The same PEM returns the same parsed key object."""
+        private_key_str, _ = generate_key_pair()
+        key = load_private_key(private_key_str)
+        self.assertIsInstance(key, ec.EllipticCurvePrivateKey)
+        self.assertIs(load_private_key(private_key_str), key)
+        self.assertIs(load_private_key(key), key)
+
+    def test_evicts_least_recently_used(self):
+        """The registry stays within capacity, evicting the oldest entry."""
+        registry = KeyRegistry(capacity=2)
+        loads = []
+        loader = lambda pem: loads.append(pem) or pem
+        for pem in ['a', 'b', 'a', 'c', 'a', 'b']:
+            registry.get('pk', pem, loader)
+        self.assertEqual(loads, ['a', 'b', 'c', 'b'])
+        self.assertEqual(registry.stats()['size'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
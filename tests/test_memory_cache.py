@@ -0,0 +1,51 @@
+import random
+import unittest
+from unittest import mock
+
+from jodi.models.memory_cache import MemoryCache, TimingWheel
+
+class TestTimingWheel(unittest.TestCase):
+    def test_entries_come_due_on_their_tick_across_levels(self):
+        """Entries on every level, and in the overflow, fire on the tick they were scheduled for."""
+        wheel = TimingWheel(tick=1, slots=4, levels=2, now=0)
+        due_at = {f'k{i}': random.Random(i).randint(1, 40) for i in range(200)}
+        for key, at in due_at.items():
+            wheel.schedule(key, at)
+
+        fired = {}
+        for now in range(1, 41):
+            for key in wheel.advance(now):
+                fired[key] = now
+        self.assertEqual(fired, due_at)
+
+class TestMemoryCache(unittest.TestCase):
+    def test_ttl_overwrite_and_nx(self):
+        clock = [1000.0]
+        with mock.patch('jodi.models.memory_cache.time.monotonic', lambda: clock[0]):
+            cache = MemoryCache(shards=2, max_bytes=1 << 20, tick_ms=100)
+            cache.setex('a', 5, 'v1')
+            self.assertIsNone(cache.set('a', 'v2', ex=5, nx=True))
+            clock[0] += 3
+            cache.setex('a', 5, 'v3') # refreshed expiry outlives the old wheel entry
+            clock[0] += 3
+            self.assertEqual(cache.get('a'), 'v3')
+            clock[0] += 3
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_memory_cap_evicts_oldest(self):
+        cache = MemoryCache(shards=1, max_bytes=1000, tick_ms=100)
+        for i in range(20):
+            cache.set(f'key{i}', 'x' * 100)
+        self.assertIsNone(cache.get('key0'))
+        self.assertEqual(cache.get('key19'), 'x' * 100)
+        self.assertLessEqual(cache.stats()['bytes'], 1000)
+        self.assertGreater(cache.stats()['evicted'], 0)
+
+        with cache.pipeline() as pipe:
+            pipe.setex('p', 10, 'q').setex('r', 10, 's')
+            self.assertEqual(pipe.execute(), [True, True])
+        self.assertEqual(cache.mget(['p', 'missing']), ['q', None])
+
+if __name__ == '__main__':
+    unittest.main()
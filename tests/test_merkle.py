@@ -0,0 +1,22 @@
+import unittest
+
+from jodi.crypto import merkle
+
+class TestMerkle(unittest.TestCase):
+    def test_every_path_leads_to_the_root(self):
+        """Each leaf's inclusion path recomputes the root, including odd-sized trees."""
+        for n in [1, 2, 3, 5, 8, 13]:
+            leaves = [merkle.leaf_hash(f'hreq{i}hres{i}') for i in range(n)]
+            root, paths = merkle.build(leaves)
+            self.assertEqual(len(paths), n)
+            for leaf, path in zip(leaves, paths):
+                self.assertEqual(merkle.root_from_path(leaf, path), root)
+
+    def test_rejects_foreign_leaf(self):
+        """A leaf that was not in the tree does not reproduce the root."""
+        leaves = [merkle.leaf_hash(str(i)) for i in range(4)]
+        root, paths = merkle.build(leaves)
+        self.assertNotEqual(merkle.root_from_path(merkle.leaf_hash('x'), paths[0]), root)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import base64
+import unittest
+
+from jodi.models import records
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode('utf-8')
+
+class TestRecords(unittest.TestCase):
+    def test_binary_record_is_smaller_and_answers_like_text(self):
+        """Both layouts yield the same retrieve response; the binary one drops idx and base64."""
+        idx, ctx, bb = b64(bytes(32)), b64(bytes(range(32))) + ':' + b64(bytes(500)), b64(bytes(range(1, 33)))
+        sig = b64(bytes(300))
+
+        text = records.encode_text(idx, ctx, sig, bb)
+        binary = records.encode(ctx, sig, bb)
+
+        self.assertLess(len(binary), len(text) * 0.8)
+        expected = {'idx': idx, 'ctx': ctx, 'sig': sig, 'bb': bb}
+        for value in (text, text.decode('utf-8'), binary):
+            self.assertEqual(records.to_response(idx, value), expected)
+
+    def test_non_canonical_fields_are_kept_as_text(self):
+        value = records.encode('c0:not base64!', 'sig', b64(b'bb'))
+        record = records.decode(value)
+        self.assertIsInstance(record.c_1, memoryview)
+        self.assertEqual(record.ctx(), 'c0:not base64!')
+        self.assertEqual(record.text('sig'), 'sig')
+        self.assertEqual(record.text('bb'), b64(b'bb'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import importlib.util
+import unittest
+
+from cryptography.hazmat.primitives.asymmetric import x25519
+
+HAS_GROUPSIG = importlib.util.find_spec('pygroupsig') is not None
+
+@unittest.skipUnless(HAS_GROUPSIG, 'needs pygroupsig')
+class TestTickets(unittest.TestCase):
+    def setUp(self):
+        from jodi import config
+        from jodi.crypto import sessions
+        self.config, self.sessions = config, sessions
+        self.saved = (config.NODE_FQDN, config.SESSION_TICKET_KEY, config.TEST_ISK, sessions.ticket_key)
+        config.SESSION_TICKET_KEY, config.TEST_ISK = None, 'shared identity key'
+        self.share = sessions.get_share(x25519.X25519PrivateKey.generate())
+
+    def tearDown(self):
+        config, sessions = self.config, self.sessions
+        config.NODE_FQDN, config.SESSION_TICKET_KEY, config.TEST_ISK, sessions.ticket_key = self.saved
+
+    def use_node(self, fqdn: str):
+        self.config.NODE_FQDN = fqdn
+        self.sessions.ticket_key = None
+
+    def test_ticket_is_only_accepted_by_its_issuer(self):
+        """Nodes deriving their ticket key from the same TEST_ISK refuse each other's tickets."""
+        self.use_node('ev1:10430')
+        ticket = self.sessions.issue(self.share)['ticket']
+        self.assertIsNotNone(self.sessions.open_ticket(ticket))
+
+        self.use_node('ev2:10430')
+        self.assertIsNone(self.sessions.open_ticket(ticket))
+
+    def test_shared_ticket_key_is_still_bound_to_the_node(self):
+        """A SESSION_TICKET_KEY copied to several nodes does not make their tickets interchangeable."""
+        self.sessions.ticket_key = bytes(32)
+        ticket = self.sessions.issue(self.share, node='ev1:10430')['ticket']
+        self.assertIsNotNone(self.sessions.open_ticket(ticket, node='ev1:10430'))
+        self.assertIsNone(self.sessions.open_ticket(ticket, node='ev2:10430'))
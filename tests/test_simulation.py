@@ -0,0 +1,53 @@
+import asyncio
+import importlib.util
+import unittest
+
+HAS_CRYPTO = importlib.util.find_spec('pylibjodi') and importlib.util.find_spec('pygroupsig')
+
+def cache_is_up() -> bool:
+    from jodi.models import cache
+    try:
+        return cache.connect().ping()
+    except Exception:
+        return False
+
+@unittest.skipUnless(HAS_CRYPTO, 'needs pylibjodi and pygroupsig')
+class TestSimulatedProvider(unittest.TestCase):
+    def setUp(self):
+        if not cache_is_up():
+            self.skipTest('needs the cache')
+
+    def test_publish_then_retrieve(self):
+        """A token published by the simulator's Provider is retrieved by another one."""
+        from jodi import config
+        from jodi.crypto import billing, groupsig
+        from jodi.models import cache
+        from jodi.prototype.simulations import entities
+        from jodi.prototype.simulations.local import LocalSimulator
+        from jodi.prototype.stirshaken.certs import generate_key_pair
+
+        cache.set_client(cache.connect())
+        LocalSimulator.create_jodi_nodes(num_evs=5, num_repos=5)
+        entities.set_evaluator_keys(cache.find(key=config.EVAL_KEYSETS_KEY, dtype=dict))
+
+        sk, _ = generate_key_pair()
+        params = {
+            'impl': False,
+            'mode': 'jodi',
+            'gpk': groupsig.get_gpk(),
+            'gsk': groupsig.get_gsk(),
+            'n_ev': 3,
+            'n_ms': 3,
+            'cr': {'x5u': 'https://example.com/ev1.crt', 'sk': sk},
+            'cps': {'fqdn': 'example.com'},
+            'bt': billing.create_endorsed_token(config.VOPRF_SK),
+        }
+
+        async def run():
+            publisher = entities.Provider({'pid': 'P0', 'next_prov': (1, 0), **params})
+            retriever = entities.Provider({'pid': 'P1', **params})
+            signal, token = await publisher.originate()
+            return token, await retriever.terminate(signal)
+
+        token, retrieved = asyncio.run(run())
+        self.assertEqual(retrieved, token)
@@ -0,0 +1,33 @@
+import asyncio
+import unittest
+
+from jodi.helpers.waiters import WaiterTable
+
+class TestWaiterTable(unittest.TestCase):
+    def test_notify_wakes_every_waiter_of_a_key(self):
+        """Waiters of the notified key wake at once; others time out and leave no entry behind."""
+        async def run():
+            table = WaiterTable()
+            waiting = [(key, table.register(key)) for key in ('idx1', 'idx1', 'idx2')]
+            tasks = [asyncio.ensure_future(table.wait(key, future, 0.05)) for (key, future) in waiting]
+            await asyncio.sleep(0)
+            self.assertEqual(table.notify('idx1'), 2)
+            return await asyncio.gather(*tasks), table.stats()
+
+        results, stats = asyncio.run(run())
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual((stats['waiting'], stats['keys'], stats['woken'], stats['timed_out']), (0, 0, 2, 1))
+
+    def test_notify_before_wait_is_not_lost(self):
+        """A key notified between register and wait still wakes its waiter; a full table refuses more."""
+        async def run():
+            table = WaiterTable(max_waiters=1)
+            future = table.register('idx')
+            self.assertIsNone(table.register('other'))
+            table.notify('idx')
+            return await table.wait('idx', future, 0.05)
+
+        self.assertTrue(asyncio.run(run()))
+
+if __name__ == '__main__':
+    unittest.main()